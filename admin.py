@@ -1,10 +1,15 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 import logging
-from database import (
-    init_db, get_db, add_song, get_all_songs, get_song_by_id,
-    delete_song, update_song, search_by_title, search_by_text, get_songs_by_region
-)
+import os
+from database import init_db, get_song_by_id, delete_song, find_duplicate_groups
+from async_database import run_db
+from cache import SongCache, SearchCache, RenderCache
+from rendering import render_song, send_rendered, split_text, MESSAGE_LIMIT
+from write_queue import WriteBatcher
+from update_processor import PerUserUpdateProcessor
+from persistence import build_persistence
+from metrics import REGISTRY, instrument_application, start_metrics_server
 from env import ADMIN_API_TOKEN
 
 logging.basicConfig(
@@ -13,47 +18,82 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-init_db()
-
-def parse_region(region_str):
-    """Parse region string into category and place"""
-    if region_str and '|' in region_str:
-        parts = region_str.split('|')
-        return parts[0], parts[1] if len(parts) > 1 else "не указано"
-    return region_str, "не указано"
-
-async def show_song_details(update, song, edit_mode=False):
-    """Show song details with ID and action buttons"""
-    category, place = parse_region(song.region)
-    
-    response = (
+# "polling" (default) or "webhook": both bots are served by webhook.py
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Local port of the /metrics endpoint in polling mode
+METRICS_PORT = int(os.getenv("ADMIN_METRICS_PORT", "9101"))
+# "0" skips migrations at import: cluster.py runs them once in the ingress process before starting workers
+if os.getenv("INIT_DB", "1") == "1":
+    init_db()
+
+# Rendered song details by id, already split into pages
+song_details_cache = SongCache()
+# Pages of search results and /all
+search_cache = SearchCache()
+# Prebuilt keyboards of /list pages
+render_cache = RenderCache()
+# Song additions and edits from several admins are written in batches
+write_batcher = WriteBatcher()
+
+def render_song_details(song):
+    """Render song details with ID and the full text, split into pages for long lyrics"""
+    header = (
         f"🎵 ID: {song.id}\n\n"
         f"📝 Название: {song.title}\n\n"
-        f"🗺️ Категория: {category}\n"
-        f"📍 Место: {place}\n\n"
-        f"📜 Текст:\n{song.text[:300]}{'...' if len(song.text) > 300 else ''}"
+        f"🗺️ Категория: {song.category}\n"
+        f"📍 Место: {song.place or 'не указано'}\n\n"
+        f"📜 Текст:\n"
     )
-    
+    return render_song(song.id, header, song.text)
+
+async def get_song_details(song_id):
+    """Return rendered song details from cache or database, None if there is no such song"""
+    if song_details_cache.sync_due():
+        await run_db(song_details_cache.sync)
+
+    response = song_details_cache.get(song_id)
+    if response is None:
+        generation = song_details_cache.generation
+        song = await run_db(get_song_by_id, song_id)
+        if not song:
+            return None
+        response = render_song_details(song)
+        song_details_cache.put(song_id, response, generation)
+    return response
+
+def song_action_rows(song_id, edit_mode=False):
+    """Action buttons under the song details"""
     if edit_mode:
-        keyboard = [
+        return [
             [InlineKeyboardButton("Название", callback_data="edit_title")],
             [InlineKeyboardButton("Регион", callback_data="edit_region")],
             [InlineKeyboardButton("Текст", callback_data="edit_text")],
             [InlineKeyboardButton("Отмена", callback_data="cancel_edit")]
         ]
-    else:
-        keyboard = [
-            [InlineKeyboardButton("Редактировать", callback_data=f"edit_{song.id}")],
-            [InlineKeyboardButton("Удалить", callback_data=f"delete_{song.id}")],
-            [InlineKeyboardButton("Назад", callback_data="back")]
-        ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if isinstance(update, Update):
-        await update.message.reply_text(response, reply_markup=reply_markup)
-    else:
-        await update.edit_message_text(response, reply_markup=reply_markup)
+    return [
+        [InlineKeyboardButton("Редактировать", callback_data=f"edit_{song_id}")],
+        [InlineKeyboardButton("Удалить", callback_data=f"delete_{song_id}")],
+        [InlineKeyboardButton("Назад", callback_data="back")]
+    ]
+
+async def send_song_details(update, song_id, rendered, edit_mode=False, page=0):
+    """Send rendered song details (one page of the text) with action buttons"""
+    await send_rendered(update, rendered, song_id, page, song_action_rows(song_id, edit_mode))
+
+async def show_song_details(update, song, edit_mode=False):
+    """Show song details with ID and action buttons"""
+    await send_song_details(update, song.id, render_song_details(song), edit_mode)
+
+async def post_init(application: Application) -> None:
+    """Start dialog state expiry and, in polling mode, the metrics endpoint"""
+    if application.persistence:
+        application.persistence.start_expiry(application)
+    if BOT_MODE != "webhook":
+        await start_metrics_server(METRICS_PORT)
+
+async def post_shutdown(application: Application) -> None:
+    """Write songs still waiting in the write batcher"""
+    await write_batcher.close()
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Handler for /start command"""
@@ -65,7 +105,8 @@ async def start(update: Update, context: CallbackContext) -> None:
         "/delete - Удалить песню\n"
         "/search_title - Поиск по названию\n"
         "/search_text - Поиск по тексту\n"
-        "/search_region - Поиск по региону"
+        "/search_region - Поиск по региону\n"
+        "/duplicates - Похожие песни (возможные дубликаты)"
     )
 
 async def help_command(update: Update, context: CallbackContext) -> None:
@@ -78,40 +119,88 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "/delete - Удалить песню\n"
         "/search_title - Поиск по названию\n"
         "/search_text - Поиск по тексту\n"
-        "/search_region - Поиск по региону"
+        "/search_region - Поиск по региону\n"
+        "/duplicates - Похожие песни (возможные дубликаты)"
     )
 
+# How many duplicate groups one /duplicates report shows
+DUPLICATE_REPORT_GROUPS = 100
+
+async def duplicates_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for /duplicates: groups of near-duplicate songs across the archive"""
+    await update.message.reply_text("Ищу похожие песни...")
+    try:
+        groups = await run_db(find_duplicate_groups)
+        if not groups:
+            await update.message.reply_text("Похожих песен не найдено")
+            return
+
+        lines = [f"Найдено групп похожих песен: {len(groups)}"]
+        for number, group in enumerate(groups[:DUPLICATE_REPORT_GROUPS], 1):
+            lines.append(f"\n{number}. Сходство до {group['similarity']:.0%}:")
+            for song in group["songs"]:
+                lines.append(f"{song.id}: {song.title} ({song.place or song.category})")
+        if len(groups) > DUPLICATE_REPORT_GROUPS:
+            lines.append(f"\n...и еще {len(groups) - DUPLICATE_REPORT_GROUPS} групп")
+        lines.append("\nУдалить лишнее можно командой /delete")
+        for chunk in split_text("\n".join(lines), MESSAGE_LIMIT):
+            await update.message.reply_text(chunk)
+    except Exception as e:
+        logger.error(f"Error finding duplicates: {e}")
+        await update.message.reply_text("Ошибка при поиске дубликатов")
+
 async def add_song_handler(update: Update, context: CallbackContext) -> None:
     """Handler for adding new song"""
     await update.message.reply_text("Введите название песни:")
     context.user_data['state'] = 'awaiting_title'
 
+def build_page_keyboard(page, kind):
+    """Build keyboard with song IDs for one page and navigation buttons"""
+    keyboard = []
+    for song in page.songs:
+        btn_text = f"{song.id}: {song.title}"
+        if song.place:
+            btn_text += f" ({song.place})"
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"song_{song.id}")])
+
+    navigation = []
+    if page.prev_cursor:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"page_{kind}_{page.prev_cursor}"))
+    if page.next_cursor:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"page_{kind}_{page.next_cursor}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def get_page_view(kind, query=None, cursor=None):
+    """Page of results and its keyboard; /list pages come prebuilt from the render cache"""
+    if kind != "all":
+        page = await run_db(search_cache.get_page, kind, query, cursor)
+        return page, build_page_keyboard(page, kind)
+
+    if render_cache.sync_due():
+        await run_db(render_cache.sync)
+    view = render_cache.get(cursor)
+    if view is None:
+        generation = render_cache.generation
+        page = await run_db(search_cache.get_page, kind, query, cursor)
+        view = (page, build_page_keyboard(page, kind))
+        render_cache.put(cursor, view, generation)
+    return view
+
 async def list_songs_handler(update: Update, context: CallbackContext) -> None:
     """Handler for listing all songs with IDs"""
-    db = next(get_db())
     try:
-        songs = get_all_songs(db)
-        if not songs:
+        page, reply_markup = await get_page_view("all")
+        if not page.songs:
             await update.message.reply_text("В базе пока нет песен.")
             return
 
-        keyboard = []
-        for song in songs:
-            category, place = parse_region(song.region)
-            btn_text = f"{song.id}: {song.title}"
-            if place and place != "не указано":
-                btn_text += f" ({place})"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"song_{song.id}")])
-        
-        await update.message.reply_text(
-            "Список всех песен:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await update.message.reply_text("Список всех песен:", reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Error listing songs: {e}")
         await update.message.reply_text("Ошибка при получении списка песен")
-    finally:
-        db.close()
 
 async def delete_song_handler(update: Update, context: CallbackContext) -> None:
     """Handler for deleting song by ID"""
@@ -159,10 +248,8 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             context.user_data['state'] = 'awaiting_text'
 
         elif user_state == 'awaiting_text':
-            db = next(get_db())
             try:
-                song = add_song(
-                    db,
+                song = await write_batcher.add_song(
                     title=context.user_data['title'],
                     region=context.user_data['region'],
                     text=user_input
@@ -174,14 +261,12 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             except Exception as e:
                 await update.message.reply_text(f"Ошибка: {str(e)}")
             finally:
-                db.close()
                 context.user_data.clear()
 
         elif user_state == 'awaiting_song_id_for_delete':
             try:
                 song_id = int(user_input)
-                db = next(get_db())
-                if delete_song(db, song_id):
+                if await run_db(delete_song, song_id):
                     await update.message.reply_text(f"Песня с ID {song_id} удалена")
                 else:
                     await update.message.reply_text(f"Песня с ID {song_id} не найдена")
@@ -190,14 +275,12 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             except Exception as e:
                 await update.message.reply_text(f"Ошибка: {str(e)}")
             finally:
-                db.close()
                 context.user_data.clear()
 
         elif user_state == 'awaiting_song_id_for_edit':
             try:
                 song_id = int(user_input)
-                db = next(get_db())
-                song = get_song_by_id(db, song_id)
+                song = await run_db(get_song_by_id, song_id)
                 if song:
                     context.user_data['song_id'] = song_id
                     await show_song_details(update, song, edit_mode=True)
@@ -207,8 +290,6 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
                 await update.message.reply_text("ID должен быть числом")
             except Exception as e:
                 await update.message.reply_text(f"Ошибка: {str(e)}")
-            finally:
-                db.close()
 
         elif user_state.startswith('editing_'):
             field = user_state.split('_')[1]
@@ -219,10 +300,9 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
                 context.user_data.clear()
                 return
                 
-            db = next(get_db())
             try:
                 update_data = {field: user_input}
-                updated_song = update_song(db, song_id, **update_data)
+                updated_song = await write_batcher.update_song(song_id, **update_data)
                 
                 if updated_song:
                     await update.message.reply_text(f"{field.capitalize()} успешно обновлен!")
@@ -232,65 +312,52 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             except Exception as e:
                 await update.message.reply_text(f"Ошибка: {str(e)}")
             finally:
-                db.close()
                 context.user_data['state'] = 'edit_menu'
 
         elif user_state == 'search_title':
-            db = next(get_db())
+            context.user_data.clear()
             try:
-                songs = search_by_title(db, user_input)
-                await display_search_results(update, songs, "по названию")
+                page = await run_db(search_cache.get_page, "title", user_input)
+                if page.songs:
+                    await display_search_results(update, context, page, "title", user_input, "по названию")
+                else:
+                    page = await run_db(search_cache.get_page, "fuzzy", user_input)
+                    await display_search_results(update, context, page, "fuzzy", user_input, "по похожим названиям")
             except Exception as e:
                 await update.message.reply_text(f"Ошибка поиска: {str(e)}")
-            finally:
-                db.close()
-                context.user_data.clear()
 
         elif user_state == 'search_text':
-            db = next(get_db())
+            context.user_data.clear()
             try:
-                songs = search_by_text(db, user_input)
-                await display_search_results(update, songs, "по тексту")
+                page = await run_db(search_cache.get_page, "text", user_input)
+                await display_search_results(update, context, page, "text", user_input, "по тексту")
             except Exception as e:
                 await update.message.reply_text(f"Ошибка поиска: {str(e)}")
-            finally:
-                db.close()
-                context.user_data.clear()
 
         elif user_state == 'search_region':
-            db = next(get_db())
+            context.user_data.clear()
             try:
-                songs = get_songs_by_region(db, user_input)
-                await display_search_results(update, songs, "по региону")
+                page = await run_db(search_cache.get_page, "region", user_input)
+                await display_search_results(update, context, page, "region", user_input, "по региону")
             except Exception as e:
                 await update.message.reply_text(f"Ошибка поиска: {str(e)}")
-            finally:
-                db.close()
-                context.user_data.clear()
 
     except Exception as e:
         logger.error(f"Error in handle_message: {e}")
         await update.message.reply_text("Произошла ошибка")
         context.user_data.clear()
 
-async def display_search_results(update: Update, songs, search_type):
-    """Display search results with IDs"""
-    if not songs:
+async def display_search_results(update: Update, context: CallbackContext, page, kind, search_query, search_type):
+    """Display the first page of search results with IDs"""
+    if not page.songs:
         await update.message.reply_text(f"По запросу {search_type} ничего не найдено")
         return
-    
-    keyboard = []
-    for song in songs:
-        category, place = parse_region(song.region)
-        btn_text = f"{song.id}: {song.title}"
-        if place and place != "не указано":
-            btn_text += f" ({place})"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"song_{song.id}")])
-    
+
+    context.user_data['search'] = {'kind': kind, 'query': search_query, 'type': search_type}
     await update.message.reply_text(
         f"🔍 Результаты поиска {search_type}:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-)
+        reply_markup=build_page_keyboard(page, kind)
+    )
 
 async def button_callback(update: Update, context: CallbackContext) -> None:
     """Handler for inline buttons"""
@@ -298,17 +365,41 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
     await query.answer()
 
     try:
-        if query.data.startswith("song_"):
+        if query.data.startswith("page_"):
+            kind, cursor = query.data[len("page_"):].rsplit("_", 1)
+            if kind == "all":
+                search_query, header = None, "Список всех песен:"
+            else:
+                search = context.user_data.get('search')
+                if not search or search['kind'] != kind:
+                    await query.edit_message_text("Результаты поиска устарели, повторите поиск")
+                    return
+                search_query, header = search['query'], f"🔍 Результаты поиска {search['type']}:"
+
+            page, reply_markup = await get_page_view(kind, search_query, cursor)
+            if page.songs:
+                await query.edit_message_text(header, reply_markup=reply_markup)
+            else:
+                await query.edit_message_text("Больше песен нет")
+
+        elif query.data.startswith("song_"):
             song_id = int(query.data.split("_")[1])
-            db = next(get_db())
-            try:
-                song = get_song_by_id(db, song_id)
-                if song:
-                    await show_song_details(query, song)
-                else:
-                    await query.edit_message_text("❌ Песня не найдена")
-            finally:
-                db.close()
+            response = await get_song_details(song_id)
+            if response:
+                await send_song_details(query, song_id, response)
+            else:
+                await query.edit_message_text("❌ Песня не найдена")
+
+        elif query.data.startswith("lyrics_"):
+            _, song_id, page = query.data.split("_")
+            song_id = int(song_id)
+            response = await get_song_details(song_id)
+            if response:
+                # Keep the field buttons while the song is being edited
+                edit_mode = context.user_data.get('song_id') == song_id
+                await send_song_details(query, song_id, response, edit_mode, int(page))
+            else:
+                await query.edit_message_text("❌ Песня не найдена")
 
         elif query.data.startswith("edit_"):
             field = query.data.split("_")[1]
@@ -317,23 +408,19 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         
         elif query.data.startswith("delete_"):
             song_id = int(query.data.split("_")[1])
-            db = next(get_db())
-            try:
-                song = get_song_by_id(db, song_id)
-                if song:
-                    context.user_data['song_to_delete'] = {
-                        'id': song_id,
-                        'title': song.title
-                    }
-                    keyboard = [
-                        [InlineKeyboardButton("Да, удалить", callback_data="confirm_delete")],
-                        [InlineKeyboardButton("Нет, отменить", callback_data="cancel_delete")]
-                    ]
-                    await query.edit_message_text(
-                        f"Удалить песню?\nID: {song_id}\nНазвание: {song.title}",
-                        reply_markup=InlineKeyboardMarkup(keyboard))
-            finally:
-                db.close()
+            song = await run_db(get_song_by_id, song_id)
+            if song:
+                context.user_data['song_to_delete'] = {
+                    'id': song_id,
+                    'title': song.title
+                }
+                keyboard = [
+                    [InlineKeyboardButton("Да, удалить", callback_data="confirm_delete")],
+                    [InlineKeyboardButton("Нет, отменить", callback_data="cancel_delete")]
+                ]
+                await query.edit_message_text(
+                    f"Удалить песню?\nID: {song_id}\nНазвание: {song.title}",
+                    reply_markup=InlineKeyboardMarkup(keyboard))
 
         elif query.data == "confirm_delete":
             if 'song_to_delete' not in context.user_data:
@@ -341,9 +428,8 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
                 return
             
             song_id = context.user_data['song_to_delete']['id']
-            db = next(get_db())
             try:
-                if delete_song(db, song_id):
+                if await run_db(delete_song, song_id):
                     await query.edit_message_text(
                         f"Песня удалена:\n"
                         f"ID: {song_id}\n"
@@ -352,7 +438,6 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
                 else:
                     await query.edit_message_text("Ошибка при удалении")
             finally:
-                db.close()
                 context.user_data.clear()
 
         elif query.data in ["cancel_edit", "cancel_delete", "back"]:
@@ -366,9 +451,15 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         await query.edit_message_text("Произошла ошибка")
         context.user_data.clear()
 
-def main() -> None:
-    """Start the bot."""
-    application = Application.builder().token(ADMIN_API_TOKEN).build()
+def build_application(builder=None) -> Application:
+    """Create the Application with all handlers"""
+    if builder is None:
+        builder = Application.builder()
+    builder = builder.token(ADMIN_API_TOKEN).concurrent_updates(PerUserUpdateProcessor())
+    persistence = build_persistence("admin")
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start))
@@ -380,6 +471,7 @@ def main() -> None:
     application.add_handler(CommandHandler("search_title", search_title_handler))
     application.add_handler(CommandHandler("search_text", search_text_handler))
     application.add_handler(CommandHandler("search_region", search_region_handler))
+    application.add_handler(CommandHandler("duplicates", duplicates_handler))
 
     # Register message handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -387,8 +479,30 @@ def main() -> None:
     # Register callback handler
     application.add_handler(CallbackQueryHandler(button_callback))
 
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
+
+    instrument_application(application, "admin")
+    REGISTRY.register_collector("admin_song_cache", "Кэш карточек песен", song_details_cache.stats)
+    REGISTRY.register_collector("admin_search_cache", "Кэш результатов поиска", search_cache.stats)
+    REGISTRY.register_collector("admin_render_cache", "Кэш клавиатур страниц /list", render_cache.stats)
+    REGISTRY.register_collector("admin_updates", "Очереди обновлений", application.update_processor.stats)
+    REGISTRY.register_collector("admin_write_batcher", "Пакетная запись песен", write_batcher.stats)
+    if application.persistence:
+        REGISTRY.register_collector("admin_user_state", "Состояние диалогов", application.persistence.stats)
+
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    # In webhook mode both bots are served by one process (see webhook.py)
+    if BOT_MODE == "webhook":
+        import webhook
+        webhook.main()
+        return
+
     # Run the bot
-    application.run_polling()
+    build_application().run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,44 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import DB_POOL_SIZE, DB_MAX_OVERFLOW, session_scope, get_pool_stats
+from metrics import REGISTRY, observe_db_call
+
+# Размер пула потоков, в которых выполняются синхронные запросы SQLAlchemy.
+# Не должен превышать размер пула соединений, иначе потоки будут ждать соединение.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(min(8, DB_POOL_SIZE + DB_MAX_OVERFLOW))))
+
+_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_WORKERS,
+    thread_name_prefix="db"
+)
+
+REGISTRY.register_collector("db_pool", "Состояние пула соединений с базой данных", get_pool_stats)
+
+def _call_with_session(fn, args, kwargs):
+    name = getattr(fn, "__qualname__", repr(fn))
+    started = time.perf_counter()
+    try:
+        with session_scope() as db:
+            result = fn(db, *args, **kwargs)
+    except Exception:
+        observe_db_call(name, time.perf_counter() - started, error=True)
+        raise
+    observe_db_call(name, time.perf_counter() - started, result)
+    return result
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Выполняет функцию из database.py в отдельном потоке, не блокируя event loop.
+
+    Сессия открывается и закрывается внутри потока (session_scope), поэтому
+    обработчикам не нужно вызывать get_db(). Пример:
+
+        songs = await run_db(search_by_text, "калинка")
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(_call_with_session, fn, args, kwargs)
+    return await loop.run_in_executor(_executor, call)
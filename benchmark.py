@@ -0,0 +1,478 @@
+"""
+Воспроизводимый бенчмарк функций database.py и отрисовки ответов ботов.
+
+Каждая пара (база, размер архива) замеряется в отдельном процессе: движок
+SQLAlchemy создается при импорте database.py по переменной DATABASE_URL.
+
+    python benchmark.py run --sizes 1000 10000 --db sqlite --db postgresql://bench@localhost/bench
+    python benchmark.py run --sizes 100000 1000000 --repeat 5 --output bench_large.json
+    python benchmark.py compare bench_old.json bench_new.json
+
+По умолчанию замеряются 1000 и 10000 песен (несколько минут). На 100000
+песен SQLite-прогон идет около 10 минут, на 1000000 - около часа даже с
+--repeat 5: полные выборки и выдачи без LIMIT растут линейно с архивом.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Сколько раз вызывается каждая функция (для полных выборок - в FULL_SCAN_DIVISOR раз меньше)
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", "20"))
+FULL_SCAN_DIVISOR = 5
+FULL_SCAN_FUNCTIONS = {"get_all_songs", "get_all_songs_with_id", "search_by_text_ilike"}
+# Сколько песен добавляется в замерах пропускной способности записи
+BENCH_WRITES = int(os.getenv("BENCH_WRITES", "500"))
+# Порог замедления медианы, после которого compare помечает функцию как регрессию
+REGRESSION_THRESHOLD = 1.2
+
+CATEGORIES = [
+    "Свадебные", "Колыбельные", "Лирические", "Хороводные", "Плясовые", "Причитания",
+    "Духовные стихи", "Частушки", "Рекрутские", "Календарные", "Игровые", "Былины"
+]
+PROVINCES = [
+    "Архангельская обл.", "Вологодская обл.", "Костромская обл.", "Белгородская обл.",
+    "Воронежская обл.", "Рязанская обл.", "Смоленская обл.", "Псковская обл.",
+    "Новгородская обл.", "Тверская обл.", "Курская обл.", "Брянская обл."
+]
+VILLAGES = [
+    "Веркола", "Карпогоры", "Ульяновка", "Подсосенье", "Борисовка", "Плёхово", "Покровка",
+    "Ивановка", "Заречье", "Луговое", "Красное", "Никольское", "Березники", "Сосновка",
+    "Дубровка", "Городище", "Слобода", "Кривцы", "Осиновка", "Мокрое"
+]
+WORDS = [
+    "ой", "да", "ли", "как", "во", "поле", "берёзка", "стояла", "калина", "малина", "реченька",
+    "быстрая", "молодец", "девица", "красная", "матушка", "батюшка", "сокол", "ясный", "голубушка",
+    "сад", "зелёный", "сударушка", "ветер", "буйный", "туман", "заря", "вечерняя", "утренняя",
+    "травушка", "муравушка", "лебедь", "белая", "ходила", "гуляла", "венок", "плела", "милый",
+    "мой", "друг", "сердечный", "горюшко", "горькое", "кручинушка", "рученьки", "ноженьки",
+    "головушка", "ворота", "тесовые", "терем", "высокий", "во саду", "на горе", "под горою",
+    "соловей", "кукушка", "вдоль", "по улице", "широкой", "реке", "лодочка", "весёлая",
+    "дороженька", "дальняя", "свадебка", "гостюшки", "дорогие", "кудри", "русые", "рябина",
+    "кудрявая", "лён", "пряла", "прялица", "снежок", "метелица", "ласточка", "касатушка"
+]
+
+def _title(rng: random.Random) -> str:
+    words = rng.sample(WORDS, rng.randint(2, 5))
+    title = " ".join(words)
+    return title[0].upper() + title[1:]
+
+def _lyrics(rng: random.Random) -> str:
+    # 5% длинных песен (былины, причитания) - несколько тысяч символов
+    verses = rng.randint(25, 60) if rng.random() < 0.05 else rng.randint(3, 8)
+    lines_per_verse = rng.choice((2, 4, 4, 6))
+    result = []
+    for _ in range(verses):
+        lines = []
+        for _ in range(lines_per_verse):
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 7)))
+            lines.append(line[0].upper() + line[1:] + rng.choice((",", ",", ".", "!", "...")))
+        result.append("\n".join(lines))
+    return "\n\n".join(result)
+
+def _region(rng: random.Random) -> str:
+    category = rng.choice(CATEGORIES)
+    # Примерно у пятой части песен место записи не указано
+    if rng.random() < 0.2:
+        return category
+    return f"{category}|{rng.choice(PROVINCES)}, д. {rng.choice(VILLAGES)}"
+
+def generate_corpus(size: int, seed: int = 0):
+    """Синтетический архив: названия и тексты на кириллице, регионы вида 'Категория|Место'"""
+    rng = random.Random(seed)
+    return [
+        {"title": _title(rng), "region": _region(rng), "text": _lyrics(rng)}
+        for _ in range(size)
+    ]
+
+def _stats(durations, rows=None):
+    durations = sorted(durations)
+    result = {
+        "runs": len(durations),
+        "min_ms": round(durations[0] * 1000, 3),
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+        "p95_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 3),
+        "mean_ms": round(statistics.fmean(durations) * 1000, 3),
+        "max_ms": round(durations[-1] * 1000, 3)
+    }
+    if rows is not None:
+        result["rows"] = rows
+    return result
+
+def measure(fn, calls, count_rows: bool = True):
+    """Замеряет fn(*args) для каждого набора аргументов; первый вызов - прогрев"""
+    from metrics import result_size
+
+    fn(*calls[0])
+    durations = []
+    result = None
+    for args in calls:
+        started = time.perf_counter()
+        result = fn(*args)
+        durations.append(time.perf_counter() - started)
+    return _stats(durations, result_size(result) if count_rows else None)
+
+async def measure_async(fn, calls):
+    await fn(*calls[0])
+    durations = []
+    for args in calls:
+        started = time.perf_counter()
+        await fn(*args)
+        durations.append(time.perf_counter() - started)
+    return _stats(durations)
+
+class _FakeMessage:
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        return text
+
+class _FakeUpdate:
+    """Заменяет Update и CallbackQuery: ответы бота никуда не отправляются"""
+
+    def __init__(self):
+        self.message = _FakeMessage()
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        return text
+
+class _FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+def _reset_database(reset: bool):
+    from sqlalchemy import text as sql_text
+    from database import Base, engine, init_db, SessionLocal, Song
+
+    init_db()
+    db = SessionLocal()
+    try:
+        count = db.query(Song).count()
+    finally:
+        db.close()
+    if count and not reset:
+        raise SystemExit(
+            f"В базе {engine.url.render_as_string(hide_password=True)} уже {count} песен. "
+            "Бенчмарк удаляет все данные: укажите --reset"
+        )
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.execute(sql_text("DROP TABLE IF EXISTS folk_songs_fts"))
+    Base.metadata.drop_all(bind=engine)
+    init_db()
+
+def _load_corpus(corpus) -> dict:
+    """Загружает архив тем же путем, что и importscript.py"""
+    import contextlib
+    from importscript import import_songs
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        for item in corpus:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    try:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            import_songs(f.name)
+        duration = time.perf_counter() - started
+    finally:
+        os.remove(f.name)
+    return _throughput(duration, len(corpus))
+
+def run_worker(size: int, repeat: int, seed: int, reset: bool):
+    """Замеры для базы из DATABASE_URL и архива из size песен"""
+    _reset_database(reset)
+
+    import database
+    from database import SessionLocal, engine
+
+    corpus = generate_corpus(size, seed)
+    rng = random.Random(seed + 1)
+    results = []
+
+    def record(group, function, stats):
+        results.append({"group": group, "function": function, **stats})
+        print(f"{engine.dialect.name} {size}: {function} {stats['median_ms']} мс", file=sys.stderr)
+
+    record("load", "import_songs", _load_corpus(corpus))
+
+    def calls(function, make_args):
+        count = max(3, repeat // FULL_SCAN_DIVISOR) if function in FULL_SCAN_FUNCTIONS else repeat
+        return [make_args() for _ in range(count)]
+
+    def title_word():
+        return rng.choice(rng.choice(corpus)["title"].split())
+
+    def text_words():
+        words = rng.choice(corpus)["text"].split()
+        return " ".join(word.strip(",.!") for word in rng.sample(words, 2))
+
+    def region():
+        return rng.choice(corpus)["region"]
+
+    def place():
+        return region().partition("|")[2].split(", д. ")[-1] or "Веркола"
+
+    db = SessionLocal()
+    try:
+        song_ids = [row[0] for row in db.query(database.Song.id).all()]
+        benchmarks = [
+            ("add_song", lambda: (db, *_title_region_text(rng))),
+            ("get_song_by_id", lambda: (db, rng.choice(song_ids))),
+            ("search_by_title", lambda: (db, title_word())),
+            ("search_by_title_fuzzy", lambda: (db, title_word()[:-1] + "а")),
+            ("search_by_text", lambda: (db, text_words())),
+            ("search_by_text_ilike", lambda: (db, text_words())),
+            ("get_songs_by_region", lambda: (db, region())),
+            ("get_songs_by_category", lambda: (db, rng.choice(CATEGORIES))),
+            ("get_songs_by_place", lambda: (db, place())),
+            ("get_all_songs", lambda: (db,)),
+            ("get_all_songs_with_id", lambda: (db,)),
+        ]
+        for function, make_args in benchmarks:
+            fn = getattr(database, function)
+            if function == "add_song":
+                fn = lambda db, title, region, text: database.add_song(db, title=title, region=region, text=text)
+            record("database", function, measure(fn, calls(function, make_args)))
+            db.expunge_all()
+
+        page_queries = [
+            ("all", lambda: None), ("title", title_word), ("text", text_words),
+            ("fuzzy", title_word), ("category", lambda: rng.choice(CATEGORIES)), ("place", place)
+        ]
+        for kind, make_query in page_queries:
+            record("database", f"get_songs_page:{kind}", measure(
+                database.get_songs_page, calls("get_songs_page", lambda: (db, kind, make_query()))
+            ))
+
+        _render_benchmarks(db, song_ids, rng, repeat, record)
+    finally:
+        db.close()
+
+    _write_benchmarks(rng, record)
+    # Индекс строится после замеров записи, чтобы его обновления не попали в них
+    _index_benchmarks(page_queries, calls, record)
+
+    return {"backend": engine.dialect.name, "size": size, "results": results}
+
+def _index_benchmarks(page_queries, calls, record):
+    """Построение SearchIndex и страницы выдачи из него для тех же запросов, что у get_songs_page"""
+    import gc
+    import tracemalloc
+    from database import SessionLocal
+    from search_index import SearchIndex
+
+    index = SearchIndex()
+    db = SessionLocal()
+    try:
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        index.build(db)
+        duration = time.perf_counter() - started
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        db.close()
+    songs = index.stats()["songs"]
+    result = _stats([duration], songs)
+    result["bytes_per_song"] = memory // songs if songs else 0
+    record("search_index", "build", result)
+
+    for kind, make_query in page_queries:
+        if index.supports(kind):
+            record("search_index", f"get_page:{kind}", measure(
+                index.get_page, calls("get_songs_page", lambda: (kind, make_query()))
+            ))
+
+def _title_region_text(rng: random.Random):
+    return _title(rng), _region(rng), _lyrics(rng)
+
+def _throughput(duration: float, count: int) -> dict:
+    result = _stats([duration], count)
+    result["rows_per_second"] = round(count / duration)
+    return result
+
+def _write_benchmarks(rng: random.Random, record, count: int = BENCH_WRITES, concurrency: int = 20):
+    """
+    Пропускная способность записи: add_song по одной, add_songs пачками и
+    concurrency одновременных админов с WriteBatcher и без него.
+    """
+    from async_database import run_db
+    from database import SessionLocal, add_song, add_songs
+    from write_queue import WriteBatcher
+
+    def songs():
+        return [dict(zip(("title", "region", "text"), _title_region_text(rng))) for _ in range(count)]
+
+    db = SessionLocal()
+    try:
+        items = songs()
+        started = time.perf_counter()
+        for item in items:
+            add_song(db, **item)
+        record("write", "add_song:sequential", _throughput(time.perf_counter() - started, count))
+
+        items = songs()
+        started = time.perf_counter()
+        for start in range(0, count, 50):
+            add_songs(db, items[start:start + 50])
+        record("write", "add_songs:batch_50", _throughput(time.perf_counter() - started, count))
+    finally:
+        db.close()
+
+    async def concurrent(add):
+        items = songs()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(item):
+            async with semaphore:
+                await add(item)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(item) for item in items))
+        return time.perf_counter() - started
+
+    async def run_concurrent():
+        direct = await concurrent(lambda item: run_db(add_song, **item))
+        batcher = WriteBatcher()
+        batched = await concurrent(lambda item: batcher.add_song(**item))
+        return direct, batched
+
+    direct, batched = asyncio.run(run_concurrent())
+    record("write", f"add_song:concurrent_{concurrency}", _throughput(direct, count))
+    record("write", f"WriteBatcher:concurrent_{concurrency}", _throughput(batched, count))
+
+def _render_benchmarks(db, song_ids, rng, repeat, record):
+    """Отрисовка клавиатур и карточек песен в bot.py и admin.py (без сети)"""
+    import admin
+    import bot
+    from database import get_songs_page, get_song_by_id
+
+    pages = [get_songs_page(db, "category", rng.choice(CATEGORIES)) for _ in range(repeat)]
+    songs = [get_song_by_id(db, rng.choice(song_ids)) for _ in range(repeat)]
+
+    page_calls = [(page, "category") for page in pages]
+    song_calls = [(song,) for song in songs]
+    record("render", "bot.build_page_keyboard", measure(bot.build_page_keyboard, page_calls, count_rows=False))
+    record("render", "bot.render_song_details", measure(bot.render_song_details, song_calls, count_rows=False))
+    record("render", "admin.build_page_keyboard", measure(admin.build_page_keyboard, page_calls, count_rows=False))
+    record("render", "admin.render_song_details", measure(admin.render_song_details, song_calls, count_rows=False))
+
+    async def render_async():
+        display = await measure_async(bot.display_results, [
+            (_FakeUpdate(), page, "category", "запрос", "в категории 'запрос'", _FakeContext()) for page in pages
+        ])
+        show = await measure_async(admin.show_song_details, [(_FakeUpdate(), song) for song in songs])
+        return display, show
+
+    display, show = asyncio.run(render_async())
+    record("render", "bot.display_results", display)
+    record("render", "admin.show_song_details", show)
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(databases, sizes, repeat: int, seed: int, output: str, reset: bool):
+    report = {
+        "commit": _git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+        "runs": []
+    }
+    for url in databases:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                if url == "sqlite":
+                    database_url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+                else:
+                    database_url = url
+                result_file = os.path.join(tmp, "result.json")
+                command = [
+                    sys.executable, os.path.abspath(__file__), "worker",
+                    "--size", str(size), "--repeat", str(repeat), "--seed", str(seed),
+                    "--result", result_file
+                ]
+                if reset:
+                    command.append("--reset")
+                subprocess.run(command, env={**os.environ, "DATABASE_URL": database_url}, check=True)
+                with open(result_file, encoding="utf-8") as f:
+                    report["runs"].append(json.load(f))
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+def compare(old_file: str, new_file: str, threshold: float = REGRESSION_THRESHOLD):
+    """Сравнивает медианы двух отчетов; возвращает число регрессий"""
+    def index(path):
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+        return report.get("commit"), {
+            (run["backend"], run["size"], result["function"]): result["median_ms"]
+            for run in report["runs"] for result in run["results"]
+        }
+
+    old_commit, old = index(old_file)
+    new_commit, new = index(new_file)
+    print(f"{old_commit} -> {new_commit}")
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        ratio = after / before if before else 1.0
+        mark = ""
+        if ratio >= threshold:
+            mark = "  РЕГРЕССИЯ"
+            regressions += 1
+        backend, size, function = key
+        print(f"{backend:10} {size:>8} {function:40} {before:>10.3f} -> {after:>10.3f} мс ({ratio:.2f}x){mark}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк функций database.py и отрисовки ответов")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="выполнить замеры")
+    run_parser.add_argument("--db", action="append", dest="databases",
+                            help="'sqlite' (временный файл) или URL базы PostgreSQL; можно указать несколько раз")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                            help="размеры архива; 100000 и 1000000 - долгие прогоны, см. README")
+    run_parser.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--reset", action="store_true", help="разрешить удаление данных в непустой базе")
+
+    worker_parser = commands.add_parser("worker", help=argparse.SUPPRESS)
+    worker_parser.add_argument("--size", type=int, required=True)
+    worker_parser.add_argument("--repeat", type=int, required=True)
+    worker_parser.add_argument("--seed", type=int, required=True)
+    worker_parser.add_argument("--result", required=True)
+    worker_parser.add_argument("--reset", action="store_true")
+
+    compare_parser = commands.add_parser("compare", help="сравнить два отчета")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.databases or ["sqlite"], args.sizes, args.repeat, args.seed, args.output, args.reset)
+    elif args.command == "worker":
+        result = run_worker(args.size, args.repeat, args.seed, args.reset)
+        with open(args.result, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+    else:
+        sys.exit(1 if compare(args.old, args.new, args.threshold) else 0)
@@ -1,8 +1,11 @@
 import logging
+import os
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     BotCommand,
     MenuButtonCommands
 )
@@ -12,14 +15,22 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackContext,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    InlineQueryHandler
 )
 from env import API_TOKEN
 from database import (
-    init_db, get_db, add_song, get_all_songs,
-    get_songs_by_region, search_by_title,
-    search_by_text, get_song_by_id
+    init_db, add_song, get_song_by_id, get_songs_by_ids, get_facet_counts, get_facet_value,
+    find_similar_songs
 )
+from async_database import run_db
+from cache import SongCache, SearchCache, RenderCache, normalize_query
+from search_index import SearchIndex
+from inline_search import InlineSearch
+from rendering import render_song, send_rendered, page_markup
+from update_processor import PerUserUpdateProcessor
+from persistence import build_persistence
+from metrics import REGISTRY, instrument_application, start_metrics_server
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -27,21 +38,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-init_db()
-
-def parse_region(region_str):
-    """Parse region string into category and place"""
-    if not region_str:
-        return "", ""
-    
-    if '|' in region_str:
-        parts = region_str.split('|')
-        category = parts[0]
-        place = parts[1] if len(parts) > 1 else ""
-        if place.strip() in ("", "."):
-            return category, ""
-        return category, place
-    return region_str, ""
+# "polling" (default) or "webhook": both bots are served by webhook.py
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Local port of the /metrics endpoint in polling mode
+METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9100"))
+# "1" to serve searches and /all from an in-memory index instead of the database
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "0") == "1"
+# "0" skips migrations at import: cluster.py runs them once in the ingress process before starting workers
+if os.getenv("INIT_DB", "1") == "1":
+    init_db()
+
+# Rendered song details by id, already split into pages
+song_details_cache = SongCache()
+# Pages of search results and /all
+search_cache = SearchCache()
+# Prebuilt keyboards of /all, category and place pages
+render_cache = RenderCache()
+# In-memory search index (SEARCH_INDEX=1)
+search_index = SearchIndex() if SEARCH_INDEX else None
 
 async def setup_commands(application: Application):
     """Set up the bot commands for the menu with CORRECT commands"""
@@ -52,12 +66,25 @@ async def setup_commands(application: Application):
         BotCommand("search_text", "Поиск по тексту"),
         BotCommand("search_place", "Поиск по месту"),
         BotCommand("search_category", "Поиск по категории"),
+        BotCommand("categories", "Все категории"),
+        BotCommand("places", "Все места записи"),
         BotCommand("all", "Список всех песен"),
         BotCommand("help", "Помощь и инструкции")
     ]
     await application.bot.set_my_commands(commands)
     await application.bot.set_chat_menu_button(menu_button=MenuButtonCommands())
 
+async def post_init(application: Application):
+    """Set up the command menu, the search index, dialog state expiry and, in polling mode, the metrics endpoint"""
+    await setup_commands(application)
+    if search_index:
+        await run_db(search_index.build)
+        logger.info(f"Поисковый индекс построен: {search_index.stats()}")
+    if application.persistence:
+        application.persistence.start_expiry(application)
+    if BOT_MODE != "webhook":
+        await start_metrics_server(METRICS_PORT)
+
 async def start_command(update: Update, context: CallbackContext):
     """Send a welcome message with available commands"""
     help_text = (
@@ -68,6 +95,8 @@ async def start_command(update: Update, context: CallbackContext):
         "/search_text - Поиск по тексту\n"
         "/search_place - Поиск по месту записи\n"
         "/search_category - Поиск по категории\n"
+        "/categories - Все категории\n"
+        "/places - Все места записи\n"
         "/all - Список всех песен\n"
         "/help - Помощь и инструкции\n\n"
         "Вы можете нажать на любую команду, чтобы быстро использовать эту команду\n"
@@ -89,6 +118,8 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "/search_text - Поиск песен по тексту\n"
         "/search_place - Поиск песен по месту записи\n"
         "/search_category - Поиск песен по категории\n"
+        "/categories - Категории с числом песен\n"
+        "/places - Места записи с числом песен\n"
         "/all - Просмотр всего архива\n"
         "/help - Эта справка\n\n"
         "Вы можете нажать на любую команду, чтобы быстро использовать эту команду\n"
@@ -121,33 +152,150 @@ async def search_category_handler(update: Update, context: CallbackContext) -> N
     await update.message.reply_text('Введите категорию для поиска:')
     context.user_data['awaiting_input'] = 'search_category'
 
+# Values per page of /categories and /places
+FACET_PAGE_SIZE = 20
+# Facet: (list header, search description prefix)
+FACETS = {
+    "category": ("Категории (число песен):", "в категории"),
+    "place": ("Места записи (число песен):", "по месту записи")
+}
+
+async def get_facet_view(facet: str, offset: int = 0):
+    """Keyboard of facet values with song counts (None if there are none), cached until the archive changes"""
+    if render_cache.sync_due():
+        await run_db(render_cache.sync)
+    key = ("facets", facet, offset)
+    reply_markup = render_cache.get(key)
+    if reply_markup is None:
+        generation = render_cache.generation
+        values = await run_db(get_facet_counts, facet, FACET_PAGE_SIZE + 1, offset)
+        keyboard = [
+            [InlineKeyboardButton(f"{row.value} ({row.count})", callback_data=f"facet_{row.id}")]
+            for row in values[:FACET_PAGE_SIZE]
+        ]
+        navigation = []
+        if offset > 0:
+            navigation.append(InlineKeyboardButton(
+                "◀️ Назад", callback_data=f"facets_{facet}_{max(offset - FACET_PAGE_SIZE, 0)}"
+            ))
+        if len(values) > FACET_PAGE_SIZE:
+            navigation.append(InlineKeyboardButton(
+                "Далее ▶️", callback_data=f"facets_{facet}_{offset + FACET_PAGE_SIZE}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+        # False marks an empty list in the cache, where None means a miss
+        reply_markup = InlineKeyboardMarkup(keyboard) if values else False
+        render_cache.put(key, reply_markup, generation)
+    return reply_markup or None
+
+async def facet_list_handler(update: Update, context: CallbackContext, facet: str) -> None:
+    """List categories or places with song counts as buttons"""
+    try:
+        reply_markup = await get_facet_view(facet)
+        if reply_markup:
+            await update.message.reply_text(FACETS[facet][0], reply_markup=reply_markup)
+        else:
+            await update.message.reply_text("В архиве пока нет песен.")
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка {facet}: {e}")
+        await update.message.reply_text("Произошла ошибка. Попробуйте позже.")
+
+async def categories_handler(update: Update, context: CallbackContext) -> None:
+    """List categories with song counts"""
+    await facet_list_handler(update, context, "category")
+
+async def places_handler(update: Update, context: CallbackContext) -> None:
+    """List places with song counts"""
+    await facet_list_handler(update, context, "place")
+
+async def facet_callback(query, context: CallbackContext) -> None:
+    """Show another page of a facet list, or the songs of a tapped category or place"""
+    try:
+        if query.data.startswith('facets_'):
+            facet, offset = query.data[len('facets_'):].rsplit('_', 1)
+            reply_markup = await get_facet_view(facet, int(offset))
+            if reply_markup:
+                await query.edit_message_text(FACETS[facet][0], reply_markup=reply_markup)
+            else:
+                await query.edit_message_text("Больше значений нет.")
+            return
+
+        row = await run_db(get_facet_value, int(query.data[len('facet_'):]))
+        if row is None:
+            await query.edit_message_text("Список устарел, откройте его заново.")
+            return
+        description = f"{FACETS[row.facet][1]} '{row.value}'"
+        page, reply_markup = await get_page_view(row.facet, row.value)
+        if page.songs:
+            context.user_data['search'] = {'kind': row.facet, 'query': row.value, 'description': description}
+            await query.edit_message_text(f"Найдены песни {description}:", reply_markup=reply_markup)
+        else:
+            await query.edit_message_text(f"По запросу {description} ничего не найдено.")
+    except Exception as e:
+        logger.error(f"Ошибка при просмотре категорий и мест: {e}")
+        await query.edit_message_text("Произошла ошибка. Попробуйте позже.")
+
+def build_page_keyboard(page, kind):
+    """Build inline keyboard for one page of songs with navigation buttons"""
+    keyboard = []
+    for song in page.songs:
+        button_text = f"{song.title}"
+        if song.place:
+            button_text += f" ({song.place})"
+
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"song_{song.id}")])
+
+    navigation = []
+    if page.prev_cursor:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page_{kind}_{page.prev_cursor}"))
+    if page.next_cursor:
+        navigation.append(InlineKeyboardButton("Далее ▶️", callback_data=f"page_{kind}_{page.next_cursor}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def get_page(kind: str, query: str = None, cursor: str = None):
+    """One page of results from the in-memory index when it covers the kind, otherwise from the database"""
+    if search_index:
+        if search_index.sync_due():
+            await run_db(search_index.sync)
+        if search_index.supports(kind, cursor):
+            return search_index.get_page(kind, query, cursor)
+    return await run_db(search_cache.get_page, kind, query, cursor)
+
+# Views browsed by everyone with the same few queries: their keyboards are cached
+BROWSE_KINDS = ("all", "category", "place")
+
+async def get_page_view(kind: str, query: str = None, cursor: str = None):
+    """Page of results and its keyboard; browse views come prebuilt from the render cache"""
+    if kind not in BROWSE_KINDS:
+        page = await get_page(kind, query, cursor)
+        return page, build_page_keyboard(page, kind)
+
+    if render_cache.sync_due():
+        await run_db(render_cache.sync)
+    key = (kind, normalize_query(query), cursor)
+    view = render_cache.get(key)
+    if view is None:
+        generation = render_cache.generation
+        page = await get_page(kind, query, cursor)
+        view = (page, build_page_keyboard(page, kind))
+        render_cache.put(key, view, generation)
+    return view
+
 async def list_songs_handler(update: Update, context: CallbackContext) -> None:
-    """List all songs with inline buttons"""
-    db = next(get_db())
+    """List all songs with inline buttons, one page at a time"""
     try:
-        results = get_all_songs(db)
-        if results:
-            keyboard = []
-            for song in results:
-                category, place = parse_region(song.region)
-                button_text = f"{song.title}"
-                if place:
-                    button_text += f" ({place})"
-                
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"song_{song.id}")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                "Все песни в архиве:",
-                reply_markup=reply_markup
-            )
+        page, reply_markup = await get_page_view("all")
+        if page.songs:
+            await update.message.reply_text("Все песни в архиве:", reply_markup=reply_markup)
         else:
             await update.message.reply_text("В архиве пока нет песен.")
     except Exception as e:
         logger.error(f"Ошибка при получении списка песен: {e}")
         await update.message.reply_text("Произошла ошибка. Попробуйте позже.")
-    finally:
-        db.close()
 
 async def handle_message(update: Update, context: CallbackContext) -> None:
     """Handle all non-command messages based on current state"""
@@ -180,55 +328,55 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
             context.user_data['text'] = user_input
             await save_song(update, context)
 
+        elif context.user_data['awaiting_input'] == 'confirm_duplicate':
+            await update.message.reply_text('Выберите "Все равно добавить" или "Отменить" под сообщением выше.')
+
         elif context.user_data['awaiting_input'] == 'search_title':
-            db = next(get_db())
-            results = search_by_title(db, user_input)
-            await display_results(update, results, f"по названию '{user_input}'", context)
+            page = await get_page("title", user_input)
+            if page.songs:
+                await display_results(update, page, "title", user_input, f"по названию '{user_input}'", context)
+            else:
+                page = await get_page("fuzzy", user_input)
+                await display_results(update, page, "fuzzy", user_input, f"с названием, похожим на '{user_input}'", context)
 
         elif context.user_data['awaiting_input'] == 'search_text':
-            db = next(get_db())
-            results = search_by_text(db, user_input)
-            await display_results(update, results, f"по тексту '{user_input}'", context)
+            page = await get_page("text", user_input)
+            await display_results(update, page, "text", user_input, f"по тексту '{user_input}'", context)
 
         elif context.user_data['awaiting_input'] == 'search_place':
-            db = next(get_db())
-            results = [song for song in get_all_songs(db) 
-                      if '|' in song.region and user_input.lower() in song.region.lower().split('|')[1]]
-            await display_results(update, results, f"по месту записи '{user_input}'", context)
+            page, reply_markup = await get_page_view("place", user_input)
+            await display_results(update, page, "place", user_input, f"по месту записи '{user_input}'", context,
+                                  reply_markup)
 
         elif context.user_data['awaiting_input'] == 'search_category':
-            db = next(get_db())
-            results = get_songs_by_region(db, user_input)
-            await display_results(update, results, f"в категории '{user_input}'", context)
+            page, reply_markup = await get_page_view("category", user_input)
+            await display_results(update, page, "category", user_input, f"в категории '{user_input}'", context,
+                                  reply_markup)
 
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         await update.message.reply_text("Произошла ошибка. Попробуйте позже.")
         context.user_data.clear()
 
-async def display_results(update: Update, results, search_description, context: CallbackContext):
-    """Display search results with inline buttons"""
-    if results:
-        keyboard = []
-        for song in results:
-            category, place = parse_region(song.region)
-            button_text = f"{song.title}"
-            if place:
-                button_text += f" ({place})"
-            
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"song_{song.id}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+async def display_results(update: Update, page, kind, search_query, search_description, context: CallbackContext,
+                          reply_markup=None):
+    """Display the first page of search results with inline buttons (prebuilt ones if given)"""
+    if page.songs:
+        context.user_data['search'] = {
+            'kind': kind,
+            'query': search_query,
+            'description': search_description
+        }
         await update.message.reply_text(
             f"Найдены песни {search_description}:",
-            reply_markup=reply_markup
+            reply_markup=reply_markup or build_page_keyboard(page, kind)
         )
     else:
         await update.message.reply_text(f"По запросу {search_description} ничего не найдено.")
 
-async def save_song(update: Update, context: CallbackContext) -> None:
-    """Save song to database"""
-    db = next(get_db())
+async def save_song(update: Update, context: CallbackContext, check_duplicates: bool = True) -> None:
+    """Save song to database, asking for confirmation first if similar songs are already archived"""
+    message = update.effective_message
     try:
         title = context.user_data['title']
         region = context.user_data['region']
@@ -239,8 +387,26 @@ async def save_song(update: Update, context: CallbackContext) -> None:
             full_region = region
         else:
             full_region = f"{region}|{place}"
+
+        if check_duplicates:
+            similar = await run_db(find_similar_songs, title, text)
+            if similar:
+                lines = []
+                for song, score in similar:
+                    where = f", {song.place}" if song.place else ""
+                    lines.append(f"• {song.title} ({song.category}{where}) - сходство {score:.0%}")
+                keyboard = [
+                    [InlineKeyboardButton("Все равно добавить", callback_data="dup_add")],
+                    [InlineKeyboardButton("Отменить", callback_data="dup_cancel")]
+                ]
+                context.user_data['awaiting_input'] = 'confirm_duplicate'
+                await message.reply_text(
+                    "Похожие песни уже есть в архиве:\n\n" + "\n".join(lines) + "\n\nДобавить песню все равно?",
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+                return
         
-        song = add_song(db, title=title, region=full_region, text=text)
+        song = await run_db(add_song, title=title, region=full_region, text=text)
         
         response_message = (
             f'Песня добавлена!\n\n'
@@ -252,49 +418,165 @@ async def save_song(update: Update, context: CallbackContext) -> None:
         
         response_message += '\nИспользуйте /help для списка команд'
         
-        await update.message.reply_text(response_message)
+        await message.reply_text(response_message)
         context.user_data.clear()
     except Exception as e:
         logger.error(f"Ошибка при сохранении песни: {e}")
-        await update.message.reply_text("Произошла ошибка. Попробуйте позже.")
-    finally:
-        db.close()
+        await message.reply_text("Произошла ошибка. Попробуйте позже.")
+
+async def duplicate_callback(update: Update, context: CallbackContext) -> None:
+    """Add the song despite similar ones, or cancel adding it"""
+    query = update.callback_query
+    if context.user_data.get('awaiting_input') != 'confirm_duplicate':
+        await query.edit_message_text("Добавление песни уже завершено.")
+        return
+    if query.data == 'dup_cancel':
+        context.user_data.clear()
+        await query.edit_message_text("Песня не добавлена.")
+        return
+    await query.edit_message_reply_markup(None)
+    await save_song(update, context, check_duplicates=False)
+
+def render_song_details(song):
+    """Render the song card shown after tapping a song button, split into pages for long lyrics"""
+    header = (
+        f"Детали песни\n\n"
+        f"Название: {song.title}\n"
+        f"Категория: {song.category}\n"
+    )
+    if song.place:
+        header += f"Место записи: {song.place}\n\n"
+
+    header += "Текст:\n"
+    return render_song(song.id, header, song.text, "\n\nИспользуйте /help для списка команд")
+
+async def get_song_details(song_id):
+    """Return the rendered song card from cache or database, None if there is no such song"""
+    if song_details_cache.sync_due():
+        await run_db(song_details_cache.sync)
+
+    rendered = song_details_cache.get(song_id)
+    if rendered is None:
+        generation = song_details_cache.generation
+        song = await run_db(get_song_by_id, song_id)
+        if not song:
+            return None
+        rendered = render_song_details(song)
+        song_details_cache.put(song_id, rendered, generation)
+    return rendered
+
+async def get_songs_details(song_ids):
+    """Rendered song cards by id, loading all cache misses with one query"""
+    if song_details_cache.sync_due():
+        await run_db(song_details_cache.sync)
+
+    cards = {}
+    missing = []
+    for song_id in song_ids:
+        rendered = song_details_cache.get(song_id)
+        if rendered is None:
+            missing.append(song_id)
+        else:
+            cards[song_id] = rendered
+    generation = song_details_cache.generation
+    for song in await run_db(get_songs_by_ids, missing):
+        cards[song.id] = render_song_details(song)
+        song_details_cache.put(song.id, cards[song.id], generation)
+    return cards
+
+async def search_inline(query: str, offset: str):
+    """
+    One page of inline results and the next offset: titles first, lyrics if
+    no title matches, the whole archive for an empty query. The offset is
+    "<kind>:<cursor>" so that the next page continues the same search.
+    """
+    if offset:
+        kind, cursor = offset.split(":", 1)
+    else:
+        kind, cursor = ("title" if query else "all"), None
+    page = await get_page(kind, query or None, cursor)
+    if not page.songs and kind == "title" and not cursor:
+        kind = "text"
+        page = await get_page(kind, query)
+
+    cards = await get_songs_details([song.id for song in page.songs])
+    results = []
+    for song in page.songs:
+        card = cards.get(song.id)
+        if card is None:
+            continue
+        # Inline messages cannot carry a file, long lyrics are paged with buttons
+        results.append(InlineQueryResultArticle(
+            id=str(song.id),
+            title=song.title,
+            description=", ".join(part for part in (song.category, song.place) if part),
+            input_message_content=InputTextMessageContent(card.pages[0]),
+            reply_markup=page_markup(card, song.id)
+        ))
+    return results, (f"{kind}:{page.next_cursor}" if page.next_cursor else "")
+
+# Inline mode: "@bot колядка" in any chat
+inline_search = InlineSearch(search_inline)
+
+async def page_callback(query, context: CallbackContext) -> None:
+    """Show another page of /all or of the last search"""
+    kind, cursor = query.data[len('page_'):].rsplit('_', 1)
+    if kind == 'all':
+        search_query, header = None, "Все песни в архиве:"
+    else:
+        search = context.user_data.get('search')
+        if not search or search['kind'] != kind:
+            await query.edit_message_text("Результаты поиска устарели, повторите поиск.")
+            return
+        search_query, header = search['query'], f"Найдены песни {search['description']}:"
+
+    try:
+        page, reply_markup = await get_page_view(kind, search_query, cursor)
+        if page.songs:
+            await query.edit_message_text(header, reply_markup=reply_markup)
+        else:
+            await query.edit_message_text("Больше песен нет.")
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы: {e}")
+        await query.edit_message_text("Произошла ошибка. Попробуйте позже.")
 
 async def button_callback(update: Update, context: CallbackContext) -> None:
-    """Handle inline button callbacks for song details"""
+    """Handle inline button callbacks for song details and pagination"""
     query = update.callback_query
     await query.answer()
-    
-    if query.data.startswith('song_'):
-        song_id = int(query.data.split("_")[1])
-        db = next(get_db())
+
+    if query.data.startswith('page_'):
+        await page_callback(query, context)
+
+    elif query.data.startswith('facet'):
+        await facet_callback(query, context)
+
+    elif query.data.startswith('dup_'):
+        await duplicate_callback(update, context)
+
+    elif query.data.startswith(('song_', 'lyrics_')):
+        parts = query.data.split("_")
+        song_id = int(parts[1])
+        page = int(parts[2]) if len(parts) > 2 else 0
         try:
-            song = get_song_by_id(db, song_id)
-            if song:
-                category, place = parse_region(song.region)
-                response_text = (
-                    f"Детали песни\n\n"
-                    f"Название: {song.title}\n"
-                    f"Категория: {category}\n"
-                )
-                if place:
-                    response_text += f"Место записи: {place}\n\n"
-                
-                response_text += f"Текст:\n{song.text}\n\n"
-                response_text += "Используйте /help для списка команд"
-                
-                await query.edit_message_text(response_text)
+            rendered = await get_song_details(song_id)
+            if rendered:
+                await send_rendered(query, rendered, song_id, page)
             else:
                 await query.edit_message_text("Песня не найдена")
         except Exception as e:
             logger.error(f"Ошибка при получении текста песни: {e}")
             await query.edit_message_text("Произошла ошибка. Попробуйте позже.")
-        finally:
-            db.close()
 
-def main():
-    """Start the bot with all handlers"""
-    application = Application.builder().token(API_TOKEN).build()
+def build_application(builder=None):
+    """Create the Application with all handlers; builder allows custom updater or request settings"""
+    if builder is None:
+        builder = Application.builder()
+    builder = builder.token(API_TOKEN).concurrent_updates(PerUserUpdateProcessor())
+    persistence = build_persistence("bot")
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("add", add_song_handler))
@@ -302,11 +584,35 @@ def main():
     application.add_handler(CommandHandler("search_text", search_text_handler))
     application.add_handler(CommandHandler("search_place", search_place_handler))
     application.add_handler(CommandHandler("search_category", search_category_handler))
+    application.add_handler(CommandHandler("categories", categories_handler))
+    application.add_handler(CommandHandler("places", places_handler))
     application.add_handler(CommandHandler("all", list_songs_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_callback))
-    application.post_init = setup_commands
+    application.add_handler(InlineQueryHandler(inline_search.handle))
+    application.post_init = post_init
+
+    instrument_application(application, "bot")
+    REGISTRY.register_collector("bot_song_cache", "Кэш карточек песен", song_details_cache.stats)
+    REGISTRY.register_collector("bot_search_cache", "Кэш результатов поиска", search_cache.stats)
+    REGISTRY.register_collector("bot_render_cache", "Кэш клавиатур страниц просмотра", render_cache.stats)
+    if search_index:
+        REGISTRY.register_collector("bot_search_index", "Поисковый индекс в памяти", search_index.stats)
+    REGISTRY.register_collector("bot_inline", "Inline-запросы", inline_search.stats)
+    REGISTRY.register_collector("bot_updates", "Очереди обновлений", application.update_processor.stats)
+    if application.persistence:
+        REGISTRY.register_collector("bot_user_state", "Состояние диалогов", application.persistence.stats)
+    return application
+
+def main():
+    """Start the bot with all handlers"""
+    if BOT_MODE == "webhook":
+        import webhook
+        webhook.main()
+        return
+
+    application = build_application()
     application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
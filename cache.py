@@ -0,0 +1,261 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from database import (
+    add_song_listener, get_changes_since, get_archive_version,
+    get_songs_page, Page, PAGE_SIZE
+)
+
+# Настройки кэша карточек песен
+SONG_CACHE_SIZE = int(os.getenv("SONG_CACHE_SIZE", "1000"))
+SONG_CACHE_TTL = float(os.getenv("SONG_CACHE_TTL", "3600"))
+# Сколько страниц результатов поиска хранить и сколько секунд (страховка на случай пропущенной инвалидации)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# Сколько готовых клавиатур страниц просмотра хранить
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "500"))
+# Как часто (в секундах) проверять журнал изменений, записанный другими процессами
+CACHE_POLL_INTERVAL = float(os.getenv("CACHE_POLL_INTERVAL", "1"))
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по времени жизни записей и счетчиками попаданий"""
+
+    def __init__(self, maxsize: int = 1000, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+class DatabaseChangeFeed:
+    """Общий для всех процессов источник инвалидаций - таблица archive_changes"""
+
+    def version(self, db) -> int:
+        return get_archive_version(db)
+
+    def changes_since(self, db, version: int):
+        return get_changes_since(db, version)
+
+class LocalChangeFeed:
+    """
+    Источник инвалидаций внутри одного процесса (замена общей таблицы для тестов).
+    Получает изменения через add_song_listener.
+    """
+
+    def __init__(self):
+        self._changes = []
+        self._lock = threading.Lock()
+        add_song_listener(self._on_song_change)
+
+    def _on_song_change(self, event: str, song):
+        with self._lock:
+            self._changes.append(None if event == "bulk" else song.id)
+
+    def version(self, db=None) -> int:
+        return len(self._changes)
+
+    def changes_since(self, db, version: int):
+        with self._lock:
+            changes = self._changes[version:]
+            new_version = len(self._changes)
+        if None in changes:
+            return new_version, None
+        return new_version, set(changes)
+
+class SongCache(LRUCache):
+    """
+    Кэш данных по id песни. Записи сбрасываются сразу после add_song, update_song
+    и delete_song в этом процессе и не позже чем через poll_interval секунд после
+    изменений из других процессов (по журналу feed). Данные, прочитанные до
+    сброса, в кэш не попадают: put сверяет поколение кэша на момент начала чтения.
+    """
+
+    def __init__(self, maxsize: int = SONG_CACHE_SIZE, ttl: float = SONG_CACHE_TTL,
+                 feed=None, poll_interval: float = CACHE_POLL_INTERVAL):
+        super().__init__(maxsize, ttl)
+        self.feed = feed if feed is not None else DatabaseChangeFeed()
+        self.poll_interval = poll_interval
+        self.version = None
+        self.generation = 0
+        self._last_poll = 0.0
+        add_song_listener(self._on_song_change)
+
+    def invalidate(self, song_ids=None):
+        """Сбрасывает записи song_ids (все при None) и начинает новое поколение"""
+        with self._lock:
+            self.generation += 1
+            if song_ids is None:
+                self._data.clear()
+            else:
+                for song_id in song_ids:
+                    self._data.pop(song_id, None)
+
+    def _on_song_change(self, event: str, song):
+        self.invalidate(None if event == "bulk" else [song.id])
+
+    def put(self, key, value, generation: int):
+        """Сохраняет value, если с начала его чтения (generation) кэш не сбрасывался"""
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def sync_due(self) -> bool:
+        return time.monotonic() - self._last_poll >= self.poll_interval
+
+    def sync(self, db):
+        """Применяет изменения из журнала, сделанные после последней проверки"""
+        self._last_poll = time.monotonic()
+        if self.version is None:
+            self.version = self.feed.version(db)
+            return
+        self.version, song_ids = self.feed.changes_since(db, self.version)
+        if song_ids is None or song_ids:
+            self.invalidate(song_ids)
+
+class RenderCache(LRUCache):
+    """
+    Готовые страницы просмотра (/all, категории, места) вместе с клавиатурами
+    по ключу (тип, запрос, курсор). Пока архив не меняется, страница отдается
+    без обращения к базе и без сборки кнопок.
+
+    Любая запись в архив сбрасывает кэш целиком: в этом процессе сразу через
+    add_song_listener, из других процессов - не позже чем через poll_interval
+    секунд по журналу feed. Страница, прочитанная до сброса, в кэш не
+    попадает: put сверяет поколение кэша на момент начала чтения.
+    """
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE, feed=None, poll_interval: float = CACHE_POLL_INTERVAL):
+        super().__init__(maxsize)
+        self.feed = feed if feed is not None else DatabaseChangeFeed()
+        self.poll_interval = poll_interval
+        self.version = None
+        self.generation = 0
+        self.invalidations = 0
+        self._last_poll = 0.0
+        add_song_listener(self._on_song_change)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._data.clear()
+
+    def _on_song_change(self, event: str, song):
+        self.invalidate()
+
+    def sync_due(self) -> bool:
+        return time.monotonic() - self._last_poll >= self.poll_interval
+
+    def sync(self, db):
+        """Сбрасывает кэш, если архив изменился после последней проверки"""
+        self._last_poll = time.monotonic()
+        version = self.feed.version(db)
+        if self.version is not None and version != self.version:
+            self.invalidate()
+        self.version = version
+
+    def put(self, key, value, generation: int):
+        """Сохраняет value, если с начала его чтения (generation) кэш не сбрасывался"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (value, None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        return {**super().stats(), "invalidations": self.invalidations}
+
+# Краткие данные песни для кнопок результатов поиска (без текста)
+SongSummary = namedtuple("SongSummary", ["id", "title", "category", "place"])
+
+def normalize_query(query: str):
+    """
+    Нормализует поисковый запрос: убирает лишние пробелы и регистр (поиск
+    во всех режимах регистр не учитывает, поэтому "Калинка" и "калинка" -
+    одна запись кэша)
+    """
+    if query is None:
+        return None
+    return " ".join(query.split()).casefold()
+
+class SearchCache(LRUCache):
+    """
+    Кэш страниц результатов поиска по ключу (тип поиска, запрос, курсор).
+
+    Каждая запись помечена версией архива, при которой она получена. Версия
+    берется из счетчика версий при каждом обращении, поэтому после любой
+    записи в архив (в любом процессе) старые результаты не возвращаются.
+    Записи дополнительно живут не дольше ttl секунд.
+    """
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE, feed=None, ttl: float = SEARCH_CACHE_TTL):
+        super().__init__(maxsize, ttl)
+        self.feed = feed if feed is not None else DatabaseChangeFeed()
+
+    def get_page(self, db, kind: str, query: str = None, cursor: str = None, limit: int = PAGE_SIZE) -> Page:
+        query = normalize_query(query)
+        key = (kind, query, cursor, limit)
+        version = self.feed.version(db)
+
+        cached = self.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        page = get_songs_page(db, kind, query, cursor, limit)
+        page = page._replace(songs=[
+            SongSummary(song.id, song.title, song.category, song.place)
+            for song in page.songs
+        ])
+        self.set(key, (version, page))
+        return page
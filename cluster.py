@@ -0,0 +1,406 @@
+"""
+Многопроцессный режим: один входной процесс (webhook или поллер) и N рабочих
+процессов с Application бота.
+
+Входной процесс ничего не обрабатывает сам: он раскладывает обновления по
+очередям multiprocessing, выбирая воркер по id пользователя, поэтому все
+обновления одного пользователя (и его диалоги /add, /edit) попадают в один
+процесс и обрабатываются по порядку. Кэши воркеров сбрасываются по общему
+журналу archive_changes, метрики воркеров собираются во входном процессе.
+
+    python cluster.py run --bot bot --workers 4 --mode polling
+    python cluster.py run --bot bot --workers 4 --mode webhook
+    python cluster.py bench --workers 1 2 4
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from metrics import REGISTRY, start_metrics_server
+
+logging.basicConfig(
+    format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Число рабочих процессов
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", str(os.cpu_count() or 1)))
+# Сколько обновлений может ждать в очереди одного воркера
+CLUSTER_QUEUE_SIZE = int(os.getenv("CLUSTER_QUEUE_SIZE", "1000"))
+# Как часто (в секундах) воркеры отправляют метрики во входной процесс
+CLUSTER_METRICS_INTERVAL = float(os.getenv("CLUSTER_METRICS_INTERVAL", "5"))
+# Порт /metrics входного процесса в режиме polling
+CLUSTER_METRICS_PORT = int(os.getenv("CLUSTER_METRICS_PORT", "9100"))
+
+routed_updates = REGISTRY.counter(
+    "cluster_updates_routed_total", "Обновления, переданные воркерам", ["worker"]
+)
+
+def routing_key(data: dict) -> int:
+    """id пользователя (или чата) обновления; обновления без них распределяются по update_id"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+def _bot_token(bot_name: str) -> str:
+    import env
+    return env.API_TOKEN if bot_name == "bot" else env.ADMIN_API_TOKEN
+
+async def _worker_main(bot_name: str, index: int, updates, metrics, api_latency, metrics_interval: float):
+    from telegram import Update
+    from telegram.ext import Application
+
+    module = importlib.import_module(bot_name)
+    builder = Application.builder().updater(None)
+    if api_latency is not None:
+        from loadtest import FakeBotAPI
+        builder = builder.request(FakeBotAPI(api_latency))
+    application = module.build_application(builder)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    async def report_metrics():
+        while not stop.is_set():
+            metrics.put((str(index), REGISTRY.snapshot()))
+            try:
+                await asyncio.wait_for(stop.wait(), metrics_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    reporter = asyncio.create_task(report_metrics())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        stop.set()
+        await reporter
+        metrics.put((str(index), REGISTRY.snapshot()))
+
+def worker_environment(env: dict = None) -> dict:
+    """Переменные окружения воркера: настройки WorkerPool поверх обязательных для воркера"""
+    return {
+        # Свой эндпоинт /metrics воркеру не нужен: метрики отдает входной процесс
+        "BOT_MODE": "webhook",
+        # Миграции уже выполнены входным процессом (WorkerPool.start); параллельные
+        # ALTER TABLE и пересчет facet_counts в нескольких воркерах мешали бы друг другу
+        "INIT_DB": "0",
+        **(env or {})
+    }
+
+def run_worker(bot_name: str, index: int, updates, metrics, api_latency=None,
+               metrics_interval: float = CLUSTER_METRICS_INTERVAL, env: dict = None):
+    """
+    Точка входа рабочего процесса: обрабатывает обновления из своей очереди до None.
+    env меняет окружение только этого (дочернего) процесса, до импорта модуля бота.
+    """
+    os.environ.update(worker_environment(env))
+    asyncio.run(_worker_main(bot_name, index, updates, metrics, api_latency, metrics_interval))
+
+class WorkerPool:
+    """
+    Рабочие процессы, их очереди обновлений и метрики. env - переменные
+    окружения воркеров (окружение входного процесса не меняется).
+    """
+
+    def __init__(self, bot_name: str, workers: int = CLUSTER_WORKERS, queue_size: int = CLUSTER_QUEUE_SIZE,
+                 api_latency=None, metrics_interval: float = CLUSTER_METRICS_INTERVAL, env: dict = None):
+        self.bot_name = bot_name
+        self.metrics_interval = metrics_interval
+        self.env = env
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.metrics = self.context.Queue()
+        self.api_latency = api_latency
+        self.processes = []
+        self.snapshots = {}
+        self._lock = threading.Lock()
+        self._collector = None
+
+    def start(self):
+        from database import init_db
+
+        init_db()
+        for index, updates in enumerate(self.queues):
+            process = self.context.Process(
+                target=run_worker,
+                args=(self.bot_name, index, updates, self.metrics, self.api_latency, self.metrics_interval, self.env),
+                name=f"{self.bot_name}-worker-{index}"
+            )
+            process.start()
+            self.processes.append(process)
+        self._collector = threading.Thread(target=self._collect_metrics, daemon=True)
+        self._collector.start()
+        logger.info(f"Запущено {len(self.processes)} воркеров {self.bot_name}")
+
+    def _collect_metrics(self):
+        while True:
+            item = self.metrics.get()
+            if item is None:
+                return
+            worker, snapshot = item
+            with self._lock:
+                self.snapshots[worker] = snapshot
+
+    def route(self, data: dict) -> int:
+        """Кладет обновление в очередь воркера пользователя (блокирует, если очередь заполнена)"""
+        index = routing_key(data) % len(self.queues)
+        self.queues[index].put(data)
+        routed_updates.inc(str(index))
+        return index
+
+    def qsize(self) -> int:
+        try:
+            return max(updates.qsize() for updates in self.queues)
+        except NotImplementedError:
+            return 0
+
+    def stop(self, timeout: float = 30):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Воркер {process.name} не остановился, завершаем")
+                process.terminate()
+        self.metrics.put(None)
+        self._collector.join(5)
+
+    def render_metrics(self) -> str:
+        """Метрики всех воркеров и входного процесса"""
+        with self._lock:
+            snapshots = dict(self.snapshots)
+        snapshots["ingress"] = REGISTRY.snapshot()
+        return REGISTRY.render(snapshots)
+
+    def per_worker(self, collector: str, stat: str) -> dict:
+        """gauge collector{stat} каждого воркера по последним снимкам"""
+        with self._lock:
+            return {
+                worker: snapshot["collectors"].get(collector, ("", {}))[1].get(stat, 0)
+                for worker, snapshot in self.snapshots.items()
+            }
+
+    def total(self, collector: str, stat: str) -> float:
+        """Сумма gauge collector{stat} по последним снимкам воркеров"""
+        return sum(self.per_worker(collector, stat).values())
+
+class UpdateRouter:
+    """
+    Стоит на месте Application во входном процессе: у него есть bot и
+    update_queue, но обновления уходят воркерам, а не обработчикам.
+    """
+
+    def __init__(self, bot, pool: WorkerPool):
+        self.bot = bot
+        self.pool = pool
+        self.post_init = None
+        self.post_shutdown = None
+        self.update_queue = self
+
+    async def initialize(self):
+        await self.bot.initialize()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def shutdown(self):
+        await self.bot.shutdown()
+
+    def qsize(self) -> int:
+        return self.pool.qsize()
+
+    async def put(self, update):
+        await asyncio.get_running_loop().run_in_executor(None, self.pool.route, update.to_dict())
+
+async def poll(router: UpdateRouter):
+    """Единственный поллер getUpdates: раздает обновления воркерам"""
+    from telegram import Update
+    from telegram.error import NetworkError
+
+    await router.initialize()
+    await router.bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await router.bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except NetworkError as e:
+                logger.warning(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await router.put(update)
+                offset = update.update_id + 1
+    finally:
+        await router.shutdown()
+
+def run(bot_name: str, workers: int, mode: str):
+    from telegram import Bot
+
+    pool = WorkerPool(bot_name, workers)
+    pool.start()
+    router = UpdateRouter(Bot(_bot_token(bot_name)), pool)
+    try:
+        if mode == "webhook":
+            import uvicorn
+            import webhook
+
+            class ClusterWebhookServer(webhook.WebhookServer):
+                def render_registry(self) -> str:
+                    return pool.render_metrics()
+
+            uvicorn.run(
+                ClusterWebhookServer({bot_name: router}),
+                host=webhook.WEBHOOK_HOST,
+                port=webhook.WEBHOOK_PORT,
+                limit_concurrency=webhook.WEBHOOK_MAX_CONCURRENCY * 2,
+                lifespan="on"
+            )
+        else:
+            async def main():
+                await start_metrics_server(CLUSTER_METRICS_PORT, render=pool.render_metrics)
+                await poll(router)
+
+            asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+
+def bench(worker_counts, users: int, updates_per_user: int, seed_size: int, api_latency: float,
+          database_url: str, seed: int = 0, timeout: float = 600):
+    """
+    Пропускная способность на поисковой нагрузке при разном числе воркеров:
+    каждый пользователь отправляет /search_text и затем запросы по случайным
+    фразам из синтетического архива. В результатах per_worker - сколько
+    обновлений обработал каждый воркер.
+
+    database_url - адрес тестовой базы, которую можно заполнить синтетическим
+    архивом; процесс должен быть подключен к ней же (DATABASE_URL задается до
+    импорта database, см. __main__), иначе засеяна была бы другая база.
+    """
+    from benchmark import generate_corpus
+    from database import DATABASE_URL
+    from loadtest import UpdateFactory, seed_database
+
+    if DATABASE_URL != database_url:
+        raise ValueError("Процесс подключен не к базе database_url: задайте DATABASE_URL до импорта database")
+    # Состояние диалогов в памяти: воркеры не делят между собой файл SQLite на запись
+    env = {"DATABASE_URL": database_url, "USER_STATE_STORE": "memory"}
+    seed_database(seed_size, seed)
+
+    rng = random.Random(seed)
+    corpus = generate_corpus(min(seed_size, 1000), seed)
+    factory = UpdateFactory()
+    traffic = [factory.message(200_000 + user, "/search_text") for user in range(users)]
+    for _ in range(updates_per_user):
+        for user in range(users):
+            words = rng.choice(corpus)["text"].split()
+            start = rng.randrange(max(1, len(words) - 2))
+            phrase = " ".join(word.strip(",.!") for word in words[start:start + 2])
+            traffic.append(factory.message(200_000 + user, phrase))
+
+    cores = os.cpu_count() or 1
+    results = []
+    for workers in worker_counts:
+        pool = WorkerPool("bot", workers, api_latency=api_latency, metrics_interval=0.2, env=env)
+        pool.start()
+        deadline = time.monotonic() + timeout
+        # Ждем, пока все воркеры запустятся и пришлют первые метрики
+        while len(pool.snapshots) < workers:
+            if time.monotonic() > deadline:
+                pool.stop()
+                raise RuntimeError(f"Воркеры не запустились за {timeout} с")
+            time.sleep(0.1)
+        started = time.perf_counter()
+        for data in traffic:
+            pool.route(data)
+        while pool.total("bot_updates", "processed") < len(traffic):
+            if time.monotonic() > deadline:
+                pool.stop()
+                raise RuntimeError(f"Обновления не обработаны за {timeout} с")
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        processed = pool.per_worker("bot_updates", "processed")
+        pool.stop()
+        results.append({"workers": workers, "updates": len(traffic), "seconds": round(elapsed, 2),
+                        "throughput_per_s": round(len(traffic) / elapsed, 1),
+                        "per_worker": [processed[worker] for worker in sorted(processed, key=int)]})
+        print(f"{workers} воркеров: {len(traffic)} обновлений за {elapsed:.2f} с, {len(traffic) / elapsed:.1f} обн./с")
+
+    # Эффективность - доля от линейного роста. Входному процессу нужно свое ядро,
+    # поэтому на машине с cores ядрами рост возможен только до cores - 1 воркеров
+    base = results[0]["throughput_per_s"] / results[0]["workers"]
+    for result in results:
+        result["efficiency"] = round(result["throughput_per_s"] / (base * result["workers"]), 2)
+        note = "" if result["workers"] < cores else f" (ядер {cores}: воркерам не хватает ядер)"
+        print(f"{result['workers']} воркеров: эффективность {result['efficiency']:.0%}{note}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Многопроцессный режим бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="запустить входной процесс и воркеры")
+    run_parser.add_argument("--bot", choices=("bot", "admin"), default="bot")
+    run_parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS)
+    run_parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+
+    bench_parser = commands.add_parser("bench", help="замерить масштабирование на поисковой нагрузке")
+    bench_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    bench_parser.add_argument("--users", type=int, default=200)
+    bench_parser.add_argument("--updates-per-user", type=int, default=20)
+    bench_parser.add_argument("--seed-size", type=int, default=5000)
+    bench_parser.add_argument("--api-latency", type=float, default=0.0)
+    bench_parser.add_argument("--db", default="sqlite",
+                              help="'sqlite' (временный файл) или URL тестовой базы, которую можно заполнить")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.bot, args.workers, args.mode)
+    else:
+        # Уже настроенная DATABASE_URL не используется, чтобы не засеять рабочую базу.
+        # Переменная задается здесь, в процессе бенчмарка, до импорта database
+        tmp = None
+        database_url = args.db
+        if args.db == "sqlite":
+            tmp = tempfile.TemporaryDirectory()
+            database_url = f"sqlite:///{os.path.join(tmp.name, 'cluster.db')}"
+        os.environ["DATABASE_URL"] = database_url
+        try:
+            bench(args.workers, args.users, args.updates_per_user, args.seed_size, args.api_latency,
+                  database_url=database_url)
+        finally:
+            if tmp is not None:
+                tmp.cleanup()
@@ -1,55 +1,141 @@
+import argparse
+import gzip
+import io
 import json
 from datetime import datetime
-from typing import List, Dict
-from database import get_db, Song
+from typing import Dict
+from database import session_scope, Song
 
-def export_songs_to_json(filename: str = None) -> str:
+# Сколько песен читается из базы за один запрос
+EXPORT_BATCH_SIZE = 1000
+
+FORMATS = ("json", "jsonl")
+COMPRESSIONS = ("gzip", "zstd")
+
+def song_to_dict(song: Song) -> Dict:
+    return {
+        "id": song.id,
+        "title": song.title,
+        "text": song.text,
+        "region": song.region,
+        "category": song.category,
+        "place": song.place
+    }
+
+def open_export_file(filename: str, compression: str = None):
+    """Открывает файл для записи текста с необязательным сжатием gzip или zstd"""
+    if compression is None:
+        return open(filename, "w", encoding="utf-8")
+    if compression == "gzip":
+        return gzip.open(filename, "wt", encoding="utf-8")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Для сжатия zstd установите пакет zstandard")
+        raw = open(filename, "wb")
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    raise ValueError(f"Неизвестный тип сжатия: {compression}")
+
+def iter_songs(db, since_id: int = 0, batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    Перебирает песни с id больше since_id пачками по batch_size.
+
+    Каждая пачка - отдельный короткий запрос по первичному ключу, после нее
+    объекты убираются из сессии, поэтому память не растет с размером архива.
+    """
+    last_id = since_id
+    while True:
+        songs = (
+            db.query(Song)
+            .filter(Song.id > last_id)
+            .order_by(Song.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not songs:
+            break
+        for song in songs:
+            yield song
+        last_id = songs[-1].id
+        db.expunge_all()
+        db.commit()
+
+def export_songs_to_json(
+    filename: str = None,
+    fmt: str = "json",
+    compression: str = None,
+    since_id: int = 0,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> str:
     """
-    Экспортирует все песни из базы данных в JSON файл.
-    
+    Потоково экспортирует песни из базы данных в JSON файл.
+
     Args:
         filename (str, optional): Имя файла для сохранения. Если не указано, будет сгенерировано автоматически.
-    
+        fmt (str): "json" - JSON-массив, "jsonl" - одна песня в строке (JSON Lines).
+        compression (str, optional): "gzip" или "zstd" (требует пакет zstandard).
+        since_id (int): Экспортировать только песни с id больше этого значения
+            (для продолжения прерванного экспорта).
+        batch_size (int): Сколько песен читать из базы за один запрос.
+
     Returns:
         str: Путь к сохраненному файлу
     """
-    # Получаем сессию базы данных
-    db = next(get_db())
-    
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+    # Генерируем имя файла, если не указано
+    if not filename:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"folk_songs_export_{timestamp}.{fmt}"
+        if compression == "gzip":
+            filename += ".gz"
+        elif compression == "zstd":
+            filename += ".zst"
+
     try:
-        # Получаем все песни
-        songs: List[Song] = db.query(Song).all()
-        
-        # Преобразуем в список словарей
-        songs_data: List[Dict] = [
-            {
-                "id": song.id,
-                "title": song.title,
-                "text": song.text,
-                "region": song.region,
-                "category": song.category
-            }
-            for song in songs
-        ]
-        
-        # Генерируем имя файла, если не указано
-        if not filename:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"folk_songs_export_{timestamp}.json"
-        
-        # Сохраняем в JSON файл
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(songs_data, f, ensure_ascii=False, indent=2)
-        
-        print(f"Успешно экспортировано {len(songs_data)} песен в файл {filename}")
-        return filename
-    
+        # Получаем сессию базы данных
+        with session_scope() as db:
+            count = 0
+            last_id = since_id
+            with open_export_file(filename, compression) as f:
+                if fmt == "json":
+                    f.write("[")
+                for song in iter_songs(db, since_id, batch_size):
+                    line = json.dumps(song_to_dict(song), ensure_ascii=False)
+                    if fmt == "json":
+                        f.write(",\n  " if count else "\n  ")
+                        f.write(line)
+                    else:
+                        f.write(line + "\n")
+                    count += 1
+                    last_id = song.id
+                if fmt == "json":
+                    f.write("\n]\n" if count else "]\n")
+
+            print(f"Успешно экспортировано {count} песен в файл {filename} (последний id: {last_id})")
+            return filename
+
     except Exception as e:
         print(f"Ошибка при экспорте данных: {e}")
         raise
-    finally:
-        db.close()
 
 if __name__ == "__main__":
-    # Пример использования
-    export_songs_to_json("folk_songs_backup.json")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Экспорт архива песен")
+    parser.add_argument("filename", nargs="?", default="folk_songs_backup.json")
+    parser.add_argument("--format", choices=FORMATS, default="json")
+    parser.add_argument("--compression", choices=COMPRESSIONS)
+    parser.add_argument("--since-id", type=int, default=0,
+                        help="продолжить экспорт с песен, у которых id больше указанного")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    export_songs_to_json(
+        args.filename,
+        fmt=args.format,
+        compression=args.compression,
+        since_id=args.since_id,
+        batch_size=args.batch_size
+    )
@@ -1,13 +1,102 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text
+from sqlalchemy import (
+    create_engine, Column, Integer, BigInteger, String, Text, DateTime, Index, UniqueConstraint,
+    func, literal_column, inspect, event, insert, update, select, exists, and_, or_
+)
+from sqlalchemy import text as sql_text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+import hashlib
+import json
 import logging
-from env import DATABASE_URL
+import os
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from env import DATABASE_URL as ENV_DATABASE_URL
+from fingerprint import fingerprint, minhash, shingles, similarity, song_text
+from profiling import SQL_PROFILING, enable_profiling
+from trigram_index import TrigramIndex, normalize
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-engine = create_engine(DATABASE_URL)
+# Переменная окружения DATABASE_URL имеет приоритет над env.py (нужно бенчмарку и нагрузочному тесту)
+DATABASE_URL = os.getenv("DATABASE_URL") or ENV_DATABASE_URL
+
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+def _engine_options(url: str) -> dict:
+    options = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+    url = make_url(url)
+    # Базе SQLite в памяти SQLAlchemy выдает пул без этих настроек; файлу SQLite
+    # они нужны: иначе пул на 5 соединений меньше числа потоков run_db и лишние
+    # соединения открываются и закрываются заново
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT
+        )
+    return options
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+
+# Метрики пула: выдачи и возвраты соединений, сколько соединений занято сейчас
+# и сколько сессии ждали свободное соединение
+_pool_stats = {
+    "connects": 0,
+    "checkouts": 0,
+    "checkins": 0,
+    "checked_out": 0,
+    "max_checked_out": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+    "sessions": 0
+}
+_pool_stats_lock = threading.Lock()
+
+def _unicode_lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    with _pool_stats_lock:
+        _pool_stats["connects"] += 1
+    # Встроенная lower() в SQLite меняет регистр только латиницы; с этой заменой
+    # ILIKE и сравнения без учета регистра работают с кириллицей, как в PostgreSQL
+    if engine.dialect.name == "sqlite":
+        dbapi_connection.create_function("lower", 1, _unicode_lower, deterministic=True)
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _pool_stats_lock:
+        _pool_stats["checkouts"] += 1
+        _pool_stats["checked_out"] += 1
+        _pool_stats["max_checked_out"] = max(_pool_stats["max_checked_out"], _pool_stats["checked_out"])
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    with _pool_stats_lock:
+        _pool_stats["checkins"] += 1
+        _pool_stats["checked_out"] -= 1
+
+def get_pool_stats() -> dict:
+    """Снимок метрик пула соединений"""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["pool_status"] = engine.pool.status()
+    return stats
+
+# Профилирование медленных запросов (SQL_PROFILING=1), см. profiling.py
+if SQL_PROFILING:
+    enable_profiling(engine)
 
 try:
     connection = engine.connect()
@@ -28,39 +117,606 @@ class Song(Base):
     title = Column(String, nullable=False)
     text = Column(Text)
     region = Column(String, nullable=False)
-    category = Column(String)
+    category = Column(String, index=True)
+    place = Column(String, index=True)
+    # category и place в нижнем регистре и с ё → е: точный поиск по индексу (_column_filter)
+    category_key = Column(String, index=True)
+    place_key = Column(String, index=True)
+    content_hash = Column(String(40), index=True)
+
+class ArchiveChange(Base):
+    """Журнал изменений архива: по нему другие процессы сбрасывают свои кэши"""
+    __tablename__ = "archive_changes"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, index=True)  # версия архива, созданная транзакцией
+    song_id = Column(Integer)  # None - массовое изменение всего архива
+    changed_at = Column(DateTime, server_default=func.now())
+
+class ArchiveVersion(Base):
+    """
+    Текущая версия архива (единственная строка). Пишущая транзакция
+    увеличивает ее перед коммитом и держит блокировку строки до коммита,
+    поэтому версии становятся видны строго по порядку. Номера id журнала
+    такой гарантии не дают: в PostgreSQL транзакция с меньшим id может
+    закоммититься позже.
+    """
+    __tablename__ = "archive_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+# Сколько последних версий журнала изменений хранить
+ARCHIVE_CHANGES_KEEP = 10000
+
+class ConversationState(Base):
+    """Состояние диалогов пользователя (context.user_data): переживает перезапуск бота"""
+    __tablename__ = "conversation_state"
+
+    bot = Column(String(16), primary_key=True)  # "bot" или "admin"
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)  # user_data в JSON
+    updated_at = Column(DateTime, nullable=False, index=True)  # UTC
+
+class FacetCount(Base):
+    """
+    Число песен по каждой категории и каждому месту. Поддерживается при
+    add_songs, update_songs и delete_song, поэтому списки категорий и мест
+    не требуют GROUP BY по folk_songs. Значения считаются по ключу facet_key,
+    как их ищет _column_filter: "Колядки", "колядки" и "Ёлка", "Елка" - одна
+    строка, value - одно из написаний для кнопки.
+    """
+    __tablename__ = "facet_counts"
+    __table_args__ = (UniqueConstraint("facet", "value_key"),)
+
+    id = Column(Integer, primary_key=True)  # для callback-данных кнопок
+    facet = Column(String(16), nullable=False)  # "category" или "place"
+    value_key = Column(String, nullable=False)
+    value = Column(String, nullable=False)
+    count = Column(Integer, nullable=False)
+
+FACETS = ("category", "place")
+
+class SongFingerprint(Base):
+    """Хэши полос MinHash песни (см. fingerprint.py) для поиска почти-дубликатов"""
+    __tablename__ = "song_fingerprints"
+    __table_args__ = (Index("ix_song_fingerprints_band_hash", "band", "hash"),)
+
+    song_id = Column(Integer, primary_key=True)
+    band = Column(Integer, primary_key=True)
+    hash = Column(BigInteger, nullable=False)
+
+def content_hash(title: str, region: str, text: str = None) -> str:
+    """Хэш содержимого песни для поиска точных дубликатов (название + регион + текст)"""
+    payload = "\x1f".join((title or "", region or "", text or ""))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def split_region(region: str):
+    """Разбирает строку региона "категория|место" на категорию и место (None, если не указано)"""
+    if not region:
+        return "", None
+    category, _, place = region.partition('|')
+    place = place.split('|')[0].strip()
+    if place in ("", "."):
+        place = None
+    return category, place
+
+def facet_key(value: str):
+    """Значение категории или места для сравнения без учета регистра и ё (category_key, place_key)"""
+    return None if value is None else normalize(value)
+
+# Конфигурация полнотекстового поиска PostgreSQL (стемминг для русского языка)
+FTS_CONFIG = "russian"
 
 def init_db():
     try:
         Base.metadata.create_all(bind=engine)
         logger.info("Таблицы созданы (если их не было)")
+        migrate_archive_version()
+        migrate_region_columns()
+        migrate_facet_keys()
+        migrate_content_hash()
+        migrate_facet_counts()
+        migrate_fingerprints()
+        setup_fulltext()
+        migrate_title_trigram_index()
     except Exception as e:
         logger.error(f"Ошибка при создании таблиц: {e}")
         raise
 
-def get_db():
+def _existing_columns():
+    return {column["name"] for column in inspect(engine).get_columns(Song.__tablename__)}
+
+def _add_column(name: str, column_type: str):
+    """Добавляет колонку с индексом в существующую таблицу, если ее еще нет"""
+    with engine.begin() as conn:
+        if name not in _existing_columns():
+            conn.execute(sql_text(f"ALTER TABLE folk_songs ADD COLUMN {name} {column_type}"))
+            logger.info(f"Добавлена колонка {name}")
+        conn.execute(sql_text(f"CREATE INDEX IF NOT EXISTS ix_folk_songs_{name} ON folk_songs ({name})"))
+
+def _upsert(model):
+    """INSERT ... ON CONFLICT текущего диалекта"""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    return upsert(model)
+
+def migrate_archive_version():
+    """
+    Переводит журнал изменений на счетчик версий: добавляет колонку version
+    и строку archive_version. Записи журнала без версии удаляются - процессы
+    после обновления начинают чтение журнала с текущей версии.
+    """
+    with engine.begin() as conn:
+        columns = {column["name"] for column in inspect(conn).get_columns(ArchiveChange.__tablename__)}
+        if "version" not in columns:
+            conn.execute(sql_text("ALTER TABLE archive_changes ADD COLUMN version INTEGER"))
+            conn.execute(sql_text("DELETE FROM archive_changes"))
+            logger.info("Журнал изменений переведен на счетчик версий")
+        conn.execute(sql_text(
+            "CREATE INDEX IF NOT EXISTS ix_archive_changes_version ON archive_changes (version)"
+        ))
+        conn.execute(_upsert(ArchiveVersion).values(id=1, version=0).on_conflict_do_nothing())
+
+def _backfill(columns: str, where: str, compute, update: str, batch_size: int) -> int:
+    """
+    Заполняет новые колонки пачками по id: compute(row) возвращает параметры
+    для запроса update. Каждая пачка - отдельная короткая транзакция.
+    """
+    migrated = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                sql_text(
+                    f"SELECT id, {columns} FROM folk_songs "
+                    f"WHERE {where} AND id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": batch_size}
+            ).all()
+            if not rows:
+                break
+            conn.execute(sql_text(update), [dict(compute(row), id=row.id) for row in rows])
+            last_id = rows[-1].id
+            migrated += len(rows)
+    return migrated
+
+def migrate_region_columns(batch_size: int = 1000):
+    """
+    Добавляет в существующую таблицу индексированные колонки category и place
+    и заполняет их из строки region для строк, где category еще пуст.
+    """
+    _add_column("category", "VARCHAR")
+    _add_column("place", "VARCHAR")
+
+    def compute(row):
+        category, place = split_region(row.region)
+        return {"category": category, "place": place}
+
+    migrated = _backfill(
+        "region", "category IS NULL", compute,
+        "UPDATE folk_songs SET category = :category, place = :place WHERE id = :id",
+        batch_size
+    )
+    if migrated:
+        logger.info(f"Заполнены category и place для {migrated} песен")
+
+def migrate_facet_keys(batch_size: int = 1000):
+    """
+    Добавляет колонки category_key и place_key и заполняет их для существующих
+    песен. Заменяют индексы PostgreSQL по lower(category) и lower(place): такой
+    индекс в SQLite нельзя построить на lower() с поддержкой кириллицы.
+    """
+    _add_column("category_key", "VARCHAR")
+    _add_column("place_key", "VARCHAR")
+    with engine.begin() as conn:
+        for name in ("category", "place"):
+            conn.execute(sql_text(f"DROP INDEX IF EXISTS ix_folk_songs_{name}_lower"))
+    migrated = _backfill(
+        "category, place", "category_key IS NULL",
+        lambda row: {"category_key": facet_key(row.category), "place_key": facet_key(row.place)},
+        "UPDATE folk_songs SET category_key = :category_key, place_key = :place_key WHERE id = :id",
+        batch_size
+    )
+    if migrated:
+        logger.info(f"Заполнены category_key и place_key для {migrated} песен")
+
+def migrate_content_hash(batch_size: int = 1000):
+    """Добавляет колонку content_hash и заполняет ее для существующих песен"""
+    _add_column("content_hash", "VARCHAR(40)")
+    migrated = _backfill(
+        "title, region, text", "content_hash IS NULL",
+        lambda row: {"content_hash": content_hash(row.title, row.region, row.text)},
+        "UPDATE folk_songs SET content_hash = :content_hash WHERE id = :id",
+        batch_size
+    )
+    if migrated:
+        logger.info(f"Заполнен content_hash для {migrated} песен")
+
+def migrate_facet_counts():
+    """
+    Заполняет facet_counts для существующего архива, если таблица пуста.
+    Таблицу прежнего вида (счетчики по точному написанию, без value_key)
+    пересоздает: ее содержимое целиком выводится из folk_songs.
+    """
+    with engine.begin() as conn:
+        columns = {column["name"] for column in inspect(conn).get_columns(FacetCount.__tablename__)}
+        if "value_key" not in columns:
+            FacetCount.__table__.drop(conn)
+            FacetCount.__table__.create(conn)
+            logger.info("Таблица facet_counts пересоздана со счетчиками по value_key")
+    with session_scope() as db:
+        if db.query(FacetCount.id).first() is not None or db.query(Song.id).first() is None:
+            return
+        rebuild_facet_counts(db)
+        db.commit()
+        logger.info(f"Заполнена таблица facet_counts: {db.query(FacetCount).count()} значений")
+
+def _fingerprint_rows(song_id: int, title: str, text: str = None):
+    return [{"song_id": song_id, "band": band, "hash": value} for band, value in fingerprint(title, text)]
+
+def migrate_fingerprints(batch_size: int = 1000, song_ids=None) -> int:
+    """
+    Строит отпечатки песен, у которых их еще нет (существующий архив, импорт).
+    song_ids ограничивает проверку этими песнями, иначе просматривается весь архив.
+    """
+    missing = ~exists().where(SongFingerprint.song_id == Song.id)
+    ordered = sorted(song_ids) if song_ids is not None else None
+    migrated = 0
+    last_id = 0
+    position = 0
+    while True:
+        if ordered is None:
+            condition = and_(missing, Song.id > last_id)
+        else:
+            chunk = ordered[position:position + batch_size]
+            if not chunk:
+                break
+            position += len(chunk)
+            condition = and_(missing, Song.id.in_(chunk))
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(Song.id, Song.title, Song.text).where(condition).order_by(Song.id).limit(batch_size)
+            ).all()
+            values = [value for row in rows for value in _fingerprint_rows(row.id, row.title, row.text)]
+            if values:
+                conn.execute(insert(SongFingerprint), values)
+        if ordered is None:
+            if not rows:
+                break
+            last_id = rows[-1].id
+        migrated += len(rows)
+    if migrated:
+        logger.info(f"Построены отпечатки для {migrated} песен")
+    return migrated
+
+def _fold_yo(value: str) -> str:
+    """ё → е: полнотекстовые индексы считают их разными буквами, а в текстах архива они смешаны"""
+    return value.replace("ё", "е").replace("Ё", "Е")
+
+def _fts5_fold(column: str) -> str:
+    """То же, что _fold_yo, в SQL для триггеров FTS5"""
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _fts_vector():
+    return func.to_tsvector(
+        literal_column(f"'{FTS_CONFIG}'"),
+        func.translate(func.coalesce(Song.text, ''), 'ёЁ', 'еЕ')
+    )
+
+def setup_fulltext():
+    """
+    Создает полнотекстовый индекс по текстам песен и заполняет его существующими строками.
+
+    PostgreSQL: GIN-индекс по выражению to_tsvector('russian', text), поддерживается
+    самой СУБД. SQLite: внешняя FTS5-таблица folk_songs_fts с триггерами синхронизации.
+    В обоих индексах ё заменена на е (запросы складываются так же, см. _fold_yo).
+    Повторный вызов безопасен; индексы без замены ё пересоздаются.
+    """
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "postgresql":
+            conn.execute(sql_text("DROP INDEX IF EXISTS ix_folk_songs_text_fts"))
+            conn.execute(sql_text(
+                "CREATE INDEX IF NOT EXISTS ix_folk_songs_text_fts_folded ON folk_songs "
+                f"USING GIN (to_tsvector('{FTS_CONFIG}', translate(coalesce(text, ''), 'ёЁ', 'еЕ')))"
+            ))
+        elif dialect == "sqlite":
+            trigger = conn.execute(sql_text(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'folk_songs_fts_ai'"
+            )).scalar()
+            if trigger is not None and _fts5_fold("new.text") in trigger:
+                return
+            for name in ("folk_songs_fts_ai", "folk_songs_fts_ad", "folk_songs_fts_au"):
+                conn.execute(sql_text(f"DROP TRIGGER IF EXISTS {name}"))
+            conn.execute(sql_text("DROP TABLE IF EXISTS folk_songs_fts"))
+            conn.execute(sql_text(
+                "CREATE VIRTUAL TABLE folk_songs_fts USING fts5("
+                "text, content='folk_songs', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')"
+            ))
+            # В индекс попадает текст с заменой ё, поэтому 'rebuild' (читает folk_songs как есть)
+            # не используется, а при удалении передается тот же сложенный текст
+            conn.execute(sql_text(
+                "CREATE TRIGGER folk_songs_fts_ai AFTER INSERT ON folk_songs BEGIN "
+                f"INSERT INTO folk_songs_fts(rowid, text) VALUES (new.id, {_fts5_fold('new.text')}); END"
+            ))
+            conn.execute(sql_text(
+                "CREATE TRIGGER folk_songs_fts_ad AFTER DELETE ON folk_songs BEGIN "
+                "INSERT INTO folk_songs_fts(folk_songs_fts, rowid, text) "
+                f"VALUES ('delete', old.id, {_fts5_fold('old.text')}); END"
+            ))
+            conn.execute(sql_text(
+                "CREATE TRIGGER folk_songs_fts_au AFTER UPDATE OF text ON folk_songs BEGIN "
+                "INSERT INTO folk_songs_fts(folk_songs_fts, rowid, text) "
+                f"VALUES ('delete', old.id, {_fts5_fold('old.text')}); "
+                f"INSERT INTO folk_songs_fts(rowid, text) VALUES (new.id, {_fts5_fold('new.text')}); END"
+            ))
+            conn.execute(sql_text(
+                f"INSERT INTO folk_songs_fts(rowid, text) SELECT id, {_fts5_fold('text')} FROM folk_songs"
+            ))
+        else:
+            return
+    logger.info("Полнотекстовый индекс готов")
+
+def migrate_title_trigram_index():
+    """
+    PostgreSQL: расширение pg_trgm и GIN-индекс названий для нечеткого поиска.
+    Выполняется один раз: когда индекс построен, запуск его не трогает и не
+    требует прав на CREATE EXTENSION. Индекс строится CONCURRENTLY, поэтому
+    запись в folk_songs на большом архиве не блокируется.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.connect() as conn:
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        valid = conn.execute(sql_text(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = 'ix_folk_songs_title_trgm' AND pg_table_is_visible(c.oid)"
+        )).scalar()
+        if valid:
+            return
+        if valid is not None:
+            # Прерванное построение CONCURRENTLY оставляет нерабочий индекс
+            conn.execute(sql_text("DROP INDEX CONCURRENTLY IF EXISTS ix_folk_songs_title_trgm"))
+        if conn.execute(sql_text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is None:
+            conn.execute(sql_text("CREATE EXTENSION pg_trgm"))
+        conn.execute(sql_text(
+            "CREATE INDEX CONCURRENTLY ix_folk_songs_title_trgm ON folk_songs USING GIN (title gin_trgm_ops)"
+        ))
+    logger.info("Построен триграммный индекс названий")
+
+@contextmanager
+def session_scope():
+    """
+    Сессия, которая всегда возвращает соединение в пул: при ошибке
+    откатывает транзакцию, в конце закрывается. Пример:
+
+        with session_scope() as db:
+            songs = search_by_title(db, "калинка")
+    """
     db = SessionLocal()
+    started = time.perf_counter()
     try:
+        db.connection()
+        waited = time.perf_counter() - started
+        with _pool_stats_lock:
+            _pool_stats["sessions"] += 1
+            _pool_stats["wait_seconds_total"] += waited
+            _pool_stats["wait_seconds_max"] = max(_pool_stats["wait_seconds_max"], waited)
         yield db
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
 
-def add_song(db, title: str, region: str, text: str = None):
+def get_db():
+    with session_scope() as db:
+        yield db
+
+_song_listeners = []
+
+def add_song_listener(listener):
+    """
+    Регистрирует функцию listener(event, song), которая вызывается после
+    успешного коммита add_song ("add"), update_song ("update") и delete_song ("delete").
+    После массовых изменений вызывается с event="bulk" и song=None.
+    """
+    _song_listeners.append(listener)
+
+def _record_changes(db, song_ids):
+    """
+    Увеличивает версию архива и записывает в журнал id измененных песен
+    одним запросом в текущей транзакции
+    """
+    if not song_ids:
+        return
+    version = db.execute(
+        update(ArchiveVersion)
+        .where(ArchiveVersion.id == 1)
+        .values(version=ArchiveVersion.version + 1)
+        .returning(ArchiveVersion.version)
+    ).scalar_one()
+    db.execute(insert(ArchiveChange), [{"version": version, "song_id": song_id} for song_id in song_ids])
+    # Старые записи удаляются каждую тысячу версий
+    if version % 1000 == 0:
+        db.query(ArchiveChange).filter(ArchiveChange.version <= version - ARCHIVE_CHANGES_KEEP).delete()
+
+def _record_change(db, song_id=None):
+    """Добавляет запись в журнал изменений в текущей транзакции"""
+    _record_changes(db, [song_id])
+
+def get_archive_version(db) -> int:
+    """Текущая версия архива - число закоммиченных пишущих транзакций"""
+    return db.query(ArchiveVersion.version).filter(ArchiveVersion.id == 1).scalar() or 0
+
+def get_changes_since(db, version: int):
+    """
+    Возвращает (новая версия, множество id измененных песен) после версии version.
+    Вместо множества возвращается None, если нужно сбросить все: было массовое
+    изменение, нужная часть журнала уже удалена или база пересоздана.
+    """
+    current = get_archive_version(db)
+    if current == version:
+        return version, set()
+    if current < version:
+        return current, None
+    # Все записи с версией не больше current уже закоммичены вместе со счетчиком
+    changes = (
+        db.query(ArchiveChange.version, ArchiveChange.song_id)
+        .filter(ArchiveChange.version > version, ArchiveChange.version <= current)
+        .all()
+    )
+    # Каждая версия оставляет хотя бы одну запись; нет самой ранней - журнал уже обрезан
+    if not changes or min(change.version for change in changes) != version + 1:
+        return current, None
+    song_ids = set()
+    for change in changes:
+        if change.song_id is None:
+            return current, None
+        song_ids.add(change.song_id)
+    return current, song_ids
+
+def rebuild_facet_counts(db):
+    """Пересчитывает facet_counts по всему архиву в текущей транзакции (после массовых изменений)"""
+    db.query(FacetCount).delete()
+    for facet in FACETS:
+        key = getattr(Song, f"{facet}_key")
+        rows = (
+            db.query(key, func.min(getattr(Song, facet)), func.count(Song.id))
+            .filter(key.isnot(None), key != "")
+            .group_by(key)
+            .all()
+        )
+        if rows:
+            db.execute(insert(FacetCount), [
+                {"facet": facet, "value_key": value_key, "value": value, "count": count}
+                for value_key, value, count in rows
+            ])
+
+def _facet_deltas(songs, sign: int, deltas: Counter = None) -> Counter:
+    """Добавляет к deltas изменения счетчиков для песен (объекты или словари с category и place)"""
+    deltas = Counter() if deltas is None else deltas
+    for song in songs:
+        for facet in FACETS:
+            value = song[facet] if isinstance(song, dict) else getattr(song, facet)
+            if value:
+                deltas[(facet, value)] += sign
+    return deltas
+
+def _apply_facet_deltas(db, deltas: Counter):
+    """
+    Применяет изменения счетчиков одним upsert в текущей транзакции; нулевые
+    удаляются. Написания с одним facet_key складываются в одну строку; value
+    задается при ее создании, у существующей строки не меняется.
+    """
+    by_key = {}
+    # Сначала добавленные значения: написание для новой строки берется из них
+    for (facet, value), delta in sorted(deltas.items(), key=lambda item: item[1] <= 0):
+        key = facet_key(value)
+        row = by_key.setdefault((facet, key), {"facet": facet, "value_key": key, "value": value, "count": 0})
+        row["count"] += delta
+    rows = [row for row in by_key.values() if row["count"]]
+    if not rows:
+        return
+    statement = _upsert(FacetCount)
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=["facet", "value_key"],
+            set_={"count": FacetCount.count + statement.excluded.count}
+        ),
+        rows
+    )
+    if any(row["count"] < 0 for row in rows):
+        db.query(FacetCount).filter(FacetCount.count <= 0).delete()
+
+def get_facet_counts(db, facet: str, limit: int = None, offset: int = 0):
+    """Значения категории или места с числом песен: сначала самые частые"""
     try:
-        if not title or not region:
-            raise ValueError("Название и область не могут быть пустыми")
+        query = (
+            db.query(FacetCount)
+            .filter(FacetCount.facet == facet)
+            .order_by(FacetCount.count.desc(), FacetCount.value, FacetCount.id)
+            .offset(offset)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка значений {facet}: {e}")
+        raise
+
+def get_facet_value(db, facet_id: int):
+    """Строка facet_counts по id или None"""
+    return db.query(FacetCount).filter(FacetCount.id == facet_id).first()
+
+def notify_bulk_change(db):
+    """Сообщает о массовом изменении архива в обход add_song (например, импорт)"""
+    rebuild_facet_counts(db)
+    _record_change(db)
+    db.commit()
+    _notify_song_listeners("bulk", None)
 
-        song = Song(title=title, text=text, region=region)
-        db.add(song)
+def _notify_song_listeners(event: str, song):
+    for listener in _song_listeners:
+        try:
+            listener(event, song)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике изменения песни: {e}")
+
+def _new_song_row(title: str, region: str, text: str = None) -> dict:
+    if not title or not region:
+        raise ValueError("Название и область не могут быть пустыми")
+    category, place = split_region(region)
+    return {
+        "title": title,
+        "text": text,
+        "region": region,
+        "category": category,
+        "place": place,
+        "category_key": facet_key(category),
+        "place_key": facet_key(place),
+        "content_hash": content_hash(title, region, text)
+    }
+
+def add_songs(db, songs):
+    """
+    Добавляет несколько песен одной транзакцией: INSERT ... RETURNING id и один
+    коммит без повторного чтения строк. songs - словари с ключами title, region
+    и text. Возвращает песни (не привязанные к сессии) в том же порядке.
+    """
+    try:
+        rows = [_new_song_row(item["title"], item["region"], item.get("text")) for item in songs]
+        fingerprints = [fingerprint(row["title"], row["text"]) for row in rows]
+        song_ids = db.execute(
+            insert(Song).returning(Song.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        fingerprint_rows = [
+            {"song_id": song_id, "band": band, "hash": value}
+            for song_id, bands in zip(song_ids, fingerprints) for band, value in bands
+        ]
+        if fingerprint_rows:
+            db.execute(insert(SongFingerprint), fingerprint_rows)
+        _apply_facet_deltas(db, _facet_deltas(rows, 1))
+        _record_changes(db, song_ids)
         db.commit()
-        db.refresh(song)
-        logger.info(f"Добавлена песня: {song.title}")
-        return song
+        added = [Song(id=song_id, **row) for song_id, row in zip(song_ids, rows)]
+        for song in added:
+            logger.info(f"Добавлена песня: {song.title}")
+            _notify_song_listeners("add", song)
+        return added
     except Exception as e:
         db.rollback()
         logger.error(f"Ошибка при добавлении песни: {e}")
         raise
 
+def add_song(db, title: str, region: str, text: str = None):
+    return add_songs(db, [{"title": title, "region": region, "text": text}])[0]
+
 def get_all_songs(db):
     try:
         return db.query(Song).all()
@@ -75,6 +731,43 @@ def get_songs_by_region(db, region: str):
         logger.error(f"Ошибка при поиске песен по области: {e}")
         raise
 
+def _column_filter(db, column, value: str):
+    """
+    Условие поиска по колонке category_key или place_key (без учета регистра
+    и ё): точное совпадение, если такие песни есть, иначе поиск подстроки.
+    Поэтому при точном совпадении песни, где значение - только часть категории
+    ("Лирические" и "Лирические протяжные"), не попадают в выдачу: так кнопки
+    /categories и /places показывают ровно посчитанные песни. Проверка точного
+    совпадения - отдельный запрос, но только по индексу колонки.
+    """
+    key = facet_key(value)
+    exact = column == key
+    if db.query(Song.id).filter(exact).first():
+        return exact
+    return column.like(f"%{key}%")
+
+def get_songs_by_category(db, category: str):
+    """
+    Поиск по категории: сначала точное совпадение по индексу,
+    если ничего не найдено - поиск подстроки в колонке category.
+    """
+    try:
+        return db.query(Song).filter(_column_filter(db, Song.category_key, category)).order_by(Song.id).all()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске песен по категории: {e}")
+        raise
+
+def get_songs_by_place(db, place: str):
+    """
+    Поиск по месту записи: сначала точное совпадение по индексу,
+    если ничего не найдено - поиск подстроки в колонке place.
+    """
+    try:
+        return db.query(Song).filter(_column_filter(db, Song.place_key, place)).order_by(Song.id).all()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске песен по месту записи: {e}")
+        raise
+
 def delete_song(db, song_id: int):
     try:
         logger.info(f"Попытка удалить песню с ID: {song_id}")
@@ -85,54 +778,95 @@ def delete_song(db, song_id: int):
             raise ValueError(f"Песня с ID {song_id} не найдена")
 
         db.delete(song)
+        db.query(SongFingerprint).filter(SongFingerprint.song_id == song_id).delete()
+        _apply_facet_deltas(db, _facet_deltas([song], -1))
+        _record_change(db, song_id)
         db.commit()
         logger.info(f"Удалена песня с ID {song_id}: {song.title}")
+        _notify_song_listeners("delete", song)
         return True
     except Exception as e:
         db.rollback()
         logger.error(f"Ошибка при удалении песни с ID {song_id}: {e}", exc_info=True)
         raise
 
-def update_song(
-    db,
-    song_id: int,
-    title: str = None,
-    text: str = None,
-    region: str = None
-):
+def update_songs(db, changes):
+    """
+    Изменяет несколько песен одной транзакцией. changes - словари с ключом
+    song_id и изменяемыми полями title, text, region (None - не менять).
+    Возвращает песни (не привязанные к сессии) в порядке changes.
+    """
     try:
-        song = db.query(Song).filter(Song.id == song_id).first()
-        if not song:
-            raise ValueError(f"Песня с ID {song_id} не найдена")
+        song_ids = {change["song_id"] for change in changes}
+        songs = {song.id: song for song in db.query(Song).filter(Song.id.in_(song_ids))}
+        missing = song_ids - songs.keys()
+        if missing:
+            raise ValueError(f"Песня с ID {min(missing)} не найдена")
 
-        if title is not None:
-            song.title = title
-        if text is not None:
-            song.text = text
-        if region is not None:
-            song.region = region
+        deltas = Counter()
+        fingerprint_rows = {}
+        for change in changes:
+            song = songs[change["song_id"]]
+            if change.get("region") is not None:
+                _facet_deltas([song], -1, deltas)
+            if change.get("title") is not None:
+                song.title = change["title"]
+            if change.get("text") is not None:
+                song.text = change["text"]
+            if change.get("region") is not None:
+                song.region = change["region"]
+                song.category, song.place = split_region(change["region"])
+                song.category_key, song.place_key = facet_key(song.category), facet_key(song.place)
+                _facet_deltas([song], 1, deltas)
+            if change.get("title") is not None or change.get("text") is not None:
+                fingerprint_rows[song.id] = _fingerprint_rows(song.id, song.title, song.text)
+            song.content_hash = content_hash(song.title, song.region, song.text)
 
+        db.flush()
+        _apply_facet_deltas(db, deltas)
+        if fingerprint_rows:
+            db.query(SongFingerprint).filter(SongFingerprint.song_id.in_(fingerprint_rows)).delete()
+            rows = [row for song_rows in fingerprint_rows.values() for row in song_rows]
+            if rows:
+                db.execute(insert(SongFingerprint), rows)
+        _record_changes(db, [change["song_id"] for change in changes])
+        # Отсоединяем песни до коммита, чтобы он не сбросил загруженные поля (без db.refresh)
+        for song in songs.values():
+            db.expunge(song)
         db.commit()
-        db.refresh(song)
-        logger.info(f"Успешно обновлена песня с ID {song_id}: title={title is not None}, "
-                   f"text={text is not None}, region={region is not None}")
-        return song
-        
+
+        for change in changes:
+            logger.info(f"Успешно обновлена песня с ID {change['song_id']}: "
+                        f"title={change.get('title') is not None}, text={change.get('text') is not None}, "
+                        f"region={change.get('region') is not None}")
+            _notify_song_listeners("update", songs[change["song_id"]])
+        return [songs[change["song_id"]] for change in changes]
+
     except Exception as e:
         db.rollback()
-        logger.error(f"Ошибка при обновлении песни ID {song_id}: {str(e)}")
+        logger.error(f"Ошибка при обновлении песен ID {sorted(change['song_id'] for change in changes)}: {str(e)}")
         raise
 
+def update_song(
+    db,
+    song_id: int,
+    title: str = None,
+    text: str = None,
+    region: str = None
+):
+    return update_songs(db, [{"song_id": song_id, "title": title, "text": text, "region": region}])[0]
+
 def get_all_songs_with_id(db):
     try:
-        songs = db.query(Song.id, Song.title, Song.text, Song.region, Song.category).all()
+        songs = db.query(Song.id, Song.title, Song.text, Song.region, Song.category, Song.place).all()
         songs_list = [
             {
                 "id": song.id,
                 "title": song.title,
                 "text": song.text,
                 "region": song.region,
-                "category": song.category
+                "category": song.category,
+                "place": song.place
             }
             for song in songs
         ]
@@ -149,13 +883,294 @@ def search_by_title(db, title: str):
         logger.error(f"Ошибка при поиске песни по названию: {e}")
         raise
 
-def search_by_text(db, text: str):
+def _fts5_query(text: str) -> str:
+    """Строит запрос FTS5: каждое слово в кавычках и с префиксным поиском, ё → е"""
+    words = [word.replace('"', '""') for word in _fold_yo(text).split()]
+    return " ".join(f'"{word}"*' for word in words)
+
+# Максимальное число результатов нечеткого поиска и минимальное сходство названий
+FUZZY_LIMIT = 20
+FUZZY_THRESHOLD = 0.3
+
+_title_index = None
+_title_index_version = None
+_title_index_lock = threading.Lock()
+
+def _get_title_index(db):
+    """
+    Триграммный индекс названий в памяти. Строится при первом обращении и
+    перед каждым поиском догоняет журнал изменений: песни, добавленные
+    админ-ботом, импортом или другими процессами, находятся сразу.
+    """
+    global _title_index, _title_index_version
+    with _title_index_lock:
+        if _title_index is not None:
+            version, song_ids = get_changes_since(db, _title_index_version)
+            if song_ids is None:
+                _title_index = None
+            elif song_ids:
+                titles = dict(db.query(Song.id, Song.title).filter(Song.id.in_(song_ids)).all())
+                for song_id in song_ids:
+                    if song_id in titles:
+                        _title_index.add(song_id, titles[song_id])
+                    else:
+                        _title_index.remove(song_id)
+            _title_index_version = version
+        if _title_index is None:
+            version = get_archive_version(db)
+            index = TrigramIndex()
+            for song_id, title in db.query(Song.id, Song.title).yield_per(1000):
+                index.add(song_id, title)
+            _title_index, _title_index_version = index, version
+            logger.info(f"Построен индекс названий: {len(index)} песен")
+        return _title_index
+
+def _update_title_index(event: str, song):
+    """Изменения этого процесса попадают в индекс сразу, не дожидаясь журнала"""
+    global _title_index
+    with _title_index_lock:
+        if _title_index is None:
+            return
+        if event == "bulk":
+            _title_index = None
+        elif event == "delete":
+            _title_index.remove(song.id)
+        else:
+            _title_index.add(song.id, song.title)
+
+add_song_listener(_update_title_index)
+
+def search_by_title_fuzzy(db, title: str, limit: int = FUZZY_LIMIT, offset: int = 0):
+    """
+    Нечеткий поиск по названию (устойчив к опечаткам), результаты отсортированы по сходству.
+    PostgreSQL использует индекс pg_trgm, остальные СУБД - триграммный индекс в памяти.
+    """
     try:
-        return db.query(Song).filter(Song.text.ilike(f"%{text}%")).all()
+        if db.get_bind().dialect.name == "postgresql":
+            similarity = func.similarity(Song.title, title)
+            db.execute(sql_text("SELECT set_limit(:limit)"), {"limit": FUZZY_THRESHOLD})
+            return (
+                db.query(Song)
+                .filter(Song.title.op("%")(title))
+                .order_by(similarity.desc(), Song.id)
+                .offset(offset)
+                .limit(limit)
+                .all()
+            )
+
+        matches = _get_title_index(db).search(title, limit=offset + limit, threshold=FUZZY_THRESHOLD)
+        ids = [song_id for song_id, _ in matches[offset:]]
+        if not ids:
+            return []
+        songs = {song.id: song for song in db.query(Song).filter(Song.id.in_(ids))}
+        return [songs[song_id] for song_id in ids if song_id in songs]
+    except Exception as e:
+        logger.error(f"Ошибка при нечетком поиске по названию: {e}")
+        raise
+
+def search_by_text(db, text: str, limit: int = None, offset: int = 0, by_id: bool = False):
+    """
+    Полнотекстовый поиск по текстам песен, результаты отсортированы по релевантности
+    (by_id=True - по id, как в SearchIndex). На СУБД без поддержки полнотекстового
+    поиска используется ILIKE.
+    """
+    try:
+        dialect = db.get_bind().dialect.name
+        if not text.strip():
+            return []
+
+        if dialect == "postgresql":
+            ts_query = func.plainto_tsquery(literal_column(f"'{FTS_CONFIG}'"), _fold_yo(text))
+            vector = _fts_vector()
+            return (
+                db.query(Song)
+                .filter(vector.op("@@")(ts_query))
+                .order_by(*([Song.id] if by_id else [func.ts_rank(vector, ts_query).desc(), Song.id]))
+                .offset(offset)
+                .limit(limit)
+                .all()
+            )
+
+        if dialect == "sqlite":
+            statement = sql_text(
+                "SELECT folk_songs.* FROM folk_songs "
+                "JOIN folk_songs_fts ON folk_songs_fts.rowid = folk_songs.id "
+                "WHERE folk_songs_fts MATCH :query "
+                f"ORDER BY {'' if by_id else 'folk_songs_fts.rank, '}folk_songs.id "
+                "LIMIT :limit OFFSET :offset"
+            )
+            return db.query(Song).from_statement(statement).params(
+                query=_fts5_query(text),
+                limit=-1 if limit is None else limit,
+                offset=offset
+            ).all()
+
+        return search_by_text_ilike(db, text, limit=limit, offset=offset)
     except Exception as e:
         logger.error(f"Ошибка при поиске песни по тексту: {e}")
         raise
 
+def search_by_text_ilike(db, text: str, limit: int = None, offset: int = 0):
+    """Поиск подстроки в тексте без индекса (полный просмотр таблицы)"""
+    return (
+        db.query(Song)
+        .filter(Song.text.ilike(f"%{text}%"))
+        .order_by(Song.id)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+
+# Число песен на одной странице клавиатуры
+PAGE_SIZE = 10
+
+# Страница результатов. Курсоры - строки для callback_data:
+# "a<id>" - песни после id, "b<id>" - песни до id, "o<n>" - смещение в ранжированной выдаче,
+# "i<n>" - смещение в выдаче по тексту, упорядоченной по id (так листает SearchIndex)
+Page = namedtuple("Page", ["songs", "prev_cursor", "next_cursor"])
+
+def _keyset_page(query, cursor: str = None, limit: int = PAGE_SIZE) -> Page:
+    """Страница по ключу id: запрос выбирает не больше limit + 1 строк независимо от размера архива"""
+    if cursor and cursor[0] == "b":
+        rows = query.filter(Song.id < int(cursor[1:])).order_by(Song.id.desc()).limit(limit + 1).all()
+        has_prev, has_next = len(rows) > limit, True
+        songs = list(reversed(rows[:limit]))
+    else:
+        after_id = int(cursor[1:]) if cursor else 0
+        rows = query.filter(Song.id > after_id).order_by(Song.id).limit(limit + 1).all()
+        has_prev, has_next = cursor is not None, len(rows) > limit
+        songs = rows[:limit]
+
+    if not songs:
+        return Page([], None, None)
+    return Page(
+        songs,
+        f"b{songs[0].id}" if has_prev else None,
+        f"a{songs[-1].id}" if has_next else None
+    )
+
+def _ranked_page(fetch, cursor: str = None, limit: int = PAGE_SIZE, prefix: str = "o") -> Page:
+    """
+    Страница выдачи по смещению: fetch(offset, limit) возвращает песни в порядке
+    релевантности (курсоры o<n>) или другом постоянном порядке (свой prefix)
+    """
+    offset = int(cursor[1:]) if cursor else 0
+    rows = fetch(offset, limit + 1)
+    songs = rows[:limit]
+    if not songs:
+        return Page([], None, None)
+    return Page(
+        songs,
+        f"{prefix}{max(offset - limit, 0)}" if offset > 0 else None,
+        f"{prefix}{offset + limit}" if len(rows) > limit else None
+    )
+
+def get_songs_page(db, kind: str, query: str = None, cursor: str = None, limit: int = PAGE_SIZE) -> Page:
+    """
+    Возвращает одну страницу результатов.
+
+    kind: "all", "title", "fuzzy" (нечеткий поиск по названию), "text",
+    "category", "place" или "region".
+    """
+    try:
+        if kind == "all":
+            return _keyset_page(db.query(Song), cursor, limit)
+        if kind == "title":
+            return _keyset_page(db.query(Song).filter(Song.title.ilike(f"%{query}%")), cursor, limit)
+        if kind == "category":
+            return _keyset_page(db.query(Song).filter(_column_filter(db, Song.category_key, query)), cursor, limit)
+        if kind == "place":
+            return _keyset_page(db.query(Song).filter(_column_filter(db, Song.place_key, query)), cursor, limit)
+        if kind == "region":
+            return _keyset_page(db.query(Song).filter(Song.region.ilike(f"%{query}%")), cursor, limit)
+        if kind == "text" and cursor and cursor[0] == "i":
+            return _ranked_page(
+                lambda offset, count: search_by_text(db, query, limit=count, offset=offset, by_id=True),
+                cursor, limit, prefix="i"
+            )
+        if kind == "text":
+            return _ranked_page(
+                lambda offset, count: search_by_text(db, query, limit=count, offset=offset),
+                cursor, limit
+            )
+        if kind == "fuzzy":
+            return _ranked_page(
+                lambda offset, count: search_by_title_fuzzy(db, query, limit=count, offset=offset),
+                cursor, limit
+            )
+        raise ValueError(f"Неизвестный тип выборки: {kind}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы песен ({kind}): {e}")
+        raise
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def load_user_state(db, bot: str, user_id: int, ttl: float):
+    """Сохраненный user_data пользователя или None, если его нет или он старше ttl секунд"""
+    try:
+        row = (
+            db.query(ConversationState.data)
+            .filter(
+                ConversationState.bot == bot,
+                ConversationState.user_id == user_id,
+                ConversationState.updated_at >= _utcnow() - timedelta(seconds=ttl)
+            )
+            .first()
+        )
+        return json.loads(row.data) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке состояния пользователя: {e}")
+        raise
+
+def save_user_states(db, bot: str, states: dict):
+    """
+    Записывает пачку состояний {user_id: user_data} одной транзакцией.
+    Пустой user_data удаляет запись пользователя.
+    """
+    try:
+        db.query(ConversationState).filter(
+            ConversationState.bot == bot,
+            ConversationState.user_id.in_(list(states))
+        ).delete(synchronize_session=False)
+        now = _utcnow()
+        rows = [
+            {"bot": bot, "user_id": user_id, "data": json.dumps(data, ensure_ascii=False), "updated_at": now}
+            for user_id, data in states.items() if data
+        ]
+        if rows:
+            db.execute(insert(ConversationState), rows)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка при сохранении состояний пользователей: {e}")
+        raise
+
+def delete_user_state(db, bot: str, user_id: int):
+    try:
+        db.query(ConversationState).filter(
+            ConversationState.bot == bot,
+            ConversationState.user_id == user_id
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка при удалении состояния пользователя: {e}")
+        raise
+
+def prune_user_states(db, ttl: float) -> int:
+    """Удаляет брошенные диалоги: состояния, не менявшиеся дольше ttl секунд"""
+    try:
+        deleted = db.query(ConversationState).filter(
+            ConversationState.updated_at < _utcnow() - timedelta(seconds=ttl)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка при очистке состояний пользователей: {e}")
+        raise
+
 def get_song_by_id(db, song_id: int):
     try:
         return db.query(Song).filter(Song.id == song_id).first()
@@ -163,5 +1178,157 @@ def get_song_by_id(db, song_id: int):
         logger.error(f"Ошибка при поиске песни по ID: {e}")
         raise
 
+def get_songs_by_ids(db, song_ids):
+    """Песни с данными id одним запросом (в порядке id, отсутствующие пропускаются)"""
+    if not song_ids:
+        return []
+    try:
+        return db.query(Song).filter(Song.id.in_(list(song_ids))).order_by(Song.id).all()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске песен по ID: {e}")
+        raise
+
+# Минимальное сходство (коэффициент Жаккара отрезков текста) почти-дубликатов
+DUPLICATE_THRESHOLD = 0.7
+# Сколько похожих песен показывать при добавлении и сколько кандидатов проверять
+DUPLICATE_LIMIT = 5
+DUPLICATE_CANDIDATES = 50
+# Корзины LSH больше этого размера проверяются не попарно, а цепочкой (иначе квадратичная сложность)
+DUPLICATE_BUCKET_LIMIT = 50
+
+def find_similar_songs(db, title: str, text: str = None, threshold: float = DUPLICATE_THRESHOLD,
+                       limit: int = DUPLICATE_LIMIT):
+    """
+    Песни архива, похожие на новую песню: [(песня, сходство)] по убыванию
+    сходства. Кандидаты ищутся по совпадающим полосам отпечатка (индекс
+    band, hash), сходство кандидатов считается точно.
+    """
+    try:
+        bands = fingerprint(title, text)
+        if not bands:
+            return []
+        candidates = (
+            db.query(SongFingerprint.song_id)
+            .filter(or_(*[and_(SongFingerprint.band == band, SongFingerprint.hash == value) for band, value in bands]))
+            .group_by(SongFingerprint.song_id)
+            .order_by(func.count().desc(), SongFingerprint.song_id)
+            .limit(DUPLICATE_CANDIDATES)
+            .all()
+        )
+        if not candidates:
+            return []
+        new_shingles = shingles(song_text(title, text))
+        scored = []
+        for song in get_songs_by_ids(db, [row.song_id for row in candidates]):
+            score = similarity(new_shingles, shingles(song_text(song.title, song.text)))
+            if score >= threshold:
+                scored.append((song, score))
+        scored.sort(key=lambda item: (-item[1], item[0].id))
+        return scored[:limit]
+    except Exception as e:
+        logger.error(f"Ошибка при поиске похожих песен: {e}")
+        raise
+
+# Песня в группе почти-дубликатов (find_duplicate_groups)
+DuplicateSong = namedtuple("DuplicateSong", ["id", "title", "category", "place"])
+
+def _candidate_pairs(db, bucket_limit: int):
+    """Пары id песен, попавших в одну корзину LSH хотя бы в одной полосе"""
+    buckets = (
+        db.query(SongFingerprint.band, SongFingerprint.hash)
+        .group_by(SongFingerprint.band, SongFingerprint.hash)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    rows = (
+        db.query(SongFingerprint.band, SongFingerprint.hash, SongFingerprint.song_id)
+        .join(buckets, and_(SongFingerprint.band == buckets.c.band, SongFingerprint.hash == buckets.c.hash))
+        .order_by(SongFingerprint.band, SongFingerprint.hash, SongFingerprint.song_id)
+        .yield_per(10000)
+    )
+    pairs = set()
+
+    def add_bucket(bucket):
+        if len(bucket) <= bucket_limit:
+            pairs.update((a, b) for i, a in enumerate(bucket) for b in bucket[i + 1:])
+        else:
+            pairs.update(zip(bucket, bucket[1:]))
+            pairs.update((bucket[0], b) for b in bucket[2:])
+
+    bucket, key = [], None
+    for band, value, song_id in rows:
+        if (band, value) != key:
+            add_bucket(bucket)
+            bucket, key = [], (band, value)
+        bucket.append(song_id)
+    add_bucket(bucket)
+    return pairs
+
+def find_duplicate_groups(db, threshold: float = DUPLICATE_THRESHOLD, bucket_limit: int = DUPLICATE_BUCKET_LIMIT):
+    """
+    Группы почти-дубликатов по всему архиву: список словарей songs (id, title,
+    category, place) и similarity (наибольшее сходство пары в группе),
+    большие группы первыми.
+
+    Сравниваются только пары из общих корзин LSH, поэтому работа растет с
+    числом кандидатов, а не с квадратом размера архива. Сходство пары
+    оценивается по подписям MinHash (доля совпавших значений).
+    """
+    try:
+        pairs = _candidate_pairs(db, bucket_limit)
+        song_ids = sorted({song_id for pair in pairs for song_id in pair})
+        # Карточки песен читаются тем же запросом, что и тексты: песни, удаленные
+        # после построения отпечатков, не попадают ни в пары, ни в группы
+        signatures, summaries = {}, {}
+        for start in range(0, len(song_ids), 500):
+            chunk = song_ids[start:start + 500]
+            for row in db.query(Song.id, Song.title, Song.category, Song.place, Song.text).filter(Song.id.in_(chunk)):
+                signatures[row.id] = minhash(shingles(song_text(row.title, row.text)))
+                summaries[row.id] = (row.id, row.title, row.category, row.place)
+
+        parent = {}
+
+        def find(song_id):
+            while parent.get(song_id, song_id) != song_id:
+                song_id = parent[song_id]
+            return song_id
+
+        best = {}
+        for a, b in pairs:
+            first, second = signatures.get(a), signatures.get(b)
+            if not first or not second:
+                continue
+            score = sum(x == y for x, y in zip(first, second)) / len(first)
+            if score < threshold:
+                continue
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+            best[(a, b)] = score
+
+        members = {}
+        for song_id in parent:
+            members.setdefault(find(song_id), set()).add(song_id)
+        for root, group in members.items():
+            group.add(root)
+        scores = {}
+        for (a, b), score in best.items():
+            root = find(a)
+            scores[root] = max(scores.get(root, 0.0), score)
+
+        groups = [
+            {
+                "songs": [DuplicateSong(*summaries[song_id]) for song_id in sorted(group) if song_id in summaries],
+                "similarity": scores.get(root, 0.0)
+            }
+            for root, group in members.items()
+        ]
+        groups = [group for group in groups if len(group["songs"]) >= 2]
+        groups.sort(key=lambda group: (-len(group["songs"]), -group["similarity"], group["songs"][0].id))
+        return groups
+    except Exception as e:
+        logger.error(f"Ошибка при поиске дубликатов: {e}")
+        raise
+
 if __name__ == "__main__":
     init_db()
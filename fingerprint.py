@@ -0,0 +1,85 @@
+"""
+Отпечатки текстов песен для поиска почти-дубликатов (MinHash + LSH).
+
+Текст (название и слова песни) разбивается на пересекающиеся отрезки по
+SHINGLE_SIZE символов после нормализации, поэтому опечатки и другое
+написание меняют лишь несколько отрезков. Подпись MinHash из
+NUM_BANDS * BAND_ROWS значений строится за один проход по отрезкам (one
+permutation hashing: хэш отрезка выбирает корзину, в корзине остается
+минимум, пустые корзины заполняются из соседних) и делится на NUM_BANDS
+полос; хэш каждой полосы хранится в таблице song_fingerprints. Песни, у
+которых совпадает хотя бы одна полоса, - кандидаты в дубликаты; их сходство
+затем проверяется точно (similarity).
+
+При 16 полосах по 4 значения пара со сходством 0.7 становится кандидатом
+с вероятностью 0.99, со сходством 0.3 - 0.12.
+"""
+import hashlib
+import re
+import zlib
+
+from trigram_index import normalize
+
+SHINGLE_SIZE = 5
+NUM_BANDS = 16
+BAND_ROWS = 4
+
+_SIGNATURE_SIZE = NUM_BANDS * BAND_ROWS
+# Перемешивание crc32 умножением (хэш не зависит от процесса, в отличие от hash())
+_MIX = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+# Сдвиг значения, взятого из соседней корзины, на каждый шаг
+_BORROW_STEP = (1 << 64) // _SIGNATURE_SIZE
+_NON_WORD = re.compile(r"[\W_]+")
+
+def song_text(title: str, text: str = None) -> str:
+    """Что сравнивается: название и текст песни"""
+    return f"{title or ''} {text or ''}"
+
+def shingles(value: str) -> set:
+    """Отрезки по SHINGLE_SIZE символов нормализованной строки (без знаков препинания)"""
+    value = _NON_WORD.sub(" ", normalize(value)).strip()
+    if len(value) <= SHINGLE_SIZE:
+        return {value} if value else set()
+    return {value[i:i + SHINGLE_SIZE] for i in range(len(value) - SHINGLE_SIZE + 1)}
+
+def similarity(a: set, b: set) -> float:
+    """Коэффициент Жаккара двух множеств отрезков"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def minhash(shingle_set: set):
+    """Подпись MinHash множества отрезков (None для пустого множества)"""
+    if not shingle_set:
+        return None
+    bins = [None] * _SIGNATURE_SIZE
+    for shingle in shingle_set:
+        value = (zlib.crc32(shingle.encode("utf-8")) * _MIX) & _MASK
+        bucket = value % _SIGNATURE_SIZE
+        if bins[bucket] is None or value < bins[bucket]:
+            bins[bucket] = value
+    # Пустая корзина берет значение ближайшей непустой справа (по кругу) со сдвигом на расстояние
+    signature = list(bins)
+    for i in range(_SIGNATURE_SIZE):
+        if bins[i] is None:
+            step = 1
+            while bins[(i + step) % _SIGNATURE_SIZE] is None:
+                step += 1
+            signature[i] = bins[(i + step) % _SIGNATURE_SIZE] + step * _BORROW_STEP
+    return signature
+
+def band_hashes(signature):
+    """Пары (номер полосы, 64-битный хэш полосы) для таблицы song_fingerprints"""
+    if signature is None:
+        return []
+    result = []
+    for band in range(NUM_BANDS):
+        rows = signature[band * BAND_ROWS:(band + 1) * BAND_ROWS]
+        digest = hashlib.blake2b(repr(rows).encode("ascii"), digest_size=8).digest()
+        result.append((band, int.from_bytes(digest, "big", signed=True)))
+    return result
+
+def fingerprint(title: str, text: str = None):
+    """Хэши полос песни"""
+    return band_hashes(minhash(shingles(song_text(title, text))))
@@ -0,0 +1,260 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import time
+from typing import Dict, Iterator
+from sqlalchemy import insert, func
+from sqlalchemy import text as sql_text
+from database import session_scope, init_db, Song, split_region, facet_key, content_hash, notify_bulk_change, migrate_fingerprints
+
+# Сколько песен вставляется в базу за одну транзакцию
+IMPORT_BATCH_SIZE = 5000
+
+COLUMNS = ("title", "text", "region", "category", "place", "category_key", "place_key", "content_hash")
+ID_COLUMNS = ("id",) + COLUMNS
+
+def open_import_file(filename: str):
+    """Открывает файл для чтения текста, распаковывая .gz и .zst"""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", encoding="utf-8")
+    if filename.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Для чтения zstd установите пакет zstandard")
+        raw = open(filename, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), encoding="utf-8")
+    return open(filename, "r", encoding="utf-8")
+
+def _iter_json_array(f, chunk_size: int = 1 << 16) -> Iterator[Dict]:
+    """Потоково читает JSON-массив объектов, не загружая весь файл в память"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    eof = False
+    while True:
+        buffer = buffer.lstrip()
+        if not started:
+            if buffer:
+                if buffer[0] != "[":
+                    raise ValueError("Ожидался JSON-массив")
+                buffer = buffer[1:]
+                started = True
+                continue
+        elif buffer[:1] == ",":
+            buffer = buffer[1:]
+            continue
+        elif buffer[:1] == "]":
+            return
+        elif buffer:
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield item
+                buffer = buffer[end:]
+                continue
+
+        if eof:
+            raise ValueError("Неожиданный конец JSON-файла")
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+def read_songs(filename: str) -> Iterator[Dict]:
+    """
+    Читает песни из файла экспорта: JSON-массив (формат export_songs_to_json),
+    JSON Lines (.jsonl) или CSV с колонками title, text, region. Поддерживает .gz и .zst.
+    """
+    name = filename
+    for suffix in (".gz", ".zst"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    with open_import_file(filename) as f:
+        if name.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif name.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            yield from _iter_json_array(f)
+
+def _prepare_row(item: Dict):
+    title = (item.get("title") or "").strip()
+    region = (item.get("region") or "").strip()
+    if not title or not region:
+        return None
+    text = item.get("text")
+    category, place = split_region(region)
+    return {
+        "title": title,
+        "text": text,
+        "region": region,
+        "category": category,
+        "place": place,
+        "category_key": facet_key(category),
+        "place_key": facet_key(place),
+        "content_hash": content_hash(title, region, text)
+    }
+
+def _song_id(item: Dict):
+    """id песни из файла экспорта или None, если его нет"""
+    value = item.get("id")
+    if value in (None, ""):
+        return None
+    return int(value)
+
+def _copy_rows(db, rows, columns=COLUMNS):
+    """Вставка пачки через COPY (только PostgreSQL)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY folk_songs ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer
+    )
+
+def _reset_id_sequence(db):
+    """После вставки явных id последовательность PostgreSQL продолжает нумерацию с наибольшего id"""
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(sql_text(
+            "SELECT setval(pg_get_serial_sequence('folk_songs', 'id'), (SELECT MAX(id) FROM folk_songs))"
+        ))
+
+def import_songs(filename: str, batch_size: int = IMPORT_BATCH_SIZE, use_copy: bool = None,
+                 keep_ids: bool = True, fingerprints: bool = False) -> Dict:
+    """
+    Массово загружает песни из файла в базу данных пачками.
+
+    Песни, совпадающие по названию, региону и тексту с уже имеющимися
+    (или с песнями выше в этом же файле), пропускаются.
+
+    id из файла экспорта сохраняются, поэтому после восстановления из
+    резервной копии остаются верными сохраненные id, курсоры страниц и
+    callback-данные кнопок. Песня, чей id уже занят другой песней, получает
+    новый id (renumbered в результате).
+
+    Отпечатки для поиска почти-дубликатов считаются в Python и обходятся
+    дороже самой вставки, поэтому по умолчанию их строит migrate_fingerprints
+    при следующем запуске бота. С fingerprints=True они строятся сразу для
+    добавленных песен, а их время учитывается отдельно (fingerprint_seconds).
+
+    Args:
+        filename (str): Путь к файлу (.json, .jsonl, .csv, можно со сжатием .gz/.zst).
+        batch_size (int): Сколько песен вставлять за одну транзакцию.
+        use_copy (bool, optional): Использовать COPY. По умолчанию - только на PostgreSQL.
+        keep_ids (bool): Сохранять id из файла. False - все песни получают новые id.
+        fingerprints (bool): Построить отпечатки добавленных песен после вставки.
+
+    Returns:
+        dict: Число прочитанных, добавленных, пропущенных, перенумерованных песен и время вставки
+    """
+    started = time.perf_counter()
+    stats = {"read": 0, "inserted": 0, "duplicates": 0, "invalid": 0, "renumbered": 0}
+
+    try:
+        with session_scope() as db:
+            if use_copy is None:
+                use_copy = db.get_bind().dialect.name == "postgresql"
+
+            seen, taken_ids, inserted_ids = set(), set(), []
+            for song_id, value in db.query(Song.id, Song.content_hash).yield_per(10000):
+                taken_ids.add(song_id)
+                if value:
+                    seen.add(value)
+
+            # Песни с id из файла и песни, которым id назначит база
+            batch, new_batch = [], []
+
+            def write(rows, columns):
+                if use_copy:
+                    _copy_rows(db, rows, columns)
+                else:
+                    db.execute(insert(Song), rows)
+
+            def flush():
+                if not batch and not new_batch:
+                    return
+                if batch:
+                    write(batch, ID_COLUMNS)
+                    _reset_id_sequence(db)
+                    inserted_ids.extend(row["id"] for row in batch)
+                if new_batch:
+                    last_id = db.query(func.max(Song.id)).scalar() or 0
+                    write(new_batch, COLUMNS)
+                    # Новые id заняты: песня ниже в файле с таким id получит другой
+                    new_ids = [song_id for (song_id,) in db.query(Song.id).filter(Song.id > last_id)]
+                    taken_ids.update(new_ids)
+                    inserted_ids.extend(new_ids)
+                db.commit()
+                stats["inserted"] += len(batch) + len(new_batch)
+                batch.clear()
+                new_batch.clear()
+
+            for item in read_songs(filename):
+                stats["read"] += 1
+                row = _prepare_row(item)
+                if row is None:
+                    stats["invalid"] += 1
+                    continue
+                if row["content_hash"] in seen:
+                    stats["duplicates"] += 1
+                    continue
+                seen.add(row["content_hash"])
+                song_id = _song_id(item) if keep_ids else None
+                if song_id is not None and song_id in taken_ids:
+                    stats["renumbered"] += 1
+                    song_id = None
+                if song_id is None:
+                    new_batch.append(row)
+                else:
+                    taken_ids.add(song_id)
+                    batch.append(dict(row, id=song_id))
+                if len(batch) + len(new_batch) >= batch_size:
+                    flush()
+            flush()
+            if stats["inserted"]:
+                notify_bulk_change(db)
+
+            stats["seconds"] = time.perf_counter() - started
+            rate = stats["inserted"] / stats["seconds"] if stats["seconds"] else 0
+            print(
+                f"Импортировано {stats['inserted']} из {stats['read']} песен за {stats['seconds']:.2f} с "
+                f"({rate:.0f} песен/с), дубликатов: {stats['duplicates']}, некорректных: {stats['invalid']}, "
+                f"с новым id из-за занятого: {stats['renumbered']}"
+            )
+
+        if fingerprints and inserted_ids:
+            started = time.perf_counter()
+            stats["fingerprinted"] = migrate_fingerprints(song_ids=inserted_ids)
+            stats["fingerprint_seconds"] = time.perf_counter() - started
+            print(f"Отпечатки для поиска дубликатов: {stats['fingerprinted']} песен за {stats['fingerprint_seconds']:.2f} с")
+        return stats
+
+    except Exception as e:
+        print(f"Ошибка при импорте данных: {e}")
+        raise
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Импорт песен из файла экспорта")
+    parser.add_argument("filename", nargs="?", default="folk_songs_backup.json")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--no-copy", action="store_true", help="не использовать COPY на PostgreSQL")
+    parser.add_argument("--new-ids", action="store_true", help="не сохранять id из файла, нумеровать песни заново")
+    parser.add_argument("--fingerprints", action="store_true",
+                        help="сразу построить отпечатки для поиска дубликатов (иначе - при следующем запуске бота)")
+    args = parser.parse_args()
+
+    init_db()
+    import_songs(args.filename, batch_size=args.batch_size, use_copy=False if args.no_copy else None,
+                 keep_ids=not args.new_ids, fingerprints=args.fingerprints)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+
+from cache import LRUCache, normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд ждать следующего символа, прежде чем искать
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.3"))
+# Сколько секунд хранить ответ на запрос (и сколько его хранит Telegram)
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "30"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "5000"))
+# Максимальное время поиска; если не успели, отвечаем пустым списком
+INLINE_TIMEOUT = float(os.getenv("INLINE_TIMEOUT", "2"))
+
+class InlineSearch:
+    """
+    Ответы на inline-запросы (@bot запрос) с задержкой и отменой.
+
+    Telegram присылает новый inline-запрос почти на каждый введенный символ.
+    Поиск запускается отдельной задачей через debounce секунд после запроса;
+    следующий запрос того же пользователя отменяет предыдущую задачу, поэтому
+    промежуточные варианты не доходят до базы. Ответы хранятся ttl секунд по
+    ключу (запрос, смещение): повторный и пролистанный назад запрос
+    отвечается сразу. Поиск ограничен timeout секундами.
+
+    search(query, offset) - корутина, возвращающая (results, next_offset).
+    """
+
+    def __init__(self, search, debounce: float = INLINE_DEBOUNCE, ttl: float = INLINE_CACHE_TTL,
+                 maxsize: int = INLINE_CACHE_SIZE, timeout: float = INLINE_TIMEOUT):
+        self.search = search
+        self.debounce = debounce
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache = LRUCache(maxsize, ttl)
+        self._tasks = {}
+        self.queries = 0
+        self.answered = 0
+        self.cancelled = 0
+        self.timeouts = 0
+
+    async def handle(self, update, context) -> None:
+        """Обработчик InlineQueryHandler: запускает ответ в отдельной задаче и сразу возвращается"""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+        self.queries += 1
+        previous = self._tasks.pop(user_id, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.cancelled += 1
+        # Задача не держит очередь обновлений пользователя, иначе следующий запрос
+        # не смог бы отменить текущий
+        task = context.application.create_task(self._answer(inline_query), update=update)
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda done: self._forget(user_id, done))
+
+    def _forget(self, user_id: int, task):
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    async def _answer(self, inline_query):
+        key = (normalize_query(inline_query.query) or "", inline_query.offset)
+        cached = self.cache.get(key)
+        if cached is None:
+            await asyncio.sleep(self.debounce)
+            try:
+                cached = await asyncio.wait_for(self.search(key[0], key[1]), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning(f"Inline-запрос '{key[0]}' не выполнен за {self.timeout} с")
+                await inline_query.answer([], cache_time=0)
+                return
+            self.cache.set(key, cached)
+        results, next_offset = cached
+        await inline_query.answer(results, cache_time=int(self.ttl), next_offset=next_offset)
+        self.answered += 1
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "answered": self.answered,
+            "cancelled": self.cancelled,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._tasks),
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses
+        }
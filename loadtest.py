@@ -0,0 +1,794 @@
+"""
+Нагрузочный тест bot.py и admin.py без сети.
+
+Application собирается обычным build_application, но запросы к Bot API уходят
+в FakeBotAPI, а обновления от виртуальных пользователей кладутся прямо в
+update_queue. Каждый пользователь проходит сценарии (поиск по тексту, /all,
+нажатия на песни, добавление песни) с паузами между шагами и ждет, пока бот
+обработает очередное обновление.
+
+Транспорт (--transport) задает, как обновления попадают в бота: queue -
+прямо в update_queue, webhook - POST-запросом с JSON обновления на
+WebhookServer под uvicorn, polling - ответом на getUpdates, который
+запрашивает Updater бота. С несколькими транспортами каждый прогоняется
+в отдельном процессе на одной базе, и печатается сравнение.
+
+    python loadtest.py --bot bot --users 100 --duration 60 --db sqlite --seed-size 10000
+    python loadtest.py --transport queue webhook polling --users 200 --think-time 0
+    python loadtest.py --offload-latency 0.05 0.2 0.5 1.0 --duration 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from telegram.request import BaseRequest
+
+# Доли сценариев по умолчанию (в процентах)
+DEFAULT_MIX = {"search_text": 40, "all": 30, "song_tap": 25, "add": 5}
+# Сколько секунд ждать обработки одного обновления
+STEP_TIMEOUT = 30
+TRANSPORTS = ("queue", "webhook", "polling")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Loadtest", "username": "loadtest_bot"}
+
+class FakeBotAPI(BaseRequest):
+    """
+    Заменяет HTTP-клиент бота: отвечает на методы Bot API правдоподобным JSON
+    после искусственной задержки latency (время ответа Telegram).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.last_markup = {}
+        self._message_ids = itertools.count(1)
+        self._pending = []
+        self._pending_ready = asyncio.Event()
+
+    def push_update(self, data: dict):
+        """Обновление, которое вернет следующий getUpdates (транспорт polling)"""
+        self._pending.append(data)
+        self._pending_ready.set()
+
+    async def _get_updates(self, params):
+        """Long polling: ждет обновлений не дольше timeout секунд"""
+        if not self._pending:
+            self._pending_ready.clear()
+            try:
+                await asyncio.wait_for(self._pending_ready.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        updates, self._pending = self._pending[:limit], self._pending[limit:]
+        return updates
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params):
+        message = {
+            "message_id": params.get("message_id") or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", "")
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+            self.last_markup[message["chat"]["id"]] = message
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        bot_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[bot_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if bot_method == "getMe":
+            result = BOT_USER
+        elif bot_method == "getUpdates":
+            result = await self._get_updates(params)
+        elif bot_method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+class UpdateFactory:
+    """Синтетические обновления Telegram в виде JSON"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+
+    @staticmethod
+    def user(user_id: int):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message(self, user_id: int, text: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str, message=None):
+        if message is None:
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": ""
+            }
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": message
+            }
+        }
+
+    def inline_query(self, user_id: int, query: str, offset: str = ""):
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "inline_query": {"id": str(update_id), "from": self.user(user_id), "query": query, "offset": offset}
+        }
+
+class CompletionTracker:
+    """Сообщает виртуальному пользователю, что обработчик его обновления завершился"""
+
+    def __init__(self):
+        self._waiters = {}
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[update_id] = future
+        return future
+
+    def done(self, update_id: int):
+        future = self._waiters.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def instrument(self, application):
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = self._wrap(handler.callback)
+
+    def _wrap(self, callback):
+        async def wrapper(update, context):
+            try:
+                return await callback(update, context)
+            finally:
+                self.done(update.update_id)
+        return wrapper
+
+def routing_user(data: dict) -> int:
+    """id пользователя, от которого пришло синтетическое обновление"""
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+def _steps(bot_name: str, scenario: str, corpus_rng: random.Random, corpus):
+    """Шаги сценария: ("message", текст), ("tap", префикс callback-данных) или ("tap_id", None)"""
+    song = corpus_rng.choice(corpus)
+    words = song["text"].split()
+    start = corpus_rng.randrange(max(1, len(words) - 2))
+    phrase = " ".join(word.strip(",.!") for word in words[start:start + 2])
+    category, _, place = song["region"].partition("|")
+
+    if scenario == "search_text":
+        return [("message", "/search_text"), ("message", phrase), ("tap", "song_")]
+    if scenario == "all":
+        command = "/all" if bot_name == "bot" else "/list"
+        return [("message", command), ("tap", "page_"), ("tap", "song_")]
+    if scenario == "song_tap":
+        return [("tap_id", None)]
+    if scenario == "add":
+        if bot_name == "bot":
+            return [("message", "/add"), ("message", song["title"]), ("message", category),
+                    ("message", place or "."), ("message", song["text"])]
+        return [("message", "/add"), ("message", song["title"]), ("message", song["region"]),
+                ("message", song["text"])]
+    raise ValueError(f"Неизвестный сценарий: {scenario}")
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+class LoadTest:
+    def __init__(self, bot_name: str, application, api: FakeBotAPI, song_ids, corpus, mix, users: int,
+                 duration: float, think_time: float, seed: int, transport: str = "queue", updates_api=None):
+        self.bot_name = bot_name
+        self.transport = transport
+        self.updates_api = updates_api
+        self.server = None
+        self.port = None
+        self.connections = {}
+        self.secret = secrets.token_hex(16)
+        self.rejected = 0
+        self.errors = Counter()
+        self.application = application
+        self.api = api
+        self.song_ids = song_ids
+        self.corpus = corpus
+        self.mix = mix
+        self.users = users
+        self.duration = duration
+        self.think_time = think_time
+        self.seed = seed
+        self.factory = UpdateFactory()
+        self.tracker = CompletionTracker()
+        self.latencies = defaultdict(list)
+        self.timeouts = Counter()
+        self.scenarios = Counter()
+        self.pool_samples = []
+
+    async def _deliver(self, data: dict) -> bool:
+        """Передает обновление боту выбранным транспортом; False, если бот его не принял"""
+        if self.transport == "webhook":
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            while True:
+                status = await self._post(routing_user(data), body)
+                if status != 503:
+                    break
+                # Как Telegram: повторить доставку, пока сервер перегружен
+                self.rejected += 1
+                await asyncio.sleep(0.05)
+            if status != 200:
+                self.errors[status] += 1
+                return False
+        elif self.transport == "polling":
+            self.updates_api.push_update(data)
+        else:
+            from telegram import Update
+
+            await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        return True
+
+    async def _post(self, user_id: int, body: bytes) -> int:
+        """
+        POST /webhook/<бот> по постоянному соединению пользователя. Простой
+        клиент HTTP/1.1 вместо httpx: нагрузочный тест работает в одном
+        процессе с сервером, и тяжелый клиент занимал бы его процессор.
+        """
+        connection = self.connections.get(user_id)
+        if connection is None:
+            connection = self.connections[user_id] = await asyncio.open_connection("127.0.0.1", self.port)
+        reader, writer = connection
+        writer.write(
+            f"POST /webhook/{self.bot_name} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+            f"Content-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: {self.secret}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        await reader.readexactly(length)
+        return status
+
+    async def _send(self, label: str, data) -> None:
+        update_id = data["update_id"]
+        future = self.tracker.expect(update_id)
+        started = time.perf_counter()
+        if not await self._deliver(data):
+            self.tracker.done(update_id)
+            return
+        try:
+            await asyncio.wait_for(future, STEP_TIMEOUT)
+            self.latencies[label].append(time.perf_counter() - started)
+        except asyncio.TimeoutError:
+            self.tracker.done(update_id)
+            self.timeouts[label] += 1
+
+    async def _user(self, user_id: int, deadline: float):
+        rng = random.Random(self.seed * 100_003 + user_id)
+        scenarios, weights = zip(*self.mix.items())
+        while time.monotonic() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            self.scenarios[scenario] += 1
+            for kind, value in _steps(self.bot_name, scenario, rng, self.corpus):
+                if kind == "message":
+                    label = value if value.startswith("/") else f"message:{scenario}"
+                    await self._send(label, self.factory.message(user_id, value))
+                elif kind == "tap_id":
+                    await self._send("tap:song_", self.factory.callback(user_id, f"song_{rng.choice(self.song_ids)}"))
+                else:
+                    message = self.api.last_markup.get(user_id)
+                    buttons = [
+                        button["callback_data"]
+                        for row in (message or {}).get("reply_markup", {}).get("inline_keyboard", [])
+                        for button in row if button.get("callback_data", "").startswith(value)
+                    ]
+                    if not buttons:
+                        continue
+                    await self._send(f"tap:{value}", self.factory.callback(user_id, rng.choice(buttons), message))
+                await asyncio.sleep(rng.expovariate(1 / self.think_time) if self.think_time else 0)
+
+    async def _sample_pool(self, deadline: float):
+        from database import get_pool_stats
+
+        while time.monotonic() < deadline:
+            self.pool_samples.append(get_pool_stats()["checked_out"])
+            await asyncio.sleep(0.2)
+
+    async def _start(self):
+        if self.transport == "webhook":
+            import uvicorn
+            from webhook import WebhookServer
+
+            # Сервер сам запускает Application (lifespan), как в режиме BOT_MODE=webhook
+            app = WebhookServer({self.bot_name: self.application}, secret_token=self.secret, webhook_url="",
+                                metrics_port=None)
+            self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, lifespan="on",
+                                                        log_level="warning"))
+            serving = asyncio.create_task(self.server.serve())
+            while not self.server.started:
+                if serving.done():
+                    serving.result()
+                    raise RuntimeError("Webhook-сервер не запустился")
+                await asyncio.sleep(0.01)
+            self._serving = serving
+            self.port = self.server.servers[0].sockets[0].getsockname()[1]
+            return
+        await self.application.initialize()
+        await self.application.start()
+        if self.transport == "polling":
+            await self.application.updater.start_polling(poll_interval=0.0, timeout=10)
+
+    async def _stop(self):
+        if self.transport == "webhook":
+            for _, writer in self.connections.values():
+                writer.close()
+            self.server.should_exit = True
+            await self._serving
+            return
+        if self.transport == "polling":
+            await self.application.updater.stop()
+        await self.application.stop()
+        await self.application.shutdown()
+
+    async def run(self):
+        from database import get_pool_stats
+
+        self.tracker.instrument(self.application)
+        await self._start()
+        pool_before = get_pool_stats()
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.duration
+        try:
+            await asyncio.gather(
+                self._sample_pool(deadline),
+                *(self._user(100_000 + i, deadline) for i in range(self.users))
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            await self._stop()
+        return self.report(elapsed, pool_before, get_pool_stats())
+
+    def report(self, elapsed: float, pool_before: dict, pool_after: dict) -> dict:
+        all_latencies = [value for values in self.latencies.values() for value in values]
+
+        def summary(values):
+            return {
+                "count": len(values),
+                "p50_ms": round(_percentile(values, 50) * 1000, 2) if values else None,
+                "p90_ms": round(_percentile(values, 90) * 1000, 2) if values else None,
+                "p95_ms": round(_percentile(values, 95) * 1000, 2) if values else None,
+                "p99_ms": round(_percentile(values, 99) * 1000, 2) if values else None,
+                "max_ms": round(max(values) * 1000, 2) if values else None
+            }
+
+        checkouts = pool_after["checkouts"] - pool_before["checkouts"]
+        wait_total = pool_after["wait_seconds_total"] - pool_before["wait_seconds_total"]
+        return {
+            "bot": self.bot_name,
+            "transport": self.transport,
+            "users": self.users,
+            "duration_s": round(elapsed, 2),
+            "updates": len(all_latencies),
+            "throughput_per_s": round(len(all_latencies) / elapsed, 2),
+            "timeouts": dict(self.timeouts),
+            "webhook_rejected": self.rejected,
+            "delivery_errors": dict(self.errors),
+            "scenarios": dict(self.scenarios),
+            "latency": summary(all_latencies),
+            "steps": {label: summary(values) for label, values in sorted(self.latencies.items())},
+            "bot_api_calls": dict(self.api.calls),
+            "db_pool": {
+                "checkouts": checkouts,
+                "max_checked_out": max(self.pool_samples, default=0),
+                "mean_checked_out": round(sum(self.pool_samples) / len(self.pool_samples), 2)
+                if self.pool_samples else 0,
+                "wait_seconds_total": round(wait_total, 3),
+                "wait_seconds_max": round(pool_after["wait_seconds_max"], 3),
+                "status": pool_after["pool_status"]
+            },
+            "update_processor": self.application.update_processor.stats()
+        }
+
+async def soak_pool(requests: int, concurrency: int, song_ids, seed: int = 0) -> dict:
+    """
+    Долгий прогон пула соединений: requests вызовов run_db, не больше
+    concurrency одновременно. Чтение песни, поиск по тексту и каждый сотый
+    вызов с ошибкой после запроса. Соединения не должны утекать: после прогона
+    занятых нет, выдач столько же, сколько возвратов, одновременно занято не
+    больше DB_EXECUTOR_WORKERS, новые соединения открываются только до
+    заполнения пула.
+    """
+    from async_database import DB_EXECUTOR_WORKERS, run_db
+    from database import Song, get_pool_stats, get_song_by_id, search_by_text
+
+    def failing_call(db, song_id):
+        db.query(Song.id).filter(Song.id == song_id).first()
+        raise ValueError("ошибка после запроса")
+
+    rng = random.Random(seed)
+    calls = iter(range(requests))
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        for number in calls:
+            try:
+                if number % 100 == 99:
+                    await run_db(failing_call, rng.choice(song_ids))
+                elif number % 10 == 9:
+                    await run_db(search_by_text, "калина", limit=10)
+                else:
+                    await run_db(get_song_by_id, rng.choice(song_ids))
+            except ValueError:
+                errors += 1
+
+    before = get_pool_stats()
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    after = get_pool_stats()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "requests_per_s": round(requests / elapsed, 1),
+        "checkouts": after["checkouts"] - before["checkouts"],
+        "checkins": after["checkins"] - before["checkins"],
+        "checked_out_after": after["checked_out"],
+        "max_checked_out": after["max_checked_out"],
+        "max_allowed": DB_EXECUTOR_WORKERS,
+        "new_connections": after["connects"] - before["connects"],
+        "wait_seconds_max": round(after["wait_seconds_max"], 4),
+        "pool_status": after["pool_status"]
+    }
+
+def print_soak_report(report: dict):
+    print(
+        f"Пул БД: {report['requests']} вызовов (ошибок {report['errors']}) за {report['seconds']} с, "
+        f"{report['requests_per_s']} вызовов/с"
+    )
+    print(
+        f"Выдач {report['checkouts']}, возвратов {report['checkins']}, занято после прогона "
+        f"{report['checked_out_after']}, максимум одновременно {report['max_checked_out']} "
+        f"(потоков {report['max_allowed']}), новых соединений {report['new_connections']}"
+    )
+
+def _slow_query(db, seconds: float):
+    """Медленный запрос: pg_sleep на PostgreSQL, на SQLite запрос и пауза с занятым соединением"""
+    from database import Song, func
+
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(func.pg_sleep(seconds).select())
+    else:
+        db.query(func.count(Song.id)).scalar()
+        time.sleep(seconds)
+
+async def offload_latency(mode: str, slow_seconds: float, song_ids, duration: float = 5.0, rate: float = 200,
+                          slow_interval: float = 1.0, seed: int = 0) -> dict:
+    """
+    Задержка быстрых запросов (get_song_by_id) на фоне медленных.
+
+    Быстрые запросы приходят с частотой rate в секунду независимо от того,
+    обслужены ли предыдущие, задержка считается от запланированного времени
+    прихода. Раз в slow_interval секунд выполняется запрос на slow_seconds.
+    mode="blocking" вызывает базу прямо в event loop, как обработчики до
+    run_db; mode="offloaded" - через run_db. В первом случае p99 растет
+    вместе с самым медленным запросом, во втором от него не зависит.
+    """
+    from async_database import DB_EXECUTOR_WORKERS, _call_with_session, run_db
+    from database import get_song_by_id
+
+    if mode == "blocking":
+        async def call(fn, *args):
+            return _call_with_session(fn, args, {})
+    else:
+        call = run_db
+
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    latencies = []
+    slow_latencies = []
+
+    async def fast(scheduled: float):
+        await call(get_song_by_id, rng.choice(song_ids))
+        latencies.append(loop.time() - scheduled)
+
+    async def slow(scheduled: float):
+        await call(_slow_query, slow_seconds)
+        slow_latencies.append(loop.time() - scheduled)
+
+    # Соединения и потоки открываются до замера
+    await asyncio.gather(*(run_db(get_song_by_id, song_ids[0]) for _ in range(DB_EXECUTOR_WORKERS)))
+    started = loop.time()
+    tasks = []
+    fast_count = int(duration * rate)
+    arrivals = sorted(
+        [(started + number / rate, fast) for number in range(fast_count)]
+        + [(started + slow_interval * (number + 0.5), slow) for number in range(int(duration / slow_interval))],
+        key=lambda item: item[0]
+    )
+    for scheduled, request in arrivals:
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(request(scheduled)))
+    await asyncio.gather(*tasks)
+    return {
+        "mode": mode,
+        "slow_seconds": slow_seconds,
+        "requests": len(latencies),
+        "slow_requests": len(slow_latencies),
+        "p50": round(_percentile(latencies, 50), 4),
+        "p99": round(_percentile(latencies, 99), 4),
+        "max": round(max(latencies), 4)
+    }
+
+def compare_offload(slow_seconds, song_ids, duration: float = 5.0, rate: float = 200) -> list:
+    """Прогоняет offload_latency в обоих режимах для каждой длительности медленного запроса"""
+    reports = []
+    for seconds in slow_seconds:
+        for mode in ("blocking", "offloaded"):
+            report = asyncio.run(offload_latency(mode, seconds, song_ids, duration, rate))
+            reports.append(report)
+            print(
+                f"медленный запрос {seconds:.3f} с, {mode:9}: p50 {report['p50'] * 1000:.1f} мс, "
+                f"p99 {report['p99'] * 1000:.1f} мс, максимум {report['max'] * 1000:.1f} мс "
+                f"({report['requests']} быстрых, {report['slow_requests']} медленных)"
+            )
+    return reports
+
+def seed_database(size: int, seed: int):
+    """Заполняет пустую базу синтетическим архивом"""
+    import contextlib
+    from benchmark import generate_corpus
+    from database import SessionLocal, Song, init_db
+    from importscript import import_songs
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if db.query(Song).count():
+            return
+    finally:
+        db.close()
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        for item in generate_corpus(size, seed):
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            import_songs(f.name)
+    finally:
+        os.remove(f.name)
+
+def _parse_mix(value: str):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+def print_report(report: dict):
+    latency = report["latency"]
+    print(
+        f"{report['bot']} ({report['transport']}): {report['users']} пользователей, {report['duration_s']} с, "
+        f"{report['updates']} обновлений, {report['throughput_per_s']} обн./с"
+    )
+    print(
+        f"Задержка: p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, "
+        f"p99 {latency['p99_ms']} мс, максимум {latency['max_ms']} мс"
+    )
+    for label, step in report["steps"].items():
+        print(f"  {label:24} {step['count']:>7}  p50 {step['p50_ms']:>8} мс  p95 {step['p95_ms']:>8} мс")
+    if report["timeouts"]:
+        print(f"Не дождались ответа: {report['timeouts']}")
+    if report["webhook_rejected"] or report["delivery_errors"]:
+        print(f"Webhook: отказов 503 {report['webhook_rejected']}, ошибок доставки {report['delivery_errors']}")
+    pool = report["db_pool"]
+    print(
+        f"Пул БД: занято в среднем {pool['mean_checked_out']}, максимум {pool['max_checked_out']}, "
+        f"ожидание соединений {pool['wait_seconds_total']} с (максимум {pool['wait_seconds_max']} с)"
+    )
+
+def build_load_test(bot_name: str, transport: str = "queue", users: int = 50, duration: float = 30,
+                    think_time: float = 1.0, api_latency: float = 0.05, mix=DEFAULT_MIX, seed: int = 0,
+                    corpus_size: int = 1000) -> LoadTest:
+    """Собирает Application бота с поддельным Bot API и LoadTest для транспорта transport"""
+    from telegram.ext import Application
+    from benchmark import generate_corpus
+    from database import SessionLocal, Song
+
+    module = __import__(bot_name)
+    api = FakeBotAPI(api_latency)
+    builder = Application.builder().request(api)
+    updates_api = None
+    if transport == "polling":
+        updates_api = FakeBotAPI(api_latency)
+        builder = builder.get_updates_request(updates_api)
+    else:
+        builder = builder.updater(None)
+    application = module.build_application(builder)
+
+    db = SessionLocal()
+    try:
+        song_ids = [row[0] for row in db.query(Song.id).all()]
+    finally:
+        db.close()
+
+    return LoadTest(
+        bot_name, application, api, song_ids, generate_corpus(corpus_size, seed),
+        mix, users, duration, think_time, seed, transport=transport, updates_api=updates_api
+    )
+
+def compare_transports(args) -> dict:
+    """Прогоняет каждый транспорт в отдельном процессе на одной базе и печатает сравнение"""
+    reports = {}
+    for transport in args.transport:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            output = f.name
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--bot", args.bot, "--users", str(args.users), "--duration", str(args.duration),
+            "--think-time", str(args.think_time), "--api-latency", str(args.api_latency),
+            "--mix", ",".join(f"{name}={weight}" for name, weight in args.mix.items()),
+            "--db", os.environ["DATABASE_URL"], "--seed-size", str(args.seed_size), "--seed", str(args.seed),
+            "--transport", transport, "--output", output
+        ]
+        try:
+            subprocess.run(command, check=True)
+            with open(output, encoding="utf-8") as f:
+                reports[transport] = json.load(f)
+        finally:
+            os.remove(output)
+
+    print("\nСравнение транспортов:")
+    for transport, report in reports.items():
+        latency = report["latency"]
+        print(
+            f"  {transport:8} {report['throughput_per_s']:>9} обн./с  p50 {latency['p50_ms']:>8} мс  "
+            f"p99 {latency['p99_ms']:>8} мс  отказов webhook {report['webhook_rejected']}"
+        )
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест bot.py и admin.py с поддельным Bot API")
+    parser.add_argument("--bot", choices=("bot", "admin"), default="bot")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="секунд")
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза пользователя между шагами, с")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX,
+                        help="доли сценариев, например search_text=40,all=30,song_tap=25,add=5")
+    parser.add_argument("--db", default="sqlite",
+                        help="'sqlite' (временный файл) или URL тестовой базы; /add пишет в нее песни")
+    parser.add_argument("--seed-size", type=int, default=5000, help="размер синтетического архива для пустой базы")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="записать отчет в JSON")
+    parser.add_argument("--soak", type=int, metavar="N",
+                        help="вместо сценариев бота: N вызовов run_db и проверка, что пул не теряет соединения")
+    parser.add_argument("--soak-concurrency", type=int, default=64)
+    parser.add_argument("--offload-latency", type=float, nargs="+", metavar="SECONDS",
+                        help="вместо сценариев бота: p99 быстрых запросов при медленных запросах такой длительности, "
+                             "вызовы в event loop против run_db")
+    parser.add_argument("--transport", choices=TRANSPORTS, nargs="+", default=["queue"],
+                        help="как обновления попадают в бота; несколько - сравнить")
+    args = parser.parse_args()
+
+    tmp = None
+    if args.db == "sqlite":
+        tmp = tempfile.TemporaryDirectory()
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'loadtest.db')}"
+    else:
+        os.environ["DATABASE_URL"] = args.db
+    # Эндпоинт /metrics процесса не нужен; с транспортом webhook post_init вызывается, режим webhook исключает его
+    os.environ.setdefault("BOT_MODE", "webhook")
+
+    seed_database(args.seed_size, args.seed)
+
+    if args.soak or args.offload_latency:
+        from database import SessionLocal, Song
+
+        db = SessionLocal()
+        try:
+            song_ids = [row[0] for row in db.query(Song.id).all()]
+        finally:
+            db.close()
+
+    if args.offload_latency:
+        reports = compare_offload(args.offload_latency, song_ids, args.duration)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(reports, f, ensure_ascii=False, indent=2)
+        if tmp is not None:
+            tmp.cleanup()
+        return
+
+    if args.soak:
+        report = asyncio.run(soak_pool(args.soak, args.soak_concurrency, song_ids, args.seed))
+        print_soak_report(report)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if tmp is not None:
+            tmp.cleanup()
+        return
+
+    if len(args.transport) > 1:
+        reports = compare_transports(args)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(reports, f, ensure_ascii=False, indent=2)
+        if tmp is not None:
+            tmp.cleanup()
+        return
+
+    test = build_load_test(
+        args.bot, args.transport[0], args.users, args.duration, args.think_time, args.api_latency,
+        args.mix, args.seed, min(args.seed_size, 1000)
+    )
+    report = asyncio.run(test.run())
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if tmp is not None:
+        tmp.cleanup()
+
+if __name__ == "__main__":
+    main()
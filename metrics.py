@@ -0,0 +1,282 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Адрес HTTP-эндпоинта /metrics (локальный, для Prometheus)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Границы корзин гистограмм: секунды и число строк
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 500, 1000, 10000)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {"type": "counter", "values": dict(self._values)}
+
+    def merge(self, snapshots):
+        """Сумма снимков нескольких процессов"""
+        values = defaultdict(float)
+        for snapshot in snapshots:
+            for labels, value in snapshot["values"].items():
+                values[labels] += value
+        return {"type": "counter", "values": dict(values)}
+
+    def render(self, snapshot):
+        for labels, value in sorted(snapshot["values"].items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * len(self.buckets), [0, 0.0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            total[0] += 1
+            total[1] += value
+            self._values[labels] = (counts, total)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "type": "histogram",
+                "values": {labels: (list(counts), list(total)) for labels, (counts, total) in self._values.items()}
+            }
+
+    def merge(self, snapshots):
+        """Сумма снимков нескольких процессов: корзины, число и сумма наблюдений"""
+        values = {}
+        for snapshot in snapshots:
+            for labels, (counts, (count, total)) in snapshot["values"].items():
+                merged_counts, merged_total = values.setdefault(labels, ([0] * len(self.buckets), [0, 0.0]))
+                for i, bucket_count in enumerate(counts):
+                    merged_counts[i] += bucket_count
+                merged_total[0] += count
+                merged_total[1] += total
+        return {"type": "histogram", "values": values}
+
+    def render(self, snapshot):
+        for labels, (counts, (count, total)) in sorted(snapshot["values"].items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {bucket_count}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+
+class Registry:
+    """Набор метрик процесса и функций, возвращающих текущие значения (gauge)"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = {}
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, name: str, documentation: str, collect):
+        """
+        collect() возвращает словарь {значение метки stat: число} для gauge name{stat="..."}.
+        Повторная регистрация с тем же именем заменяет прежнюю функцию.
+        """
+        self.collectors[name] = (documentation, collect)
+
+    def snapshot(self):
+        """Значения всех метрик и коллекторов процесса (можно передать в другой процесс)"""
+        collected = {}
+        for name, (documentation, collect) in list(self.collectors.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрики {name}: {e}")
+                continue
+            collected[name] = (
+                documentation,
+                {stat: value for stat, value in values.items() if isinstance(value, (int, float))}
+            )
+        return {"metrics": {metric.name: metric.snapshot() for metric in self.metrics}, "collectors": collected}
+
+    def render(self, snapshots=None) -> str:
+        """
+        Метрики в текстовом формате Prometheus. snapshots - снимки нескольких
+        процессов {имя процесса: snapshot()}: счетчики и гистограммы суммируются,
+        gauge выводятся для каждого процесса с меткой worker.
+        """
+        if snapshots is None:
+            snapshots = {None: self.snapshot()}
+        lines = []
+        for metric in self.metrics:
+            kind = "counter" if isinstance(metric, Counter) else "histogram"
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            merged = metric.merge([
+                snapshot["metrics"][metric.name] for snapshot in snapshots.values()
+                if metric.name in snapshot["metrics"]
+            ])
+            lines.extend(metric.render(merged))
+
+        names = {}
+        for snapshot in snapshots.values():
+            for name, (documentation, _) in snapshot["collectors"].items():
+                names.setdefault(name, documentation)
+        for name, documentation in names.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for worker, snapshot in snapshots.items():
+                if name not in snapshot["collectors"]:
+                    continue
+                extra = [] if worker is None else [("worker", worker)]
+                for stat, value in sorted(snapshot["collectors"][name][1].items()):
+                    lines.append(f"{name}{_format_labels(('stat',), (stat,), extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+handler_latency = REGISTRY.histogram(
+    "bot_handler_seconds", "Время обработки обновления", ["bot", "handler"]
+)
+handler_errors = REGISTRY.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ["bot", "handler"]
+)
+db_query_latency = REGISTRY.histogram(
+    "db_query_seconds", "Время выполнения функций database.py", ["function"]
+)
+db_result_size = REGISTRY.histogram(
+    "db_result_rows", "Число песен в результате функций database.py", ["function"], buckets=SIZE_BUCKETS
+)
+db_errors = REGISTRY.counter(
+    "db_errors_total", "Ошибки в функциях database.py", ["function"]
+)
+log_errors = REGISTRY.counter(
+    "log_errors_total", "Сообщения уровня ERROR в логах (обработчики перехватывают свои исключения)", ["logger"]
+)
+
+class _ErrorCountingHandler(logging.Handler):
+    def emit(self, record):
+        log_errors.inc(record.name)
+
+logging.getLogger().addHandler(_ErrorCountingHandler(level=logging.ERROR))
+
+def result_size(result):
+    """Число песен в результате: список, страница (Page) или одна песня"""
+    if result is None:
+        return 0
+    songs = getattr(result, "songs", result)
+    if isinstance(songs, (list, tuple)):
+        return len(songs)
+    return 1
+
+def observe_db_call(function: str, seconds: float, result=None, error: bool = False):
+    db_query_latency.observe(seconds, function)
+    if error:
+        db_errors.inc(function)
+    elif not isinstance(result, (bool, int)):
+        db_result_size.observe(result_size(result), function)
+
+def handler_label(handler, update, context) -> str:
+    """
+    Имя обработчика для метрик: команда (/search_text), префикс callback-данных
+    (song_, page_) или состояние диалога для обычных сообщений (message:search_text).
+    """
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query is not None and callback_query.data:
+        return callback_query.data.split("_")[0] + "_"
+    commands = getattr(handler, "commands", None)
+    if commands:
+        return "/" + sorted(commands)[0]
+    if getattr(update, "inline_query", None) is not None:
+        return "inline_query"
+    user_data = getattr(context, "user_data", None) or {}
+    state = user_data.get("awaiting_input") or user_data.get("state") or "none"
+    return f"message:{state}"
+
+def _timed_callback(bot_name: str, handler, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = handler_label(handler, update, context)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(bot_name, label)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, bot_name, label)
+    return wrapper
+
+def instrument_application(application, bot_name: str):
+    """Оборачивает все зарегистрированные обработчики замером времени и счетчиком ошибок"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = _timed_callback(bot_name, handler, handler.callback)
+
+async def _serve_metrics(reader, writer, render=REGISTRY.render):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = render().encode("utf-8")
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST, render=None):
+    """Запускает HTTP-эндпоинт /metrics в текущем event loop; render() возвращает текст метрик"""
+    handler = _serve_metrics if render is None else functools.partial(_serve_metrics, render=render)
+    server = await asyncio.start_server(handler, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
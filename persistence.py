@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_database import run_db
+from database import load_user_state, save_user_states, delete_user_state, prune_user_states
+
+logger = logging.getLogger(__name__)
+
+# Где хранить состояние диалогов: "sql" (таблица conversation_state) или "memory" (только в памяти процесса)
+USER_STATE_STORE = os.getenv("USER_STATE_STORE", "sql")
+# Как часто (в секундах) записывать измененные состояния в базу
+USER_STATE_FLUSH_INTERVAL = float(os.getenv("USER_STATE_FLUSH_INTERVAL", "5"))
+# Через сколько секунд без изменений диалог считается брошенным и удаляется
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", str(24 * 3600)))
+# Через сколько секунд без обновлений пользователь выгружается из памяти (запись в базе остается)
+USER_STATE_IDLE = float(os.getenv("USER_STATE_IDLE", "900"))
+# Сколько пользователей записывается в одной транзакции
+USER_STATE_BATCH_SIZE = int(os.getenv("USER_STATE_BATCH_SIZE", "500"))
+
+def _dump(data) -> str:
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+class SQLPersistence(BasePersistence):
+    """
+    Хранит context.user_data в таблице conversation_state.
+
+    При старте ничего не загружается: данные пользователя читаются из базы при
+    его первом обновлении (refresh_user_data), причем только если диалог моложе
+    ttl. Раз в update_interval секунд PTB передает измененные user_data, и все
+    они записываются одной транзакцией; неизменившиеся данные не пишутся.
+    Пользователи без обновлений дольше idle секунд выгружаются из памяти,
+    брошенные диалоги удаляются из базы.
+    """
+
+    def __init__(self, bot_name: str, ttl: float = USER_STATE_TTL, idle: float = USER_STATE_IDLE,
+                 update_interval: float = USER_STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.bot_name = bot_name
+        self.ttl = ttl
+        self.idle = idle
+        # Пользователи в памяти процесса: время последнего обновления
+        self._last_seen = {}
+        # JSON последней записи для пользователей, у которых есть запись в базе
+        self._written = {}
+        self._pending = {}
+        self._batch = None
+        self._evicted = set()
+        self._expiry_task = None
+        self.loads = 0
+        self.writes = 0
+        self.batches = 0
+        self.skipped = 0
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        if user_id not in self._last_seen:
+            data = await run_db(load_user_state, self.bot_name, user_id, self.ttl)
+            self.loads += 1
+            if data and not user_data:
+                user_data.update(data)
+                self._written[user_id] = _dump(data)
+        self._last_seen[user_id] = time.monotonic()
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        if (_dump(data) if data else None) == self._written.get(user_id):
+            self.skipped += 1
+            return
+        self._pending[user_id] = data
+        # Все вызовы из одного прохода update_persistence попадают в одну пачку
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._write_pending())
+        await asyncio.shield(self._batch)
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        self._batch = None
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), USER_STATE_BATCH_SIZE):
+            chunk = dict(items[start:start + USER_STATE_BATCH_SIZE])
+            try:
+                await run_db(save_user_states, self.bot_name, chunk)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояния {len(chunk)} пользователей: {e}")
+                for user_id, data in chunk.items():
+                    self._pending.setdefault(user_id, data)
+                continue
+            self.batches += 1
+            self.writes += len(chunk)
+            for user_id, data in chunk.items():
+                if data:
+                    self._written[user_id] = _dump(data)
+                else:
+                    self._written.pop(user_id, None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            # Пользователь выгружен из памяти по неактивности, его запись в базе нужна
+            self._evicted.discard(user_id)
+            return
+        self._pending.pop(user_id, None)
+        self._written.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+        await run_db(delete_user_state, self.bot_name, user_id)
+
+    async def evict_idle(self, application) -> int:
+        """
+        Выгружает из памяти пользователей без обновлений дольше idle секунд.
+        Сначала записывает изменения, которые PTB еще не передал: выгрузка
+        помечает пользователя к удалению, и PTB отбросил бы его запись.
+        Пользователи, чью запись сохранить не удалось, остаются в памяти.
+        """
+        await application.update_persistence()
+        now = time.monotonic()
+        idle = [
+            user_id for user_id, seen in list(self._last_seen.items())
+            if now - seen > self.idle and user_id not in self._pending
+        ]
+        for user_id in idle:
+            del self._last_seen[user_id]
+            self._written.pop(user_id, None)
+            self._evicted.add(user_id)
+            application.drop_user_data(user_id)
+        return len(idle)
+
+    async def _expire(self, application, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                evicted = await self.evict_idle(application)
+                pruned = await run_db(prune_user_states, self.ttl)
+                if evicted or pruned:
+                    logger.info(f"Выгружено из памяти {evicted} пользователей, удалено {pruned} брошенных диалогов")
+            except Exception as e:
+                logger.error(f"Ошибка при очистке состояний пользователей: {e}")
+
+    def start_expiry(self, application):
+        """Запускает периодическую выгрузку неактивных пользователей и удаление брошенных диалогов"""
+        if self._expiry_task is None:
+            interval = min(self.idle, self.ttl, 60)
+            self._expiry_task = asyncio.get_running_loop().create_task(self._expire(application, interval))
+
+    async def flush(self) -> None:
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+        if self._batch is not None:
+            await self._batch
+        if self._pending:
+            await self._write_pending()
+
+    def stats(self):
+        return {
+            "users_in_memory": len(self._last_seen),
+            "stored_dialogs": len(self._written),
+            "pending": len(self._pending),
+            "loads": self.loads,
+            "writes": self.writes,
+            "batches": self.batches,
+            "skipped": self.skipped
+        }
+
+    # Остальные данные (chat_data, bot_data, callback_data, ConversationHandler) не используются
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+def build_persistence(bot_name: str):
+    """SQLPersistence для бота или None, если состояние хранится только в памяти"""
+    if USER_STATE_STORE == "memory":
+        return None
+    return SQLPersistence(bot_name)
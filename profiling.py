@@ -0,0 +1,249 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from logging.handlers import RotatingFileHandler
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Включение профилирования запросов и его настройки
+SQL_PROFILING = os.getenv("SQL_PROFILING", "") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_BYTES = int(os.getenv("SLOW_QUERY_LOG_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+# EXPLAIN ANALYZE повторно выполняет запрос, поэтому включается отдельно (PostgreSQL)
+SLOW_QUERY_ANALYZE = os.getenv("SLOW_QUERY_ANALYZE", "") == "1"
+# Сколько медленных запросов может ждать построения плана; сверх этого план не строится
+SLOW_QUERY_EXPLAIN_QUEUE = int(os.getenv("SLOW_QUERY_EXPLAIN_QUEUE", "100"))
+
+# Модули, функции которых считаются «вызывающими» запрос
+CALLER_MODULES = ("database.py", "cache.py", "copyscript.py", "importscript.py")
+
+_local = threading.local()
+
+def redact_parameters(parameters):
+    """Заменяет значения параметров их типом и длиной: в лог не попадают тексты и запросы пользователей"""
+    if isinstance(parameters, dict):
+        return {key: redact_parameters(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if len(parameters) > 10:
+            return f"<{len(parameters)} наборов параметров>"
+        return [redact_parameters(value) for value in parameters]
+    if parameters is None or isinstance(parameters, (bool, int, float)):
+        return parameters
+    if isinstance(parameters, str):
+        return f"<str:{len(parameters)}>"
+    return f"<{type(parameters).__name__}>"
+
+def find_caller():
+    """
+    Функции из CALLER_MODULES в стеке вызовов, от внешней к внутренней:
+    "database.py:get_songs_page > _keyset_page"
+    """
+    names = []
+    module = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.endswith(CALLER_MODULES):
+            module = os.path.basename(filename)
+            names.append(frame.f_code.co_name)
+        elif names:
+            break
+        frame = frame.f_back
+    if not names:
+        return "unknown"
+    return f"{module}:" + " > ".join(reversed(names))
+
+def _explain(engine, statement, parameters, analyze: bool = False):
+    """План выполнения SELECT; на PostgreSQL EXPLAIN ANALYZE только при analyze=True"""
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS, FORMAT TEXT) " if analyze else "EXPLAIN (FORMAT TEXT) "
+    elif dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        return None
+    _local.explaining = True
+    try:
+        with engine.connect() as explain_connection:
+            cursor = explain_connection.connection.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+            finally:
+                cursor.close()
+    except Exception as e:
+        return f"EXPLAIN не выполнен: {e}"
+    finally:
+        _local.explaining = False
+
+class QueryProfiler:
+    """
+    Замеряет каждый SQL-запрос движка и записывает медленные (дольше threshold_ms)
+    в ротируемый JSON-лог вместе с планом выполнения.
+
+    План строится не в потоке запроса: медленный запрос кладется в очередь,
+    а фоновый поток выполняет для него EXPLAIN на своем соединении и пишет
+    запись в лог. Если очередь заполнена, запись пишется без плана.
+    """
+
+    def __init__(self, engine, threshold_ms: float = SLOW_QUERY_MS, log_path: str = SLOW_QUERY_LOG,
+                 explain: bool = True, analyze: bool = SLOW_QUERY_ANALYZE,
+                 explain_queue: int = SLOW_QUERY_EXPLAIN_QUEUE):
+        self.engine = engine
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.analyze = analyze
+        self.slow_queries = 0
+        self.plans_skipped = 0
+        self._queue = queue.Queue(maxsize=explain_queue)
+        self._worker = None
+        self.log = logging.getLogger("slow_queries")
+        self.log.propagate = False
+        if not self.log.handlers:
+            handler = RotatingFileHandler(
+                log_path, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
+
+    def attach(self):
+        if self.explain:
+            self._worker = threading.Thread(target=self._explain_worker, name="slow-query-explain", daemon=True)
+            self._worker.start()
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        event.listen(self.engine, "after_cursor_execute", self._after)
+        event.listen(self.engine, "handle_error", self._error)
+        logger.info(f"Профилирование SQL включено, порог {self.threshold * 1000:.0f} мс")
+
+    def detach(self):
+        event.remove(self.engine, "before_cursor_execute", self._before)
+        event.remove(self.engine, "after_cursor_execute", self._after)
+        event.remove(self.engine, "handle_error", self._error)
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def flush(self):
+        """Ждет, пока фоновый поток запишет все медленные запросы из очереди"""
+        self._queue.join()
+
+    def _before(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _error(self, context):
+        # after_cursor_execute не вызывается для запроса с ошибкой, время его начала снимается здесь
+        connection = context.connection
+        if connection is not None and not connection.invalidated and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    def _after(self, connection, cursor, statement, parameters, context, executemany):
+        started = connection.info["query_started"].pop()
+        duration = time.perf_counter() - started
+        if duration < self.threshold or getattr(_local, "explaining", False):
+            return
+
+        self.slow_queries += 1
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "caller": find_caller(),
+            "duration_ms": round(duration * 1000, 2),
+            "statement": statement,
+            "parameters": redact_parameters(parameters),
+            "executemany": executemany
+        }
+        if self._worker is not None and not executemany:
+            try:
+                self._queue.put_nowait((record, parameters))
+                return
+            except queue.Full:
+                self.plans_skipped += 1
+                record["plan"] = "план не построен: очередь EXPLAIN заполнена"
+        self.log.info(json.dumps(record, ensure_ascii=False))
+
+    def _explain_worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                record, parameters = item
+                record["plan"] = _explain(self.engine, record["statement"], parameters, self.analyze)
+                self.log.info(json.dumps(record, ensure_ascii=False))
+            except Exception:
+                logger.exception("Не удалось записать медленный запрос")
+            finally:
+                self._queue.task_done()
+
+def enable_profiling(engine, **kwargs) -> QueryProfiler:
+    """Подключает профилировщик к движку SQLAlchemy"""
+    profiler = QueryProfiler(engine, **kwargs)
+    profiler.attach()
+    return profiler
+
+def read_log(path: str):
+    """Читает записи из лога медленных запросов и его ротированных копий"""
+    paths = [path] + [f"{path}.{i}" for i in range(1, SLOW_QUERY_LOG_BACKUPS + 1)]
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+def summarize(path: str = SLOW_QUERY_LOG, top: int = 10):
+    """Сводка по медленным запросам: группировка по вызывающей функции и тексту запроса"""
+    groups = defaultdict(list)
+    samples = {}
+    for record in read_log(path):
+        key = (record["caller"], record["statement"])
+        groups[key].append(record["duration_ms"])
+        samples[key] = record
+
+    rows = sorted(groups.items(), key=lambda item: sum(item[1]), reverse=True)[:top]
+    result = []
+    for (caller, statement), durations in rows:
+        result.append({
+            "caller": caller,
+            "statement": statement,
+            "count": len(durations),
+            "total_ms": round(sum(durations), 2),
+            "avg_ms": round(sum(durations) / len(durations), 2),
+            "max_ms": max(durations),
+            "plan": samples[(caller, statement)].get("plan")
+        })
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сводка по медленным SQL-запросам")
+    parser.add_argument("log", nargs="?", default=SLOW_QUERY_LOG)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--plans", action="store_true", help="показать планы выполнения")
+    args = parser.parse_args()
+
+    for i, row in enumerate(summarize(args.log, args.top), 1):
+        statement = " ".join(row["statement"].split())
+        print(
+            f"{i}. {row['caller']}: {row['count']} раз, всего {row['total_ms']} мс, "
+            f"в среднем {row['avg_ms']} мс, максимум {row['max_ms']} мс"
+        )
+        print(f"   {statement[:300]}")
+        if args.plans and row["plan"]:
+            for line in row["plan"].splitlines():
+                print(f"      {line}")
@@ -0,0 +1,134 @@
+import os
+import re
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Update
+
+# Ограничение Telegram на длину сообщения (в единицах UTF-16)
+MESSAGE_LIMIT = 4096
+# Сколько страниц листать кнопками; более длинный текст в чате отправляется файлом .txt
+LYRICS_MAX_PAGES = int(os.getenv("LYRICS_MAX_PAGES", "5"))
+
+# Запас под подпись страницы
+_PAGE_MARK_RESERVE = 24
+_VERSE_BREAK = re.compile(r"\n[ \t]*\n")
+
+# Готовая к отправке карточка песни: страницы (каждая не длиннее MESSAGE_LIMIT),
+# сообщение для чата вместо страниц и полный текст для файла (None, если страниц мало)
+RenderedSong = namedtuple("RenderedSong", ["pages", "summary", "document", "filename"])
+
+def text_length(text: str) -> int:
+    """Длина строки так, как ее считает Telegram (эмодзи - две единицы)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _hard_split(text: str, limit: int):
+    pieces, current, length = [], [], 0
+    for char in text:
+        size = text_length(char)
+        if length + size > limit:
+            pieces.append("".join(current))
+            current, length = [], 0
+        current.append(char)
+        length += size
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+def _verse_pieces(verse: str, limit: int):
+    """Куплет целиком, а если он не помещается - группы его строк"""
+    if text_length(verse) <= limit:
+        return [verse]
+    pieces, current = [], ""
+    for line in verse.split("\n"):
+        for part in ([line] if text_length(line) <= limit else _hard_split(line, limit)):
+            candidate = f"{current}\n{part}" if current else part
+            if text_length(candidate) <= limit:
+                current = candidate
+            else:
+                pieces.append(current)
+                current = part
+    if current:
+        pieces.append(current)
+    return pieces
+
+def split_text(text: str, limit: int):
+    """
+    Делит текст на части не длиннее limit по границам куплетов (пустым строкам).
+    Куплет делится по строкам, только если он сам не помещается в limit.
+    """
+    chunks, current = [], ""
+    for verse in _VERSE_BREAK.split(text.strip()):
+        for piece in _verse_pieces(verse, limit):
+            candidate = f"{current}\n\n{piece}" if current else piece
+            if text_length(candidate) <= limit:
+                current = candidate
+            else:
+                chunks.append(current)
+                current = piece
+    chunks.append(current)
+    return chunks
+
+def render_song(song_id: int, header: str, text: str, footer: str = "", limit: int = MESSAGE_LIMIT) -> RenderedSong:
+    """Делит карточку песни на страницы: заголовок на первой, подпись на последней"""
+    text = text or ""
+    body_limit = max(limit - text_length(header) - text_length(footer) - _PAGE_MARK_RESERVE, limit // 4)
+    chunks = split_text(text, body_limit)
+    total = len(chunks)
+    pages = []
+    for number, chunk in enumerate(chunks, 1):
+        page = chunk
+        if number == 1:
+            page = header + page
+        if number == total:
+            page += footer
+        if total > 1:
+            page += f"\n\n[стр. {number}/{total}]"
+        pages.append(page)
+
+    document = summary = None
+    if total > LYRICS_MAX_PAGES:
+        document = header + text + footer
+        summary = header + f"Текст слишком длинный ({len(text)} символов), он отправлен файлом." + footer
+    return RenderedSong(tuple(pages), summary, document, f"song_{song_id}.txt")
+
+def page_buttons(song_id: int, page: int, total: int):
+    """Кнопки листания страниц текста (пустой список, если страница одна)"""
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Текст", callback_data=f"lyrics_{song_id}_{page - 1}"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("Текст ▶️", callback_data=f"lyrics_{song_id}_{page + 1}"))
+    return buttons
+
+def page_markup(rendered: RenderedSong, song_id: int, page: int = 0, rows=()):
+    navigation = page_buttons(song_id, page, len(rendered.pages))
+    keyboard = ([navigation] if navigation else []) + list(rows)
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def send_rendered(target, rendered: RenderedSong, song_id: int, page: int = 0, rows=()):
+    """
+    Показывает карточку песни. target - Update (новое сообщение) или
+    CallbackQuery (правка сообщения с кнопкой). Слишком длинный текст в чате
+    заменяется сообщением summary и файлом; в сообщениях inline-режима файл
+    отправить нельзя, поэтому там всегда листаются страницы.
+    """
+    page = min(max(page, 0), len(rendered.pages) - 1)
+    if isinstance(target, Update):
+        message, edit = target.effective_message, None
+    else:
+        message, edit = target.message, target.edit_message_text
+
+    if rendered.document is not None and message is not None:
+        markup = InlineKeyboardMarkup(list(rows)) if rows else None
+        if edit:
+            await edit(rendered.summary, reply_markup=markup)
+        else:
+            await message.reply_text(rendered.summary, reply_markup=markup)
+        await message.reply_document(InputFile(rendered.document.encode("utf-8"), filename=rendered.filename))
+        return
+
+    markup = page_markup(rendered, song_id, page, rows)
+    if edit:
+        await edit(rendered.pages[page], reply_markup=markup)
+    else:
+        await message.reply_text(rendered.pages[page], reply_markup=markup)
@@ -0,0 +1,371 @@
+import bisect
+import re
+import sys
+import threading
+import time
+from array import array
+
+from cache import DatabaseChangeFeed, SongSummary, CACHE_POLL_INTERVAL
+from database import add_song_listener, get_all_songs_with_id, Song, Page, PAGE_SIZE
+from trigram_index import normalize
+
+_WORD = re.compile(r"\w+")
+
+def tokens(value: str) -> set:
+    """Слова строки после нормализации (нижний регистр, ё → е); одинаковые слова разных песен - один объект"""
+    return set(map(sys.intern, _WORD.findall(normalize(value))))
+
+class _TokenIndex:
+    """
+    Инвертированный индекс одного поля: слово → отсортированный массив id песен
+    (array('I'), 4 байта на вхождение). Слова хранятся и в отсортированном
+    списке для поиска по префиксу. entry_bytes - размер слов и массивов id,
+    пересчитывается при каждом изменении.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.vocabulary = []
+        self.entry_bytes = 0
+
+    def build(self, pairs):
+        """pairs - (id, множество слов) в порядке возрастания id"""
+        for song_id, words in pairs:
+            for word in words:
+                postings = self.postings.get(word)
+                if postings is None:
+                    postings = self.postings[word] = array("I")
+                postings.append(song_id)
+        self.vocabulary = sorted(self.postings)
+        self.entry_bytes = sum(sys.getsizeof(word) + sys.getsizeof(postings) for word, postings in self.postings.items())
+
+    def add(self, song_id: int, words):
+        for word in words:
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = array("I")
+                bisect.insort(self.vocabulary, word)
+                self.entry_bytes += sys.getsizeof(word)
+                before = 0
+            else:
+                before = sys.getsizeof(postings)
+            if not postings or postings[-1] < song_id:
+                postings.append(song_id)
+            else:
+                position = bisect.bisect_left(postings, song_id)
+                if position == len(postings) or postings[position] != song_id:
+                    postings.insert(position, song_id)
+            self.entry_bytes += sys.getsizeof(postings) - before
+
+    def remove(self, song_id: int, words):
+        for word in words:
+            postings = self.postings.get(word)
+            if postings is None:
+                continue
+            before = sys.getsizeof(postings)
+            position = bisect.bisect_left(postings, song_id)
+            if position < len(postings) and postings[position] == song_id:
+                del postings[position]
+            if not postings:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+                self.entry_bytes -= before + sys.getsizeof(word)
+            else:
+                self.entry_bytes += sys.getsizeof(postings) - before
+
+    def prefix_match(self, prefix: str) -> set:
+        """id песен, в которых есть слово, начинающееся с prefix"""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        result = set()
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            result.update(self.postings[word])
+        return result
+
+    def substring_match(self, fragment: str) -> set:
+        """id песен, в которых есть слово, содержащее fragment"""
+        result = set()
+        for word in self.vocabulary:
+            if fragment in word:
+                result.update(self.postings[word])
+        return result
+
+    def search(self, query: str, match=None):
+        """
+        id песен, содержащих все слова запроса, по возрастанию. По умолчанию
+        слово запроса должно быть началом слова песни (как в FTS5).
+        """
+        match = match or self.prefix_match
+        words = sorted(tokens(query), key=len, reverse=True)
+        if not words:
+            return []
+        result = None
+        for word in words:
+            matches = match(word)
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+        return sorted(result)
+
+    def memory(self) -> int:
+        return sys.getsizeof(self.postings) + sys.getsizeof(self.vocabulary) + self.entry_bytes
+
+class SearchIndex:
+    """
+    Поиск по архиву в памяти процесса без запросов к базе.
+
+    Строится из get_all_songs_with_id: инвертированные индексы слов названий
+    и текстов, словари значений категорий и мест. Выборки повторяют
+    get_songs_page: название - подстрока (как ILIKE), текст - все слова по
+    началу (как FTS5), категория и место - точное совпадение, иначе подстрока
+    (как _column_filter). Результаты упорядочены по id, в том числе поиск по
+    тексту (база ранжирует его по релевантности, поэтому у страниц текста
+    свои курсоры i<смещение>, см. get_page).
+    Тексты песен в памяти не хранятся, только массивы id; на песню уходит
+    порядка 1 КБ (см. memory_usage и README).
+
+    Изменения в этом процессе применяются сразу через add_song_listener,
+    изменения других процессов - не позже чем через poll_interval секунд
+    по журналу archive_changes.
+    """
+
+    KINDS = ("all", "title", "text", "category", "place")
+
+    def __init__(self, feed=None, poll_interval: float = CACHE_POLL_INTERVAL):
+        self.feed = feed if feed is not None else DatabaseChangeFeed()
+        self.poll_interval = poll_interval
+        self.version = None
+        self.ready = False
+        self.build_seconds = None
+        self._last_poll = 0.0
+        self._lock = threading.Lock()
+        self._reset()
+        add_song_listener(self._on_song_change)
+
+    def _reset(self):
+        self._summaries = {}
+        self._ids = array("I")
+        self._title = _TokenIndex()
+        self._text = _TokenIndex()
+        self._categories = {}
+        self._places = {}
+        # Слова названия и текста каждой песни нужны, чтобы удалить ее из индексов
+        self._words = {}
+        # Размер карточек, слов песен и списков id категорий и мест без самих словарей;
+        # ведется при изменениях, чтобы stats не обходил весь индекс
+        self._entry_bytes = 0
+
+    def supports(self, kind: str, cursor: str = None) -> bool:
+        """
+        Может ли индекс отдать страницу. Курсор o<n> получен из ранжированной
+        выдачи базы, и листать ее дальше должна база.
+        """
+        if kind == "text" and cursor and cursor[0] == "o":
+            return False
+        return self.ready and kind in self.KINDS
+
+    def build(self, db):
+        """Полностью перестраивает индекс по текущему содержимому архива"""
+        started = time.perf_counter()
+        version = self.feed.version(db)
+        songs = sorted(get_all_songs_with_id(db), key=lambda song: song["id"])
+        with self._lock:
+            self._reset()
+            title_pairs, text_pairs = [], []
+            for song in songs:
+                title_words, text_words = tokens(song["title"]), tokens(song["text"])
+                title_pairs.append((song["id"], title_words))
+                text_pairs.append((song["id"], text_words))
+                self._set_words(song["id"], title_words, text_words)
+                self._add_summary(song["id"], song["title"], song["category"], song["place"])
+            self._title.build(title_pairs)
+            self._text.build(text_pairs)
+            self.version = version
+            self._last_poll = time.monotonic()
+            self.ready = True
+        self.build_seconds = time.perf_counter() - started
+
+    def _set_words(self, song_id, title_words, text_words):
+        words = self._words[song_id] = (tuple(title_words), tuple(text_words))
+        self._entry_bytes += sys.getsizeof(words[0]) + sys.getsizeof(words[1])
+
+    def _add_summary(self, song_id, title, category, place):
+        summary = self._summaries[song_id] = SongSummary(song_id, title, category, place)
+        self._entry_bytes += sys.getsizeof(summary) + sys.getsizeof(summary.title)
+        if not self._ids or self._ids[-1] < song_id:
+            self._ids.append(song_id)
+        else:
+            self._ids.insert(bisect.bisect_left(self._ids, song_id), song_id)
+        for values, key in ((self._categories, normalize(category)), (self._places, normalize(place))):
+            if key:
+                ids = values.get(key)
+                if ids is None:
+                    ids = values[key] = array("I")
+                    self._entry_bytes += sys.getsizeof(key)
+                    before = 0
+                else:
+                    before = sys.getsizeof(ids)
+                ids.insert(bisect.bisect_left(ids, song_id), song_id)
+                self._entry_bytes += sys.getsizeof(ids) - before
+
+    def _remove(self, song_id: int):
+        summary = self._summaries.pop(song_id, None)
+        if summary is None:
+            return
+        self._entry_bytes -= sys.getsizeof(summary) + sys.getsizeof(summary.title)
+        del self._ids[bisect.bisect_left(self._ids, song_id)]
+        for values, key in ((self._categories, normalize(summary.category)), (self._places, normalize(summary.place))):
+            ids = values.get(key)
+            if ids is not None:
+                before = sys.getsizeof(ids)
+                del ids[bisect.bisect_left(ids, song_id)]
+                if not ids:
+                    del values[key]
+                    self._entry_bytes -= before + sys.getsizeof(key)
+                else:
+                    self._entry_bytes += sys.getsizeof(ids) - before
+        title_words, text_words = self._words.pop(song_id)
+        self._entry_bytes -= sys.getsizeof(title_words) + sys.getsizeof(text_words)
+        self._title.remove(song_id, title_words)
+        self._text.remove(song_id, text_words)
+
+    def _put(self, song_id, title, text, category, place):
+        self._remove(song_id)
+        title_words, text_words = tokens(title), tokens(text)
+        self._set_words(song_id, title_words, text_words)
+        self._title.add(song_id, title_words)
+        self._text.add(song_id, text_words)
+        self._add_summary(song_id, title, category, place)
+
+    def _on_song_change(self, event: str, song):
+        if not self.ready:
+            return
+        if event == "bulk":
+            # Массовое изменение: индекс перестраивается при следующей синхронизации
+            self.ready = False
+            return
+        with self._lock:
+            if event == "delete":
+                self._remove(song.id)
+            else:
+                self._put(song.id, song.title, song.text, song.category, song.place)
+
+    def sync_due(self) -> bool:
+        return not self.ready or time.monotonic() - self._last_poll >= self.poll_interval
+
+    def sync(self, db):
+        """Применяет изменения других процессов из журнала; перестраивает индекс, если он устарел"""
+        if not self.ready or self.version is None:
+            self.build(db)
+            return
+        self._last_poll = time.monotonic()
+        version, song_ids = self.feed.changes_since(db, self.version)
+        if song_ids is None:
+            self.build(db)
+            return
+        if song_ids:
+            rows = {
+                row.id: row for row in
+                db.query(Song.id, Song.title, Song.text, Song.category, Song.place).filter(Song.id.in_(song_ids))
+            }
+            with self._lock:
+                for song_id in song_ids:
+                    row = rows.get(song_id)
+                    if row is None:
+                        self._remove(song_id)
+                    else:
+                        self._put(row.id, row.title, row.text, row.category, row.place)
+        self.version = version
+
+    def _column_ids(self, values: dict, value: str):
+        """Точное совпадение, если оно есть, иначе подстрока (как _column_filter)"""
+        key = normalize(value)
+        if key in values:
+            return values[key]
+        ids = set()
+        for candidate, candidate_ids in values.items():
+            if key in candidate:
+                ids.update(candidate_ids)
+        return sorted(ids)
+
+    def _title_ids(self, query: str):
+        """Названия, содержащие query как подстроку: кандидаты по словам, затем проверка целиком"""
+        fragment = normalize(query)
+        if tokens(fragment):
+            candidates = self._title.search(fragment, self._title.substring_match)
+        else:
+            candidates = self._ids
+        return [song_id for song_id in candidates if fragment in normalize(self._summaries[song_id].title)]
+
+    def _search(self, kind: str, query: str = None):
+        if kind == "all":
+            return self._ids
+        if kind == "title":
+            return self._title_ids(query)
+        if kind == "text":
+            return self._text.search(query)
+        if kind == "category":
+            return self._column_ids(self._categories, query)
+        if kind == "place":
+            return self._column_ids(self._places, query)
+        raise ValueError(f"Неизвестный тип выборки: {kind}")
+
+    def search(self, kind: str, query: str = None):
+        """id найденных песен по возрастанию"""
+        with self._lock:
+            return list(self._search(kind, query))
+
+    def get_page(self, kind: str, query: str = None, cursor: str = None, limit: int = PAGE_SIZE) -> Page:
+        """
+        Страница результатов с курсорами, которые понимает и get_songs_page:
+        для текста i<смещение> (выдача по id, а не по релевантности, как o<n>
+        в базе), для остальных a<id>/b<id>. Поэтому листание продолжается и
+        в базе, если индекс перестраивается.
+        """
+        with self._lock:
+            ids = self._search(kind, query)
+            if cursor and cursor[0] == "i":
+                start = int(cursor[1:])
+            elif cursor and cursor[0] == "b":
+                start = max(bisect.bisect_left(ids, int(cursor[1:])) - limit, 0)
+            elif cursor:
+                start = bisect.bisect_right(ids, int(cursor[1:]))
+            else:
+                start = 0
+            songs = [self._summaries[song_id] for song_id in ids[start:start + limit]]
+        if not songs:
+            return Page([], None, None)
+        if kind == "text":
+            return Page(
+                songs,
+                f"i{max(start - limit, 0)}" if start > 0 else None,
+                f"i{start + limit}" if start + limit < len(ids) else None
+            )
+        return Page(
+            songs,
+            f"b{songs[0].id}" if start > 0 else None,
+            f"a{songs[-1].id}" if start + limit < len(ids) else None
+        )
+
+    def memory_usage(self) -> int:
+        """Приблизительный объем индекса в байтах, без обхода песен"""
+        with self._lock:
+            containers = sum(
+                sys.getsizeof(container)
+                for container in (self._summaries, self._words, self._ids, self._categories, self._places)
+            )
+            return containers + self._entry_bytes + self._title.memory() + self._text.memory()
+
+    def stats(self):
+        songs = len(self._summaries)
+        memory = self.memory_usage()
+        return {
+            "ready": int(self.ready),
+            "songs": songs,
+            "title_words": len(self._title.postings),
+            "text_words": len(self._text.postings),
+            "memory_bytes": memory,
+            "bytes_per_song": memory // songs if songs else 0,
+            "build_seconds": self.build_seconds or 0.0
+        }
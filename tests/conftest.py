@@ -0,0 +1,39 @@
+"""
+Общие настройки тестов: модули бота лежат в корне репозитория, база -
+временный файл SQLite (DATABASE_URL задается до импорта database).
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp(prefix="folk_songs_tests_")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(TMP, "test.db")
+
+# env.py с токенами в репозиторий не входит; тестам достаточно заглушек токенов.
+# Файл, а не модуль в sys.modules: его импортируют и процессы воркеров cluster.py
+if importlib.util.find_spec("env") is None:
+    with open(os.path.join(TMP, "env.py"), "w", encoding="utf-8") as f:
+        f.write(
+            "import os\n"
+            "DATABASE_URL = os.environ['DATABASE_URL']\n"
+            "API_TOKEN = '123:test'\n"
+            "ADMIN_API_TOKEN = '456:test'\n"
+        )
+    sys.path.append(TMP)
+
+import pytest
+
+@pytest.fixture(scope="session")
+def database():
+    import database
+    database.init_db()
+    return database
+
+@pytest.fixture
+def db(database):
+    with database.session_scope() as session:
+        yield session
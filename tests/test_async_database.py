@@ -0,0 +1,23 @@
+"""p99 быстрых запросов при медленном запросе: в event loop и через run_db"""
+import asyncio
+
+from loadtest import offload_latency
+
+SLOW_SECONDS = 0.3
+
+def _song_ids(database, db):
+    if not db.query(database.Song.id).first():
+        database.add_song(db, title="Калина красная", region="Лирические|Село", text="калина красная")
+    return [row[0] for row in db.query(database.Song.id).all()]
+
+def test_blocking_calls_stall_fast_requests(database, db):
+    report = asyncio.run(offload_latency("blocking", SLOW_SECONDS, _song_ids(database, db), duration=2, rate=100))
+    assert report["slow_requests"] == 2
+    assert report["p99"] >= SLOW_SECONDS * 0.8
+
+def test_offloaded_p99_does_not_depend_on_slow_query(database, db):
+    song_ids = _song_ids(database, db)
+    for slow_seconds in (SLOW_SECONDS, SLOW_SECONDS * 3):
+        report = asyncio.run(offload_latency("offloaded", slow_seconds, song_ids, duration=2, rate=100))
+        assert report["slow_requests"] == 2
+        assert report["p99"] < SLOW_SECONDS / 3
@@ -0,0 +1,41 @@
+"""Поиск по категории и месту: точное совпадение по индексу, иначе подстрока"""
+from sqlalchemy import text as sql_text
+
+def _ids(songs):
+    return {song.id for song in songs}
+
+def test_exact_match_excludes_substring_matches(database, db):
+    exact = database.add_song(db, title="Точная", region="Свадебные величальные|Ёлкино", text="")
+    longer = database.add_song(db, title="Длиннее", region="Свадебные величальные протяжные|Ёлкино Верхнее", text="")
+
+    # Точное совпадение без учета регистра и ё: песни с более длинной категорией не попадают
+    assert _ids(database.get_songs_by_category(db, "СВАДЕБНЫЕ величальные")) == {exact.id}
+    assert _ids(database.get_songs_by_place(db, "елкино")) == {exact.id}
+    assert [song.id for song in database.get_songs_page(db, "category", "свадебные величальные").songs] == [exact.id]
+
+    # Точного совпадения нет - поиск подстроки
+    assert _ids(database.get_songs_by_category(db, "величальные")) == {exact.id, longer.id}
+    assert _ids(database.get_songs_by_place(db, "Верхнее")) == {longer.id}
+
+    database.update_song(db, longer.id, region="Свадебные величальные|Ёлкино")
+    assert _ids(database.get_songs_by_category(db, "свадебные величальные")) == {exact.id, longer.id}
+
+def test_exact_match_uses_index(database, db):
+    with database.engine.connect() as conn:
+        for column in ("category_key", "place_key"):
+            plan = " ".join(
+                row[-1] for row in conn.execute(sql_text(
+                    f"EXPLAIN QUERY PLAN SELECT id FROM folk_songs WHERE {column} = 'x' ORDER BY id"
+                ))
+            )
+            assert f"USING INDEX ix_folk_songs_{column}" in plan or f"USING COVERING INDEX ix_folk_songs_{column}" in plan
+
+def test_keys_are_backfilled(database, db):
+    song = database.add_song(db, title="Без ключей", region="Хороводные Заполняемые|Погост", text="")
+    with database.engine.begin() as conn:
+        conn.execute(sql_text("UPDATE folk_songs SET category_key = NULL, place_key = NULL WHERE id = :id"), {"id": song.id})
+    assert not database.get_songs_by_category(db, "хороводные заполняемые")
+
+    database.migrate_facet_keys()
+    assert _ids(database.get_songs_by_category(db, "хороводные заполняемые")) == {song.id}
+    assert _ids(database.get_songs_by_place(db, "ПОГОСТ")) == {song.id}
@@ -0,0 +1,141 @@
+"""Инвалидация кэшей по журналу изменений (DatabaseChangeFeed) и внутри процесса (LocalChangeFeed)"""
+import asyncio
+
+from cache import DatabaseChangeFeed, LocalChangeFeed, RenderCache, SongCache
+from search_index import SearchIndex
+
+def _write_elsewhere(database, song_id=None, title=None):
+    """Изменение, сделанное другим процессом: только строка песни и журнал, без add_song_listener"""
+    with database.session_scope() as session:
+        if title is not None:
+            session.query(database.Song).filter(database.Song.id == song_id).update({"title": title})
+        database._record_change(session, song_id)
+        session.commit()
+
+def _add(database, db, title):
+    return database.add_song(db, title=title, region="Тестовые|Деревня", text="тестовый текст")
+
+def test_versions_count_committed_writes(database, db):
+    version = database.get_archive_version(db)
+    first = _add(database, db, "Первая")
+    second = _add(database, db, "Вторая")
+    assert database.get_changes_since(db, version) == (version + 2, {first.id, second.id})
+    assert database.get_changes_since(db, version + 2) == (version + 2, set())
+
+def test_changes_do_not_depend_on_journal_ids(database, db):
+    """Запись с меньшим id, закоммиченная позже, все равно доставляется"""
+    version = database.get_archive_version(db)
+    first = _add(database, db, "Раньше")
+    second = _add(database, db, "Позже")
+    lowest = db.query(database.func.min(database.ArchiveChange.id)).scalar()
+    db.query(database.ArchiveChange).filter(database.ArchiveChange.version == version + 2).update(
+        {"id": lowest - 1}
+    )
+    db.commit()
+    assert database.get_changes_since(db, version + 1) == (version + 2, {second.id})
+    assert database.get_changes_since(db, version) == (version + 2, {first.id, second.id})
+
+def test_changes_reset_after_bulk_change_and_pruning(database, db):
+    song = _add(database, db, "Массовая")
+    version = database.get_archive_version(db)
+    _write_elsewhere(database)
+    assert database.get_changes_since(db, version) == (version + 1, None)
+
+    version += 1
+    _write_elsewhere(database, song.id, "Обрезанная")
+    _write_elsewhere(database, song.id, "Обрезанная 2")
+    db.query(database.ArchiveChange).filter(database.ArchiveChange.version == version + 1).delete()
+    db.commit()
+    assert database.get_changes_since(db, version) == (version + 2, None)
+
+def test_song_cache_syncs_from_database_feed(database, db):
+    song = _add(database, db, "Кэшируемая")
+    other = _add(database, db, "Соседняя")
+    cache = SongCache(feed=DatabaseChangeFeed(), poll_interval=0)
+    cache.sync(db)
+    cache.set(song.id, "старая карточка")
+    cache.set(other.id, "карточка соседа")
+
+    _write_elsewhere(database, song.id, "Измененная")
+    assert cache.get(song.id) == "старая карточка"
+    assert cache.sync_due()
+    cache.sync(db)
+    assert cache.get(song.id) is None
+    assert cache.get(other.id) == "карточка соседа"
+
+    _write_elsewhere(database)
+    cache.sync(db)
+    assert len(cache) == 0
+
+def test_song_cache_drops_card_read_before_invalidation(database, db):
+    song = _add(database, db, "Читаемая")
+    cache = SongCache(feed=DatabaseChangeFeed(), poll_interval=0)
+    cache.sync(db)
+
+    generation = cache.generation
+    database.update_song(db, song.id, title="Исправленная")
+    cache.put(song.id, "карточка до правки", generation)
+    assert cache.get(song.id) is None
+
+    generation = cache.generation
+    _write_elsewhere(database, song.id, "Исправленная еще раз")
+    cache.sync(db)
+    cache.put(song.id, "карточка до правки", generation)
+    assert cache.get(song.id) is None
+
+    cache.put(song.id, "свежая карточка", cache.generation)
+    assert cache.get(song.id) == "свежая карточка"
+
+def test_card_fill_interleaved_with_update(database, db, monkeypatch):
+    import bot
+
+    song = _add(database, db, "Карточка до правки")
+    read = bot.get_song_by_id
+
+    def read_then_update(session, song_id):
+        # Правка приходит, пока карточка читается из базы
+        stale = read(session, song_id)
+        session.expunge(stale)
+        with database.session_scope() as other:
+            database.update_song(other, song_id, title="Карточка после правки")
+        return stale
+
+    monkeypatch.setattr(bot, "get_song_by_id", read_then_update)
+    assert "Карточка до правки" in asyncio.run(bot.get_song_details(song.id)).pages[0]
+    assert bot.song_details_cache.get(song.id) is None
+
+    monkeypatch.setattr(bot, "get_song_by_id", read)
+    assert "Карточка после правки" in asyncio.run(bot.get_song_details(song.id)).pages[0]
+    assert bot.song_details_cache.get(song.id) is not None
+
+def test_render_cache_and_search_index_sync_from_database_feed(database, db):
+    song = _add(database, db, "Индексируемая")
+    render = RenderCache(feed=DatabaseChangeFeed(), poll_interval=0)
+    render.sync(db)
+    render.put(("all", None, None), "страница", render.generation)
+    index = SearchIndex(feed=DatabaseChangeFeed(), poll_interval=0)
+    index.build(db)
+
+    _write_elsewhere(database, song.id, "Переименованная")
+    render.sync(db)
+    index.sync(db)
+    assert render.get(("all", None, None)) is None
+    assert song.id in index.search("title", "переименованная")
+    assert song.id not in index.search("title", "индексируемая")
+
+def test_local_change_feed(database, db):
+    feed = LocalChangeFeed()
+    cache = SongCache(feed=feed, poll_interval=0)
+    cache.sync(db)
+    version = feed.version()
+
+    song = _add(database, db, "Локальная")
+    database.update_song(db, song.id, title="Локальная 2")
+    assert feed.changes_since(db, version) == (version + 2, {song.id})
+
+    cache.set(song.id, "карточка")
+    database.notify_bulk_change(db)
+    assert feed.changes_since(db, version + 2) == (version + 3, None)
+    cache.set(song.id, "карточка")
+    cache.sync(db)
+    assert len(cache) == 0
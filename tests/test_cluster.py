@@ -0,0 +1,41 @@
+"""Многопроцессный режим: маршрутизация и масштабирование на поисковой нагрузке"""
+import os
+
+import pytest
+
+import cluster
+from loadtest import UpdateFactory
+
+def test_routing_key_keeps_user_on_one_worker():
+    factory = UpdateFactory()
+    assert cluster.routing_key(factory.message(42, "/add")) == 42
+    assert cluster.routing_key(factory.callback(42, "song_1")) == 42
+    assert cluster.routing_key(factory.inline_query(42, "калинка")) == 42
+
+def test_workers_process_all_updates(database):
+    environ = dict(os.environ)
+    results = cluster.bench([2], users=10, updates_per_user=3, seed_size=200, api_latency=0.0,
+                            database_url=os.environ["DATABASE_URL"], timeout=120)
+    assert results[0]["updates"] == 40
+    # Настройки воркеров передаются им аргументами и не остаются в окружении вызывающего процесса
+    assert dict(os.environ) == environ
+
+def test_updates_are_split_between_workers(database):
+    """Условие масштабирования, проверяемое на любом числе ядер: каждый воркер делает свою долю работы"""
+    results = cluster.bench([1, 2, 3], users=60, updates_per_user=2, seed_size=200, api_latency=0.0,
+                            database_url=os.environ["DATABASE_URL"], timeout=300)
+    for result in results:
+        assert len(result["per_worker"]) == result["workers"]
+        assert sum(result["per_worker"]) == result["updates"]
+        assert min(result["per_worker"]) >= result["updates"] / result["workers"] / 2
+
+def test_bench_refuses_other_database(database):
+    with pytest.raises(ValueError):
+        cluster.bench([1], users=1, updates_per_user=1, seed_size=10, api_latency=0.0,
+                      database_url="sqlite:///other.db")
+
+@pytest.mark.skipif((os.cpu_count() or 1) < 3, reason="нужно ядро входному процессу и по ядру двум воркерам")
+def test_two_workers_scale_nearly_linearly(database):
+    results = cluster.bench([1, 2], users=100, updates_per_user=10, seed_size=1000, api_latency=0.0,
+                            database_url=os.environ["DATABASE_URL"], timeout=300)
+    assert results[1]["efficiency"] >= 0.75
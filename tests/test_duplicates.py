@@ -0,0 +1,82 @@
+"""Отпечатки MinHash/LSH и поиск почти-дубликатов песен"""
+from sqlalchemy import text as sql_text
+
+import fingerprint
+
+BASE = (
+    "ой да во поле дубравушка шумела зеленая дубравушка под горою стояла "
+    "там ходила красна девица с подружками гуляла веночки плела да на реченьку пускала"
+)
+TYPOS = BASE.replace("дубравушка шумела", "дубравушка шумела-то").replace("красна", "красная")
+WREATH = (
+    "по лугу лугу зеленому ходили девушки хороводом венки из васильков вили "
+    "на воду пускали да про милого гадали куда венок поплывет туда и замуж идти"
+)
+RIVER = (
+    "ой ты реченька быстрая не шуми не волнуйся разлилась весной широко "
+    "унесла мосточки тесовые разлучила с милым дружком на том берегу"
+)
+OTHER = (
+    "как за речкою за быстрою молодой казак коня поил сабелькою острой помахивал "
+    "про родную сторонушку песню звонкую заводил да матушку вспоминал"
+)
+
+def test_fingerprint_of_near_duplicates_share_bands():
+    base, typos, other = (fingerprint.shingles(value) for value in (BASE, TYPOS, OTHER))
+    assert fingerprint.similarity(base, base) == 1.0
+    assert fingerprint.similarity(base, typos) >= 0.7
+    assert fingerprint.similarity(base, other) < 0.3
+
+    bands = fingerprint.fingerprint("Дубравушка", BASE)
+    assert len(bands) == fingerprint.NUM_BANDS
+    assert bands == fingerprint.fingerprint("Дубравушка", BASE)
+    assert set(bands) & set(fingerprint.fingerprint("Дубравушка", TYPOS))
+    assert not set(bands) & set(fingerprint.fingerprint("Казак", OTHER))
+    assert fingerprint.fingerprint("", "") == []
+
+def test_find_similar_songs(database, db):
+    original = database.add_song(db, title="Дубравушка", region="Лирические|Дубровка", text=BASE)
+    database.add_song(db, title="Казак коня поил", region="Казачьи|Дубровка", text=OTHER)
+
+    similar = database.find_similar_songs(db, "Дубравушка", TYPOS)
+    assert [song.id for song, _ in similar] == [original.id]
+    assert similar[0][1] >= database.DUPLICATE_THRESHOLD
+    assert database.find_similar_songs(db, "Новая песня", "совсем другие слова про метелицу и снежок") == []
+
+def test_duplicate_groups_and_deleted_songs(database, db):
+    trio = [
+        database.add_song(db, title="Веночки", region="Лирические|Венково", text=WREATH),
+        database.add_song(db, title="Веночки", region="Лирические|Венково", text=WREATH.replace("васильков", "василечков")),
+        database.add_song(db, title="Веночки", region="Хороводные|Венково", text=WREATH + " плели")
+    ]
+    pair = [
+        database.add_song(db, title="Реченька", region="Лирические|Венково", text=RIVER),
+        database.add_song(db, title="Реченька", region="Лирические|Венково", text=RIVER.replace("быстрая", "быстрая моя"))
+    ]
+    single = database.add_song(db, title="Метелица", region="Зимние|Венково", text="метелица снежок " * 10)
+    ours = {song.id for song in trio + pair + [single]}
+
+    pairs = database._candidate_pairs(db, database.DUPLICATE_BUCKET_LIMIT)
+    assert (trio[0].id, trio[1].id) in pairs and (pair[0].id, pair[1].id) in pairs
+    assert not any(single.id in candidate for candidate in pairs)
+
+    def our_groups():
+        groups = database.find_duplicate_groups(db)
+        assert all(len(group["songs"]) >= 2 for group in groups)
+        return [
+            [song.id for song in group["songs"]] for group in groups
+            if {song.id for song in group["songs"]} & ours
+        ]
+
+    assert sorted(our_groups()) == sorted([[song.id for song in trio], [song.id for song in pair]])
+
+    # Строки удалены в обход delete_song (другой процесс до очистки), отпечатки остались
+    with database.engine.begin() as conn:
+        conn.execute(
+            sql_text("DELETE FROM folk_songs WHERE id IN (:first, :second)"),
+            {"first": trio[2].id, "second": pair[1].id}
+        )
+    assert our_groups() == [[trio[0].id, trio[1].id]]
+
+    database.delete_song(db, trio[1].id)
+    assert our_groups() == []
@@ -0,0 +1,165 @@
+"""Счетчики категорий и мест: ведутся при записи, совпадают с пересчетом и листаются в /categories и /places"""
+import asyncio
+from types import SimpleNamespace
+
+def _counts(database, db, facet):
+    return {row.value: row.count for row in database.get_facet_counts(db, facet)}
+
+def _recounted(database, db, facet):
+    database.rebuild_facet_counts(db)
+    db.commit()
+    return _counts(database, db, facet)
+
+def test_counts_follow_writes(database, db):
+    # Другие тесты удаляют строки в обход delete_song: отсчет ведется от пересчета
+    _recounted(database, db, "category")
+    first = database.add_song(db, title="Счетчик один", region="Счетные|Село Учетное")
+    second = database.add_song(db, title="Счетчик два", region="Счетные|Деревня Пересчетная")
+    assert _counts(database, db, "category")["Счетные"] == 2
+    assert _counts(database, db, "place")["Село Учетное"] == 1
+
+    database.update_song(db, second.id, region="Счетные|Село Учетное")
+    places = _counts(database, db, "place")
+    assert places["Село Учетное"] == 2
+    # Значение без песен удаляется, а не остается с нулем
+    assert "Деревня Пересчетная" not in places
+
+    database.update_songs(db, [
+        {"song_id": first.id, "region": "Пересчитанные|Село Учетное"},
+        {"song_id": first.id, "title": "Счетчик один заново"}
+    ])
+    database.delete_song(db, second.id)
+    categories = _counts(database, db, "category")
+    assert categories["Пересчитанные"] == 1 and "Счетные" not in categories
+    assert _counts(database, db, "place")["Село Учетное"] == 1
+
+    for facet in ("category", "place"):
+        assert _counts(database, db, facet) == _recounted(database, db, facet), facet
+
+def test_spellings_of_one_value_are_counted_together(database, db):
+    database.add_song(db, title="Написание один", region="Колядки написаний|Ёлкино Написаний")
+    database.add_song(db, title="Написание два", region="колядки НАПИСАНИЙ|Елкино написаний")
+    third = database.add_song(db, title="Написание три", region="Колядки написаний|ёлкино написаний")
+
+    rows = [row for row in database.get_facet_counts(db, "category") if row.value_key == "колядки написаний"]
+    assert [(row.value, row.count) for row in rows] == [("Колядки написаний", 3)]
+    places = [row for row in database.get_facet_counts(db, "place") if row.value_key == "елкино написаний"]
+    assert [(row.value, row.count) for row in places] == [("Ёлкино Написаний", 3)]
+    # Число на кнопке совпадает с выдачей по ней
+    assert len(database.get_songs_by_place(db, places[0].value)) == 3
+
+    database.update_song(db, third.id, region="Колядки написаний|Другое Написаний")
+    assert _counts(database, db, "place")["Ёлкино Написаний"] == 2
+    for facet in ("category", "place"):
+        assert _counts(database, db, facet) == _recounted(database, db, facet), facet
+    row, = [row for row in database.get_facet_counts(db, "category") if row.value_key == "колядки написаний"]
+    assert row.count == 3 and database.facet_key(row.value) == row.value_key
+
+def test_old_table_is_rebuilt_by_key(database, db):
+    from sqlalchemy import text as sql_text
+
+    database.add_song(db, title="Старая таблица", region="Переходные|Село Старое")
+    database.add_song(db, title="Старая таблица 2", region="ПЕРЕХОДНЫЕ|Село Старое")
+    db.commit()
+    with database.engine.begin() as conn:
+        conn.execute(sql_text("DROP TABLE facet_counts"))
+        conn.execute(sql_text(
+            "CREATE TABLE facet_counts (id INTEGER PRIMARY KEY, facet VARCHAR(16) NOT NULL, "
+            "value VARCHAR NOT NULL, count INTEGER NOT NULL, UNIQUE (facet, value))"
+        ))
+        conn.execute(sql_text("INSERT INTO facet_counts (facet, value, count) VALUES ('category', 'Переходные', 1)"))
+    database.migrate_facet_counts()
+    rows = [row for row in database.get_facet_counts(db, "category") if row.value_key == "переходные"]
+    assert [row.count for row in rows] == [2]
+
+def test_most_frequent_first(database, db):
+    for number in range(3):
+        database.add_song(db, title=f"Частая {number}", region="Частотные частые|Село Частое")
+    database.add_song(db, title="Редкая", region="Частотные редкие|Село Частое")
+    rows = database.get_facet_counts(db, "category")
+    order = [(-row.count, row.value) for row in rows]
+    assert order == sorted(order)
+    assert [row.value for row in database.get_facet_counts(db, "category", 1, 0)] == [rows[0].value]
+    assert [row.value for row in database.get_facet_counts(db, "category", 2, 1)] == [row.value for row in rows[1:3]]
+
+    frequent = next(row for row in rows if row.value == "Частотные частые")
+    assert database.get_facet_value(db, frequent.id).count == 3
+    assert database.get_facet_value(db, -1) is None
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+
+class Query:
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+
+def _buttons(reply_markup):
+    return [button for row in reply_markup.inline_keyboard for button in row]
+
+def test_categories_view(database, db):
+    import bot
+
+    songs = [database.add_song(db, title=f"Просмотр категорий {n}", region="Просмотровые|Село Видное") for n in range(2)]
+
+    async def scenario():
+        message = Message()
+        await bot.categories_handler(SimpleNamespace(message=message), SimpleNamespace(user_data={}))
+        (header, reply_markup), = message.replies
+        assert header == bot.FACETS["category"][0]
+
+        # Все страницы списка через кнопки «Далее», значения без повторов, по убыванию числа песен
+        values = []
+        while True:
+            buttons = _buttons(reply_markup)
+            values.extend(button for button in buttons if button.callback_data.startswith("facet_"))
+            following = [button.callback_data for button in buttons if button.callback_data.startswith("facets_")
+                         and button.text.startswith("Далее")]
+            if not following:
+                break
+            query = Query(following[0])
+            await bot.facet_callback(query, None)
+            (_, reply_markup), = query.edits
+        labels = [button.text for button in values]
+        assert len(labels) == len(set(labels)) == len(database.get_facet_counts(db, "category"))
+        counts = [int(label.rsplit("(", 1)[1].rstrip(")")) for label in labels]
+        assert counts == sorted(counts, reverse=True)
+
+        # Нажатие на значение открывает его песни
+        button = next(button for button in values if button.text == "Просмотровые (2)")
+        context = SimpleNamespace(user_data={})
+        query = Query(button.callback_data)
+        await bot.facet_callback(query, context)
+        (text, reply_markup), = query.edits
+        assert text == "Найдены песни в категории 'Просмотровые':"
+        assert {f"song_{song.id}" for song in songs} <= {b.callback_data for b in _buttons(reply_markup)}
+        assert context.user_data["search"]["kind"] == "category"
+
+    asyncio.run(scenario())
+
+def test_places_view_refreshes_after_write(database, db):
+    import bot
+
+    async def place_counts():
+        values, offset = {}, 0
+        while (reply_markup := await bot.get_facet_view("place", offset)) is not None:
+            for button in _buttons(reply_markup):
+                if button.callback_data.startswith("facet_"):
+                    value, count = button.text.rsplit(" (", 1)
+                    values[value] = int(count.rstrip(")"))
+            offset += bot.FACET_PAGE_SIZE
+        return values
+
+    song = database.add_song(db, title="Просмотр мест", region="Местные|Хутор Обзорный")
+    assert asyncio.run(place_counts())["Хутор Обзорный"] == 1
+    database.add_song(db, title="Просмотр мест второй", region="Местные|Хутор Обзорный")
+    assert asyncio.run(place_counts())["Хутор Обзорный"] == 2
+    database.delete_song(db, song.id)
+    assert asyncio.run(place_counts()) == _counts(database, db, "place")
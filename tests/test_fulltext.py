@@ -0,0 +1,40 @@
+"""Полнотекстовый поиск не различает ё и е ни в тексте, ни в запросе"""
+from sqlalchemy import text as sql_text
+
+def _ids(database, db, query):
+    return {song.id for song in database.search_by_text(db, query)}
+
+def test_yo_is_folded_in_text_and_query(database, db):
+    yo = database.add_song(db, title="Белая берёзка", region="Лирические|Село", text="во поле берёзка стояла")
+    ye = database.add_song(db, title="Зеленая березонька", region="Лирические|Село", text="зеленая березонька кудрявая")
+    assert {yo.id, ye.id} <= _ids(database, db, "берез")
+    assert {yo.id, ye.id} <= _ids(database, db, "берёз")
+    assert yo.id in _ids(database, db, "БЕРЁЗКА стояла")
+
+    database.update_song(db, yo.id, text="ёлочка зелёная")
+    assert yo.id not in _ids(database, db, "берез")
+    assert yo.id in _ids(database, db, "елочка зеленая")
+
+    database.delete_song(db, yo.id)
+    assert yo.id not in _ids(database, db, "елочка")
+
+def test_old_index_is_rebuilt_with_folding(database, db):
+    song = database.add_song(db, title="Тёмная ноченька", region="Лирические|Село", text="тёмная ноченька осенняя")
+    with database.engine.begin() as conn:
+        for name in ("folk_songs_fts_ai", "folk_songs_fts_ad", "folk_songs_fts_au"):
+            conn.execute(sql_text(f"DROP TRIGGER {name}"))
+        conn.execute(sql_text("DROP TABLE folk_songs_fts"))
+        conn.execute(sql_text(
+            "CREATE VIRTUAL TABLE folk_songs_fts USING fts5("
+            "text, content='folk_songs', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+        conn.execute(sql_text(
+            "CREATE TRIGGER folk_songs_fts_ai AFTER INSERT ON folk_songs BEGIN "
+            "INSERT INTO folk_songs_fts(rowid, text) VALUES (new.id, new.text); END"
+        ))
+        conn.execute(sql_text("INSERT INTO folk_songs_fts(folk_songs_fts) VALUES ('rebuild')"))
+    assert song.id not in _ids(database, db, "темная")
+
+    database.setup_fulltext()
+    assert song.id in _ids(database, db, "темная")
+    assert song.id in _ids(database, db, "тёмная")
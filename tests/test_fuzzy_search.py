@@ -0,0 +1,102 @@
+"""Нечеткий поиск по названию на SQLite (триграммный индекс в памяти)"""
+import threading
+from types import SimpleNamespace
+
+def _titles(database, db, query):
+    return [song.title for song in database.search_by_title_fuzzy(db, query)]
+
+def test_index_picks_up_writes_from_other_processes(database, db):
+    song = database.add_song(db, title="Ой да во поле берёзонька", region="Хороводные|Село")
+    assert "Ой да во поле берёзонька" in _titles(database, db, "во поле березонька")
+
+    # Другой процесс (админ-бот, импорт) пишет в базу мимо add_song_listener этого процесса
+    with database.session_scope() as session:
+        session.query(database.Song).filter(database.Song.id == song.id).update({"title": "Сеяли ленок"})
+        database._record_change(session, song.id)
+        other = database.Song(title="Ходила младёшенька по борочку", region="Лирические")
+        session.add(other)
+        session.flush()
+        database._record_change(session, other.id)
+        session.commit()
+
+    assert "Ой да во поле берёзонька" not in _titles(database, db, "во поле березонька")
+    assert "Сеяли ленок" in _titles(database, db, "сеяли ленок")
+    assert "Ходила младёшенька по борочку" in _titles(database, db, "ходила младешенька")
+
+def test_listener_waits_for_index_rebuild(database, db):
+    # Пока индекс строится или сверяется с журналом, слушатель не меняет его и не сбрасывает
+    database._get_title_index(db)
+    song = SimpleNamespace(id=-1, title="Запевка из слушателя")
+    with database._title_index_lock:
+        listener = threading.Thread(target=database._update_title_index, args=("add", song))
+        listener.start()
+        listener.join(0.2)
+        assert listener.is_alive()
+    listener.join()
+    assert -1 in [song_id for song_id, _ in database._get_title_index(db).search("запевка из слушателя")]
+
+    database._update_title_index("delete", song)
+    assert -1 not in [song_id for song_id, _ in database._get_title_index(db).search("запевка из слушателя")]
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+    def first(self):
+        return None if self.value is None else (self.value,)
+
+class _PostgresConnection:
+    """Соединение PostgreSQL, которое записывает выполненные команды и отвечает на проверки каталога"""
+
+    def __init__(self, index_valid, extension):
+        self.index_valid = index_valid
+        self.extension = extension
+        self.statements = []
+        self.options = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execution_options(self, **options):
+        self.options.update(options)
+        return self
+
+    def execute(self, statement):
+        sql = str(statement)
+        self.statements.append(sql)
+        if "pg_index" in sql:
+            return _Result(self.index_valid)
+        if "pg_extension" in sql:
+            return _Result(1 if self.extension else None)
+        return _Result(None)
+
+def _migrate(database, monkeypatch, index_valid, extension):
+    connection = _PostgresConnection(index_valid, extension)
+    engine = SimpleNamespace(dialect=SimpleNamespace(name="postgresql"), connect=lambda: connection)
+    monkeypatch.setattr(database, "engine", engine)
+    database.migrate_title_trigram_index()
+    return [sql for sql in connection.statements if "pg_index" not in sql and "pg_extension" not in sql], connection
+
+def test_trigram_index_migration(database, monkeypatch):
+    # Индекс уже построен: ни расширения, ни DDL при запуске
+    assert _migrate(database, monkeypatch, index_valid=True, extension=True)[0] == []
+
+    statements, connection = _migrate(database, monkeypatch, index_valid=None, extension=False)
+    assert statements == [
+        "CREATE EXTENSION pg_trgm",
+        "CREATE INDEX CONCURRENTLY ix_folk_songs_title_trgm ON folk_songs USING GIN (title gin_trgm_ops)"
+    ]
+    assert connection.options == {"isolation_level": "AUTOCOMMIT"}
+
+    # Нерабочий индекс после прерванного построения пересоздается; расширение уже есть
+    statements, _ = _migrate(database, monkeypatch, index_valid=False, extension=True)
+    assert statements == [
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_folk_songs_title_trgm",
+        "CREATE INDEX CONCURRENTLY ix_folk_songs_title_trgm ON folk_songs USING GIN (title gin_trgm_ops)"
+    ]
@@ -0,0 +1,120 @@
+"""Экспорт copyscript и восстановление через importscript"""
+import json
+import os
+import tracemalloc
+
+from sqlalchemy import func, insert
+from sqlalchemy import text as sql_text
+
+from copyscript import export_songs_to_json, song_to_dict
+from importscript import import_songs
+
+def _export(database, db, tmp_path, songs, name="backup.jsonl"):
+    filename = str(tmp_path / name)
+    export_songs_to_json(filename, fmt="jsonl", since_id=min(song.id for song in songs) - 1)
+    with open(filename, encoding="utf-8") as f:
+        return filename, [json.loads(line) for line in f]
+
+def test_export_import_round_trip_keeps_ids(database, db, tmp_path):
+    songs = [
+        database.add_song(db, title=f"Резервная {number}", region="Обрядовые|Копьево", text=f"куплет {number}")
+        for number in range(5)
+    ]
+    filename, exported = _export(database, db, tmp_path, songs)
+    originals = {item["id"]: item for item in exported}
+    assert {song.id for song in songs} <= set(originals)
+
+    for song_id in originals:
+        database.delete_song(db, song_id)
+    stats = import_songs(filename, batch_size=2)
+    assert stats["inserted"] == len(originals) and stats["renumbered"] == 0
+
+    db.expire_all()
+    restored = {song.id: song_to_dict(song) for song in database.get_songs_by_ids(db, list(originals))}
+    assert restored == originals
+
+    # После явных id база продолжает нумерацию без конфликтов
+    assert database.add_song(db, title="После восстановления", region="Обрядовые|Копьево").id > max(originals)
+
+def test_taken_ids_are_renumbered(database, db, tmp_path):
+    song = database.add_song(db, title="Занятый id", region="Обрядовые|Заняво", text="старая песня")
+    filename = str(tmp_path / "taken.jsonl")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"id": song.id, "title": "Другая песня", "region": "Обрядовые|Заняво", "text": "новая"},
+                           ensure_ascii=False) + "\n")
+        f.write(json.dumps({"title": "Без id", "region": "Обрядовые|Заняво", "text": "без id"},
+                           ensure_ascii=False) + "\n")
+
+    stats = import_songs(filename)
+    assert stats["inserted"] == 2 and stats["renumbered"] == 1
+    db.expire_all()
+    assert database.get_song_by_id(db, song.id).title == "Занятый id"
+    titles = {item.title for item in database.get_songs_by_place(db, "Заняво")}
+    assert titles == {"Занятый id", "Другая песня", "Без id"}
+
+def test_new_ids_flag(database, db, tmp_path):
+    songs = [database.add_song(db, title=f"Перенумерация {n}", region="Обрядовые|Новоселки", text="") for n in range(2)]
+    filename, exported = _export(database, db, tmp_path, songs, "renumber.jsonl")
+    # Песня после экспортированных: SQLite иначе снова выдал бы освободившиеся наибольшие id
+    database.add_song(db, title="Перенумерация после", region="Обрядовые|Другое", text="")
+    for item in exported:
+        database.delete_song(db, item["id"])
+    import_songs(filename, keep_ids=False)
+    db.expire_all()
+    restored = database.get_songs_by_place(db, "Новоселки")
+    assert len(restored) == 2
+    assert not {song.id for song in restored} & {item["id"] for item in exported}
+
+# Предел памяти экспорта: пачка из EXPORT_BATCH_SIZE песен, а не весь архив
+EXPORT_MEMORY_LIMIT = 12 * 1024 * 1024
+
+def test_export_memory_does_not_grow_with_archive(database, db, tmp_path):
+    first = db.query(func.max(database.Song.id)).scalar() or 0
+    lyrics = "ой да по полю по чистому " * 40
+    rows = [
+        {"title": f"Большой архив {number}", "region": "Большие|Экспортово", "text": lyrics,
+         "category": "Большие", "place": "Экспортово"}
+        for number in range(20000)
+    ]
+    db.execute(insert(database.Song), rows)
+    db.commit()
+    try:
+        filename = str(tmp_path / "large.jsonl")
+        tracemalloc.start()
+        try:
+            export_songs_to_json(filename, fmt="jsonl", since_id=first)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert os.path.getsize(filename) > 3 * EXPORT_MEMORY_LIMIT
+        assert peak < EXPORT_MEMORY_LIMIT
+    finally:
+        with database.engine.begin() as conn:
+            conn.execute(sql_text("DELETE FROM folk_songs WHERE id > :first"), {"first": first})
+        database.notify_bulk_change(db)
+
+def test_fingerprints_are_optional(database, db, tmp_path):
+    filename = str(tmp_path / "fingerprints.jsonl")
+
+    def write(title):
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"title": title, "region": "Обрядовые|Отпечатково", "text": f"{title} куплет про отпечатки"},
+                               ensure_ascii=False) + "\n")
+
+    def fingerprinted(title):
+        song, = database.search_by_title(db, title)
+        return db.query(database.SongFingerprint).filter(database.SongFingerprint.song_id == song.id).count() > 0
+
+    write("Отложенные отпечатки")
+    stats = import_songs(filename)
+    assert "fingerprint_seconds" not in stats
+    assert not fingerprinted("Отложенные отпечатки")
+
+    write("Сразу с отпечатками")
+    stats = import_songs(filename, fingerprints=True)
+    assert stats["fingerprinted"] == 1 and stats["fingerprint_seconds"] >= 0
+    assert fingerprinted("Сразу с отпечатками")
+    # Проверялись только добавленные песни: отложенная ждет общего прохода при запуске
+    assert not fingerprinted("Отложенные отпечатки")
+    database.migrate_fingerprints()
+    assert fingerprinted("Отложенные отпечатки")
@@ -0,0 +1,105 @@
+"""Inline-режим: задержка и отмена запросов, кэш по запросу и смещению, постраничные ответы"""
+import asyncio
+from types import SimpleNamespace
+
+from inline_search import InlineSearch
+
+class InlineQuery:
+    def __init__(self, user_id: int, query: str, offset: str = ""):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.query = query
+        self.offset = offset
+        self.answers = []
+
+    async def answer(self, results, cache_time=None, next_offset=None):
+        self.answers.append((results, cache_time, next_offset))
+
+class Context:
+    """context.application.create_task как в PTB: обычная задача event loop"""
+
+    def __init__(self):
+        self.application = SimpleNamespace(create_task=lambda coroutine, update=None: asyncio.ensure_future(coroutine))
+
+def _update(inline_query):
+    return SimpleNamespace(inline_query=inline_query)
+
+class Search:
+    def __init__(self, delay: float = 0):
+        self.calls = []
+        self.delay = delay
+
+    async def __call__(self, query, offset):
+        self.calls.append((query, offset))
+        await asyncio.sleep(self.delay)
+        return [f"{query}:{offset}"], "next"
+
+def test_keystrokes_are_debounced_and_cancelled():
+    search = Search()
+    inline = InlineSearch(search, debounce=0.2, ttl=30)
+
+    async def scenario():
+        context = Context()
+        queries = [InlineQuery(1, text) for text in ("к", "ка", "кал")] + [InlineQuery(2, "сад")]
+        for query in queries:
+            await inline.handle(_update(query), context)
+            await asyncio.sleep(0.01)
+        while inline._tasks:
+            await asyncio.sleep(0.01)
+        return queries
+
+    queries = asyncio.run(scenario())
+    assert sorted(search.calls) == [("кал", ""), ("сад", "")]
+    assert [len(query.answers) for query in queries] == [0, 0, 1, 1]
+    assert queries[2].answers[0] == (["кал:"], 30, "next")
+    assert (inline.stats()["cancelled"], inline.stats()["answered"]) == (2, 2)
+
+def test_answers_are_cached_by_query_and_offset():
+    search = Search()
+    inline = InlineSearch(search, debounce=0, ttl=30)
+
+    async def scenario():
+        context = Context()
+        for user_id, text, offset in ((1, "Калинка", ""), (2, " калинка ", ""), (3, "калинка", "title:a5"), (4, "калинка", "")):
+            await inline.handle(_update(InlineQuery(user_id, text, offset)), context)
+            while inline._tasks:
+                await asyncio.sleep(0.001)
+
+    asyncio.run(scenario())
+    assert search.calls == [("калинка", ""), ("калинка", "title:a5")]
+    assert (inline.cache.hits, inline.cache.misses) == (2, 2)
+
+def test_slow_search_is_answered_empty_and_not_cached():
+    search = Search(delay=0.2)
+    inline = InlineSearch(search, debounce=0, ttl=30, timeout=0.05)
+
+    async def scenario():
+        query = InlineQuery(1, "медленно")
+        await inline.handle(_update(query), Context())
+        while inline._tasks:
+            await asyncio.sleep(0.01)
+        return query
+
+    query = asyncio.run(scenario())
+    assert query.answers == [([], 0, None)]
+    assert inline.stats()["timeouts"] == 1
+    assert len(inline.cache) == 0
+
+def test_search_inline_pages_titles_and_falls_back_to_lyrics(database, db):
+    import bot
+
+    for number in range(12):
+        database.add_song(db, title=f"Инлайновая {number}", region="Встречные|Инлайново", text="")
+    database.add_song(db, title="Без слова в названии", region="Встречные|Инлайново", text="перепелочка")
+
+    async def scenario():
+        first, next_offset = await bot.search_inline("инлайновая", "")
+        second, last_offset = await bot.search_inline("инлайновая", next_offset)
+        by_text, _ = await bot.search_inline("перепелочка", "")
+        return first, next_offset, second, last_offset, by_text
+
+    first, next_offset, second, last_offset, by_text = asyncio.run(scenario())
+    assert [result.title for result in first] == [f"Инлайновая {number}" for number in range(10)]
+    assert next_offset.startswith("title:a")
+    assert [result.title for result in second] == ["Инлайновая 10", "Инлайновая 11"]
+    assert last_offset == ""
+    assert [result.title for result in by_text] == ["Без слова в названии"]
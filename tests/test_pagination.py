@@ -0,0 +1,74 @@
+"""Постраничная выдача: курсоры a<id>/b<id> по ключу и o<n> в ранжированной выдаче"""
+from bot import build_page_keyboard
+
+def _walk_forward(database, db, kind, query, limit):
+    pages, cursor = [], None
+    while True:
+        page = database.get_songs_page(db, kind, query, cursor, limit)
+        pages.append(page)
+        if not page.next_cursor:
+            return pages
+        cursor = page.next_cursor
+
+def _walk_back(database, db, kind, query, cursor, limit):
+    pages = []
+    while cursor:
+        page = database.get_songs_page(db, kind, query, cursor, limit)
+        pages.append(page)
+        cursor = page.prev_cursor
+    return pages
+
+def _ids(page):
+    return [song.id for song in page.songs]
+
+def test_keyset_pages_forward_and_back(database, db):
+    songs = [
+        database.add_song(db, title=f"Страничная {number}", region="Листовые|Страницыно", text="")
+        for number in range(25)
+    ]
+    pages = _walk_forward(database, db, "title", "страничная", 10)
+    assert [_ids(page) for page in pages] == [
+        [song.id for song in songs[:10]], [song.id for song in songs[10:20]], [song.id for song in songs[20:]]
+    ]
+    assert pages[0].prev_cursor is None
+    assert pages[1].prev_cursor == f"b{songs[10].id}" and pages[1].next_cursor == f"a{songs[19].id}"
+    assert pages[-1].next_cursor is None
+
+    back = _walk_back(database, db, "title", "страничная", pages[-1].prev_cursor, 10)
+    assert [_ids(page) for page in back] == [_ids(pages[1]), _ids(pages[0])]
+    # Вернулись на первую страницу: кнопки "Назад" нет, "Далее" ведет на вторую
+    assert back[-1].prev_cursor is None
+    assert back[-1].next_cursor == pages[0].next_cursor
+
+def test_ranked_pages_forward_and_back(database, db):
+    for number in range(23):
+        database.add_song(db, title=f"Ранжированная {number}", region="Листовые|Страницыно",
+                          text="переборы " * (number + 1) + "гусельки")
+    pages = _walk_forward(database, db, "text", "гусельки", 10)
+    assert [len(page.songs) for page in pages] == [10, 10, 3]
+    assert [page.next_cursor for page in pages] == ["o10", "o20", None]
+    assert [page.prev_cursor for page in pages] == [None, "o0", "o10"]
+    assert len({song_id for page in pages for song_id in _ids(page)}) == 23
+
+    back = _walk_back(database, db, "text", "гусельки", pages[-1].prev_cursor, 10)
+    assert [_ids(page) for page in back] == [_ids(pages[1]), _ids(pages[0])]
+    assert back[-1].prev_cursor is None
+
+def test_empty_page(database, db):
+    page = database.get_songs_page(db, "title", "такого названия точно нет")
+    assert page == database.Page([], None, None)
+
+def test_keyboard_cursors_survive_callback_data(database, db):
+    for number in range(12):
+        database.add_song(db, title=f"Кнопочная {number}", region="Листовые|Кнопкино", text="")
+    first = database.get_songs_page(db, "title", "кнопочная")
+    second = database.get_songs_page(db, "title", "кнопочная", first.next_cursor)
+    keyboard = build_page_keyboard(second, "title").inline_keyboard
+
+    assert [row[0].callback_data for row in keyboard[:-1]] == [f"song_{song.id}" for song in second.songs]
+    back = keyboard[-1][0].callback_data
+    assert len(back.encode("utf-8")) <= 64
+    # page_callback разбирает callback_data так же
+    kind, cursor = back[len("page_"):].rsplit("_", 1)
+    assert (kind, cursor) == ("title", second.prev_cursor)
+    assert _ids(database.get_songs_page(db, kind, "кнопочная", cursor)) == _ids(first)
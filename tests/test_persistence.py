@@ -0,0 +1,151 @@
+"""Состояние диалогов в conversation_state: загрузка по требованию, пакетная запись, TTL и выгрузка"""
+import asyncio
+import time
+
+from telegram.ext import Application
+
+from loadtest import FakeBotAPI
+from persistence import SQLPersistence
+
+BOT = "test"
+
+def _persistence(**kwargs):
+    return SQLPersistence(BOT, update_interval=60, **kwargs)
+
+def _stored(database, user_id, ttl=3600):
+    with database.session_scope() as db:
+        return database.load_user_state(db, BOT, user_id, ttl)
+
+def test_state_survives_restart(database):
+    state = {"search": {"kind": "text", "query": "калинка", "description": "по тексту"}}
+
+    async def before_restart():
+        persistence = _persistence()
+        await persistence.refresh_user_data(1001, {})
+        await persistence.update_user_data(1001, state)
+        return persistence.stats()
+
+    assert asyncio.run(before_restart())["writes"] == 1
+    assert _stored(database, 1001) == state
+
+    async def after_restart():
+        persistence = _persistence()
+        user_data = {}
+        await persistence.refresh_user_data(1001, user_data)
+        await persistence.refresh_user_data(1001, user_data)
+        # Неизменившиеся данные повторно не пишутся
+        await persistence.update_user_data(1001, dict(user_data))
+        return user_data, persistence.stats()
+
+    user_data, stats = asyncio.run(after_restart())
+    assert user_data == state
+    assert (stats["loads"], stats["writes"], stats["skipped"]) == (1, 0, 1)
+
+def test_updates_are_written_in_one_batch(database):
+    async def scenario():
+        persistence = _persistence()
+        await asyncio.gather(*(
+            persistence.update_user_data(user_id, {"step": user_id}) for user_id in (1101, 1102, 1103)
+        ))
+        return persistence.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["batches"], stats["writes"]) == (1, 3)
+    assert [_stored(database, user_id) for user_id in (1101, 1102, 1103)] == [{"step": 1101}, {"step": 1102}, {"step": 1103}]
+
+def test_empty_data_and_drop_delete_the_record(database):
+    async def scenario():
+        persistence = _persistence()
+        await persistence.update_user_data(1201, {"step": "add"})
+        await persistence.update_user_data(1202, {"step": "edit"})
+        await persistence.update_user_data(1201, {})
+        await persistence.drop_user_data(1202)
+
+    asyncio.run(scenario())
+    assert _stored(database, 1201) is None
+    assert _stored(database, 1202) is None
+
+def test_expired_dialogs_are_not_loaded_and_pruned(database):
+    async def save():
+        persistence = _persistence()
+        await persistence.update_user_data(1301, {"step": "add"})
+
+    asyncio.run(save())
+    time.sleep(0.05)
+
+    async def load():
+        persistence = _persistence(ttl=0.01)
+        user_data = {}
+        await persistence.refresh_user_data(1301, user_data)
+        return user_data
+
+    assert asyncio.run(load()) == {}
+    with database.session_scope() as db:
+        assert database.prune_user_states(db, 0.01) >= 1
+    assert _stored(database, 1301) is None
+
+def test_idle_users_are_unloaded_but_kept_in_database(database):
+    class StubApplication:
+        dropped = []
+
+        async def update_persistence(self):
+            pass
+
+        def drop_user_data(self, user_id):
+            self.dropped.append(user_id)
+
+    async def scenario():
+        persistence = _persistence(idle=0)
+        await persistence.refresh_user_data(1401, {})
+        await persistence.update_user_data(1401, {"step": "delete"})
+        application = StubApplication()
+        assert await persistence.evict_idle(application) == 1
+        # PTB затем вызывает drop_user_data для выгруженного пользователя
+        for user_id in application.dropped:
+            await persistence.drop_user_data(user_id)
+        return application.dropped, persistence.stats()
+
+    dropped, stats = asyncio.run(scenario())
+    assert dropped == [1401]
+    assert stats["users_in_memory"] == 0
+    assert _stored(database, 1401) == {"step": "delete"}
+
+def test_eviction_keeps_change_from_the_same_cycle(database):
+    async def scenario():
+        persistence = _persistence(idle=0)
+        application = Application.builder().token("123:test").updater(None).request(FakeBotAPI()) \
+            .persistence(persistence).build()
+        # Обновление обработано, но PTB еще не передал его в update_user_data
+        await persistence.refresh_user_data(1501, application.user_data[1501])
+        application.user_data[1501]["step"] = "title"
+        application.mark_data_for_update_persistence(user_ids=1501)
+
+        assert await persistence.evict_idle(application) == 1
+        await application.update_persistence()
+        return 1501 in application.user_data
+
+    assert asyncio.run(scenario()) is False
+    assert _stored(database, 1501) == {"step": "title"}
+
+def test_user_with_failed_write_is_not_evicted(database, monkeypatch):
+    import persistence as module
+
+    def fail(*args):
+        raise RuntimeError("база недоступна")
+
+    class StubApplication:
+        async def update_persistence(self):
+            pass
+
+        def drop_user_data(self, user_id):
+            raise AssertionError("пользователь с несохраненной записью выгружен")
+
+    async def scenario():
+        persistence = _persistence(idle=0)
+        await persistence.refresh_user_data(1601, {})
+        monkeypatch.setattr(module, "save_user_states", fail)
+        await persistence.update_user_data(1601, {"step": "text"})
+        assert await persistence.evict_idle(StubApplication()) == 0
+        return persistence.stats()
+
+    assert asyncio.run(scenario())["pending"] == 1
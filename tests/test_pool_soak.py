@@ -0,0 +1,26 @@
+"""
+Соединения возвращаются в пул при любом исходе вызова run_db.
+
+Полный прогон на 100 000 вызовов: python loadtest.py --soak 100000
+(здесь число вызовов задает SOAK_REQUESTS, чтобы тесты шли быстро).
+"""
+import asyncio
+import os
+
+from loadtest import soak_pool
+
+SOAK_REQUESTS = int(os.getenv("SOAK_REQUESTS", "5000"))
+
+def test_pool_does_not_leak_connections(database, db):
+    if not db.query(database.Song.id).first():
+        database.add_song(db, title="Калина красная", region="Лирические|Село", text="калина красная")
+    song_ids = [row[0] for row in db.query(database.Song.id).all()]
+    db.close()
+
+    report = asyncio.run(soak_pool(SOAK_REQUESTS, 64, song_ids))
+
+    assert report["errors"] == SOAK_REQUESTS // 100
+    assert report["checkouts"] == report["checkins"] >= SOAK_REQUESTS
+    assert report["checked_out_after"] == 0
+    assert report["max_checked_out"] <= report["max_allowed"]
+    assert report["new_connections"] <= report["max_allowed"]
@@ -0,0 +1,62 @@
+"""Профилировщик медленных запросов: план в фоновом потоке и запросы с ошибкой"""
+import json
+import logging
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from profiling import QueryProfiler
+
+class _Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((threading.current_thread().name, json.loads(record.getMessage())))
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'profiling.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)"))
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def records():
+    handler = _Records()
+    log = logging.getLogger("slow_queries")
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    yield handler.records
+    log.removeHandler(handler)
+
+def test_plan_is_built_in_background(engine, records, tmp_path):
+    profiler = QueryProfiler(engine, threshold_ms=0, log_path=str(tmp_path / "slow.log"))
+    profiler.attach()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT name FROM items WHERE id = :id"), {"id": 1}).all()
+        profiler.flush()
+    finally:
+        profiler.detach()
+
+    thread, record = next(item for item in records if "items" in item[1]["statement"])
+    assert thread == "slow-query-explain"
+    assert record["parameters"] == [1]
+    assert "SEARCH items" in record["plan"]
+
+def test_failed_statement_does_not_leave_start_time(engine, tmp_path):
+    profiler = QueryProfiler(engine, threshold_ms=10_000, log_path=str(tmp_path / "slow.log"), explain=False)
+    profiler.attach()
+    try:
+        with engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(Exception):
+                    connection.execute(text("SELECT * FROM missing_table"))
+            connection.execute(text("SELECT 1")).all()
+            assert connection.info["query_started"] == []
+    finally:
+        profiler.detach()
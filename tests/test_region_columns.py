@@ -0,0 +1,34 @@
+"""Строка региона "категория|место" хранится и в колонках category и place"""
+from sqlalchemy import text as sql_text
+
+def test_split_region(database):
+    assert database.split_region("Лирические|Село Верхнее") == ("Лирические", "Село Верхнее")
+    assert database.split_region("Лирические| Село Верхнее |лишнее") == ("Лирические", "Село Верхнее")
+    assert database.split_region("Лирические|.") == ("Лирические", None)
+    assert database.split_region("Лирические") == ("Лирические", None)
+    assert database.split_region("") == ("", None)
+
+def test_columns_follow_region(database, db):
+    song = database.add_song(db, title="Колонки", region="Колоночные|Столбово", text="")
+    db.expire_all()
+    stored = database.get_song_by_id(db, song.id)
+    assert (stored.category, stored.place) == ("Колоночные", "Столбово")
+
+    database.update_song(db, song.id, region="Строчные|.")
+    db.expire_all()
+    stored = database.get_song_by_id(db, song.id)
+    assert (stored.region, stored.category, stored.place) == ("Строчные|.", "Строчные", None)
+
+    database.update_song(db, song.id, title="Колонки без смены региона")
+    db.expire_all()
+    assert database.get_song_by_id(db, song.id).category == "Строчные"
+
+def test_existing_rows_are_backfilled(database, db):
+    song = database.add_song(db, title="Старая строка", region="Довоенные|Заполнино", text="")
+    with database.engine.begin() as conn:
+        conn.execute(sql_text("UPDATE folk_songs SET category = NULL, place = NULL WHERE id = :id"), {"id": song.id})
+
+    database.migrate_region_columns(batch_size=1)
+    db.expire_all()
+    stored = database.get_song_by_id(db, song.id)
+    assert (stored.category, stored.place) == ("Довоенные", "Заполнино")
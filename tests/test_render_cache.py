@@ -0,0 +1,67 @@
+"""Кэш готовых страниц просмотра: сброс по поколению при записи в этом и в другом процессе"""
+import asyncio
+
+from cache import RenderCache
+
+def test_local_write_invalidates(database, db):
+    cache = RenderCache(poll_interval=0)
+    cache.put(("all", None, None), "страница", cache.generation)
+    assert cache.get(("all", None, None)) == "страница"
+
+    song = database.add_song(db, title="Кэш клавиатур", region="Рендерные|Село Кнопочное")
+    assert cache.get(("all", None, None)) is None
+    assert cache.invalidations == 1
+
+    cache.put(("all", None, None), "новая", cache.generation)
+    database.delete_song(db, song.id)
+    assert cache.get(("all", None, None)) is None
+    assert cache.stats()["invalidations"] == 2
+
+def test_page_read_before_invalidation_is_not_stored():
+    cache = RenderCache(poll_interval=0)
+    generation = cache.generation
+    # Страница читалась, пока архив менялся: она может быть устаревшей
+    cache.invalidate()
+    cache.put(("all", None, None), "устаревшая", generation)
+    assert cache.get(("all", None, None)) is None
+    assert len(cache) == 0
+
+    cache.put(("all", None, None), "свежая", cache.generation)
+    assert cache.get(("all", None, None)) == "свежая"
+
+def test_write_in_other_process_invalidates_on_sync(database, db):
+    song = database.add_song(db, title="Кэш клавиатур чужой", region="Рендерные|Село Кнопочное")
+    cache = RenderCache(poll_interval=0)
+    cache.sync(db)
+    cache.put(("category", "рендерные", None), "страница", cache.generation)
+    cache.sync(db)
+    assert cache.get(("category", "рендерные", None)) == "страница"
+
+    # Запись другого процесса видна только по журналу archive_changes, слушатели здесь не вызываются
+    with database.session_scope() as session:
+        session.query(database.Song).filter(database.Song.id == song.id).update({"title": "Переименована"})
+        database._record_change(session, song.id)
+        session.commit()
+    generation = cache.generation
+    assert cache.get(("category", "рендерные", None)) == "страница"
+    cache.sync(db)
+    assert cache.generation == generation + 1
+    assert cache.get(("category", "рендерные", None)) is None
+
+def test_browse_view_is_served_from_cache_until_write(database, db):
+    import bot
+
+    async def view():
+        page, reply_markup = await bot.get_page_view("place", "кнопочное")
+        return [song.id for song in page.songs], reply_markup
+
+    first = database.add_song(db, title="Кнопки места", region="Рендерные|Село Кнопочное")
+    ids, markup = asyncio.run(view())
+    assert first.id in ids
+    # Повторный просмотр - та же клавиатура из кэша, без сборки заново
+    assert asyncio.run(view())[1] is markup
+
+    second = database.add_song(db, title="Кнопки места новые", region="Рендерные|Село Кнопочное")
+    ids, fresh = asyncio.run(view())
+    assert fresh is not markup
+    assert {first.id, second.id} <= set(ids)
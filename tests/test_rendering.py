@@ -0,0 +1,83 @@
+"""Длинные тексты: страницы по куплетам в пределах 4096 единиц UTF-16 и файл .txt для очень длинных"""
+import asyncio
+
+import rendering
+from rendering import MESSAGE_LIMIT, render_song, send_rendered, split_text, text_length
+
+def _verses(count: int, line: str = "Ой да калинушка со малинушкою 🌸") -> str:
+    return "\n\n".join("\n".join(f"{line} {verse}.{row}" for row in range(4)) for verse in range(count))
+
+def test_utf16_length():
+    assert text_length("калина") == 6
+    assert text_length("🌸") == 2
+    assert len("🌸" * 3000) <= MESSAGE_LIMIT < text_length("🌸" * 3000)
+
+def test_pages_fit_the_limit_and_keep_verses():
+    text = _verses(60)
+    header, footer = "Калинушка\nЛирические, Село\n\n", "\n\nID: 7"
+    rendered = render_song(7, header, text, footer)
+
+    assert 1 < len(rendered.pages) <= rendering.LYRICS_MAX_PAGES
+    assert all(text_length(page) <= MESSAGE_LIMIT for page in rendered.pages)
+    assert rendered.pages[0].startswith(header)
+    assert rendered.pages[-1].endswith(f"{footer}\n\n[стр. {len(rendered.pages)}/{len(rendered.pages)}]")
+    assert rendered.document is None
+    # Куплеты не разрезаются: каждая страница начинается с начала куплета
+    verses = text.split("\n\n")
+    for page in rendered.pages[1:]:
+        assert page.split("\n\n")[0] in verses
+
+def test_split_without_verse_breaks():
+    line = "🌸" * 5000
+    chunks = split_text(line, 1000)
+    assert "".join(chunks) == line
+    assert all(text_length(chunk) <= 1000 for chunk in chunks)
+
+    lines = "\n".join(f"строка {number} без пустых строк" for number in range(400))
+    chunks = split_text(lines, 1000)
+    assert "\n".join(chunks) == lines
+    assert all(text_length(chunk) <= 1000 for chunk in chunks)
+
+def test_short_song_is_one_page():
+    rendered = render_song(1, "Заголовок\n\n", "Один куплет", "\n\nID: 1")
+    assert rendered.pages == ("Заголовок\n\nОдин куплет\n\nID: 1",)
+    assert rendered.document is None
+
+class Message:
+    def __init__(self):
+        self.sent = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.sent.append(("text", text, reply_markup))
+
+    async def reply_document(self, document):
+        self.sent.append(("document", document.filename, document.input_file_content))
+
+class CallbackQuery:
+    def __init__(self):
+        self.message = Message()
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.message.sent.append(("edit", text, reply_markup))
+
+def test_very_long_song_is_sent_as_file():
+    text = _verses(400)
+    rendered = render_song(9, "Длинная\n\n", text, "\n\nID: 9")
+    assert len(split_text(text, MESSAGE_LIMIT)) > rendering.LYRICS_MAX_PAGES
+    assert rendered.document == "Длинная\n\n" + text + "\n\nID: 9"
+    assert rendered.filename == "song_9.txt"
+
+    query = CallbackQuery()
+    asyncio.run(send_rendered(query, rendered, 9))
+    (edit, summary, _), (kind, filename, content) = query.message.sent
+    assert (edit, summary) == ("edit", rendered.summary)
+    assert text_length(summary) <= MESSAGE_LIMIT
+    assert (kind, filename, content) == ("document", "song_9.txt", rendered.document.encode("utf-8"))
+
+def test_pages_are_turned_with_buttons():
+    rendered = render_song(5, "Листаемая\n\n", _verses(60), "")
+    query = CallbackQuery()
+    asyncio.run(send_rendered(query, rendered, 5, page=1))
+    (_, text, markup), = query.message.sent
+    assert text == rendered.pages[1]
+    assert [button.callback_data for button in markup.inline_keyboard[0]] == ["lyrics_5_0", "lyrics_5_2"]
@@ -0,0 +1,39 @@
+"""Кэш страниц результатов поиска"""
+import time
+
+from cache import SearchCache, normalize_query
+
+def test_normalize_query_ignores_case_and_spaces():
+    assert normalize_query("  Калинка   МАЛИНКА ") == "калинка малинка"
+    assert normalize_query(None) is None
+
+def test_query_case_shares_entry_and_results(database, db):
+    song = database.add_song(db, title="Калинка регистровая", region="Плясовые Регистровые|Село Тестовое")
+    cache = SearchCache()
+    upper = cache.get_page(db, "title", "КАЛИНКА регистровая")
+    lower = cache.get_page(db, "title", "калинка  регистровая")
+    assert [item.id for item in upper.songs] == [song.id]
+    assert lower is upper
+    assert len(cache) == 1
+
+    category = cache.get_page(db, "category", "плясовые регистровые")
+    assert [item.id for item in category.songs] == [song.id]
+
+def test_page_refreshed_after_write_in_other_process(database, db):
+    song = database.add_song(db, title="Кэш поиска старое", region="Тестовые|Деревня")
+    cache = SearchCache()
+    assert [item.id for item in cache.get_page(db, "title", "кэш поиска").songs] == [song.id]
+
+    with database.session_scope() as session:
+        session.query(database.Song).filter(database.Song.id == song.id).update({"title": "Переименована"})
+        database._record_change(session, song.id)
+        session.commit()
+    assert cache.get_page(db, "title", "кэш поиска").songs == []
+
+def test_entries_expire(database, db):
+    cache = SearchCache(ttl=0.01)
+    cache.get_page(db, "all")
+    key = ("all", None, None, database.PAGE_SIZE)
+    assert cache.get(key) is not None
+    time.sleep(0.02)
+    assert cache.get(key) is None
@@ -0,0 +1,119 @@
+"""Размер поискового индекса ведется при изменениях и совпадает с полным пересчетом"""
+import random
+import sys
+
+from cache import LocalChangeFeed
+from search_index import SearchIndex
+
+def _recount(index):
+    """Полный обход индекса, как считал memory_usage до введения счетчика"""
+    total = sum(
+        sys.getsizeof(container)
+        for container in (index._summaries, index._words, index._ids, index._categories, index._places)
+    )
+    total += sum(sys.getsizeof(summary) + sys.getsizeof(summary.title) for summary in index._summaries.values())
+    total += sum(sys.getsizeof(title) + sys.getsizeof(text) for title, text in index._words.values())
+    total += sum(
+        sys.getsizeof(key) + sys.getsizeof(ids)
+        for values in (index._categories, index._places) for key, ids in values.items()
+    )
+    for tokens in (index._title, index._text):
+        total += sys.getsizeof(tokens.postings) + sys.getsizeof(tokens.vocabulary) + sum(
+            sys.getsizeof(word) + sys.getsizeof(postings) for word, postings in tokens.postings.items()
+        )
+    return total
+
+def test_memory_usage_is_maintained_on_changes(database, db):
+    rng = random.Random(1)
+    words = ["калина", "береза", "рябина", "ручеек", "дорожка", "сокол", "лебедь", "поле"]
+    regions = ["Лирические|Село Верхнее", "Плясовые|Село Нижнее", "Хороводные|Деревня Заречье"]
+
+    def song_fields():
+        return {
+            "title": " ".join(rng.sample(words, 2)).capitalize(),
+            "region": rng.choice(regions),
+            "text": " ".join(rng.choices(words, k=12))
+        }
+
+    for _ in range(20):
+        database.add_song(db, **song_fields())
+    index = SearchIndex(feed=LocalChangeFeed(), poll_interval=0)
+    index.build(db)
+    assert index.memory_usage() == _recount(index)
+
+    added = []
+    for step in range(200):
+        if added and step % 3 == 2:
+            song_id = added.pop(rng.randrange(len(added)))
+            database.delete_song(db, song_id)
+        elif added and step % 3 == 1:
+            database.update_song(db, rng.choice(added), **song_fields())
+        else:
+            added.append(database.add_song(db, **song_fields()).id)
+        assert index.memory_usage() == _recount(index)
+
+    stats = index.stats()
+    assert stats["memory_bytes"] == _recount(index)
+    assert stats["songs"] == len(index._summaries)
+
+def _walk(get_page, cursor=None):
+    """Все страницы выдачи вперед от cursor: [(id песен, курсор назад, курсор вперед)]"""
+    pages = []
+    while True:
+        page = get_page(cursor)
+        pages.append(([song.id for song in page.songs], page.prev_cursor, page.next_cursor))
+        if not page.next_cursor:
+            return pages
+        cursor = page.next_cursor
+
+def test_index_pages_match_database_pages(database, db):
+    rng = random.Random(2)
+    words = ["сверка", "страниц", "индекса", "базы", "курсор", "листание"]
+    for number in range(120):
+        database.add_song(
+            db,
+            title=f"Сверка {' '.join(rng.sample(words, 2))} {number}",
+            region=rng.choice(["Сверочные|Село Листово", "Сверочные песни|Деревня Курсорово"]),
+            text=" ".join(rng.choices(words, k=rng.randint(3, 30)))
+        )
+    index = SearchIndex(feed=LocalChangeFeed(), poll_interval=0)
+    index.build(db)
+    queries = {"all": None, "title": "сверка", "category": "сверочные", "place": "листово", "text": "курсор базы"}
+
+    for kind, query in queries.items():
+        start = "i0" if kind == "text" else None
+        from_index = _walk(lambda cursor: index.get_page(kind, query, cursor))
+        from_database = _walk(lambda cursor: database.get_songs_page(db, kind, query, cursor or start))
+        assert from_index == from_database, kind
+        assert len(from_index) > 2, kind
+
+        # Назад с последней страницы - те же страницы в обратном порядке, до первой
+        back, cursor = [], from_index[-1][1]
+        while cursor:
+            page = database.get_songs_page(db, kind, query, cursor)
+            back.append([song.id for song in page.songs])
+            cursor = page.prev_cursor
+        assert back == [ids for ids, _, _ in reversed(from_index[:-1])], kind
+
+    # Текст по id - те же песни, что ранжированная выдача базы
+    ranked = _walk(lambda cursor: database.get_songs_page(db, "text", queries["text"], cursor))
+    indexed = [song_id for ids, _, _ in _walk(lambda cursor: index.get_page("text", queries["text"], cursor)) for song_id in ids]
+    assert sorted(indexed) == sorted(song_id for ids, _, _ in ranked for song_id in ids)
+
+    # Переход между индексом и базой посреди листания не теряет и не повторяет песни
+    for kind, query in queries.items():
+        seen, cursor, use_index = [], None, True
+        while True:
+            if use_index and index.supports(kind, cursor):
+                page = index.get_page(kind, query, cursor)
+            else:
+                page = database.get_songs_page(db, kind, query, cursor)
+            seen.extend(song.id for song in page.songs)
+            if not page.next_cursor:
+                break
+            cursor, use_index = page.next_cursor, not use_index
+        expected = index.search(kind, query)
+        assert sorted(seen) == expected and len(seen) == len(set(seen)), kind
+
+    # Ранжированный курсор базы индекс не листает
+    assert not index.supports("text", ranked[0][2])
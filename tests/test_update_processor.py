@@ -0,0 +1,71 @@
+"""Порядок обновлений одного пользователя и параллельность разных пользователей"""
+import asyncio
+import time
+
+from telegram import Update
+
+from loadtest import UpdateFactory
+from update_processor import PerUserUpdateProcessor
+
+factory = UpdateFactory()
+
+def _update(user_id: int, text: str = "сообщение"):
+    return Update.de_json(factory.message(user_id, text), None)
+
+class Recorder:
+    """Записывает начало и конец каждого обновления и наибольшее число одновременных"""
+
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.peak = 0
+
+    async def handle(self, user_id: int, number: int, duration: float):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.events.append(("start", user_id, number))
+        await asyncio.sleep(duration)
+        self.events.append(("end", user_id, number))
+        self.running -= 1
+
+async def _process(processor, items):
+    await asyncio.gather(*(processor.process_update(update, coroutine) for update, coroutine in items))
+    await processor.shutdown()
+
+def test_one_user_in_order_without_overlap():
+    processor, recorder = PerUserUpdateProcessor(8), Recorder()
+    # Первое обновление самое долгое: без очереди следующие закончились бы раньше
+    items = [(_update(1), recorder.handle(1, number, 0.05 - number * 0.01)) for number in range(5)]
+    asyncio.run(_process(processor, items))
+
+    assert recorder.events == [(kind, 1, number) for number in range(5) for kind in ("start", "end")]
+    assert recorder.peak == 1
+    assert processor.stats()["processed"] == 5
+    assert processor.max_queue_depth == 4
+
+def test_users_run_concurrently_up_to_limit():
+    processor, recorder = PerUserUpdateProcessor(4), Recorder()
+    items = [(_update(user_id), recorder.handle(user_id, 0, 0.1)) for user_id in range(8)]
+    started = time.perf_counter()
+    asyncio.run(_process(processor, items))
+    elapsed = time.perf_counter() - started
+
+    assert recorder.peak == 4
+    assert elapsed < 0.35
+    assert processor.stats()["processed"] == 8
+
+def test_queued_updates_do_not_take_slots():
+    """Пока первый пользователь ждет своей очереди, второй обрабатывается сразу"""
+    processor, recorder = PerUserUpdateProcessor(2), Recorder()
+    items = [(_update(1), recorder.handle(1, number, 0.05)) for number in range(6)]
+    items.append((_update(2), recorder.handle(2, 0, 0.01)))
+
+    async def scenario():
+        await asyncio.gather(*(processor.process_update(update, coroutine) for update, coroutine in items))
+        assert processor.stats()["queued"] == 5
+        await processor.shutdown()
+
+    asyncio.run(scenario())
+    finished = [event for event in recorder.events if event[0] == "end"]
+    assert finished.index(("end", 2, 0)) == 0
+    assert processor.max_queue_depth == 5
@@ -0,0 +1,148 @@
+"""ASGI-приложение webhook.py и доставка обновлений через webhook и getUpdates в нагрузочном тесте"""
+import asyncio
+import json
+
+import pytest
+from telegram.ext import Application
+
+from loadtest import FakeBotAPI, UpdateFactory, build_load_test
+from webhook import WebhookServer
+
+SECRET = "s3cret"
+
+async def _request(app, method: str, path: str, body: bytes = b"", secret: str = SECRET, release=None):
+    """Один HTTP-запрос к ASGI-приложению; release задерживает чтение тела запроса"""
+    headers = [(b"content-type", b"application/json")]
+    if secret is not None:
+        headers.append((b"x-telegram-bot-api-secret-token", secret.encode()))
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+    sent = []
+
+    async def receive():
+        if release is not None:
+            await release.wait()
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"], sent[1]["body"].decode("utf-8")
+
+@pytest.fixture
+def application():
+    return Application.builder().token("123:test").updater(None).request(FakeBotAPI()).build()
+
+def _update_body(user_id: int = 7) -> bytes:
+    return json.dumps(UpdateFactory().message(user_id, "/start")).encode("utf-8")
+
+def test_update_is_queued(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, webhook_url="")
+    status, _ = asyncio.run(_request(app, "POST", "/webhook/bot", _update_body()))
+    assert status == 200
+    assert application.update_queue.qsize() == 1
+    assert application.update_queue.get_nowait().effective_user.id == 7
+
+def test_replies_have_no_body_type(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, webhook_url="")
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": _update_body(), "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/webhook/bot",
+             "headers": [(b"x-telegram-bot-api-secret-token", SECRET.encode())]}
+    asyncio.run(app(scope, receive, send))
+    assert sent[0]["status"] == 200
+    assert dict(sent[0]["headers"]) == {b"content-length": b"0"}
+    assert sent[1]["body"] == b""
+
+def test_rejects_wrong_secret_path_and_body(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, webhook_url="")
+
+    async def scenario():
+        return [
+            (await _request(app, "POST", "/webhook/bot", _update_body(), secret=None))[0],
+            (await _request(app, "POST", "/webhook/bot", _update_body(), secret="wrong"))[0],
+            (await _request(app, "POST", "/webhook/other", _update_body()))[0],
+            (await _request(app, "GET", "/webhook/bot"))[0],
+            (await _request(app, "POST", "/webhook/bot", b"{not json"))[0]
+        ]
+
+    assert asyncio.run(scenario()) == [403, 403, 404, 404, 400]
+    assert application.update_queue.qsize() == 0
+
+def test_backpressure_when_queue_is_full(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, max_queue=1, webhook_url="")
+
+    async def scenario():
+        first = await _request(app, "POST", "/webhook/bot", _update_body(1))
+        second = await _request(app, "POST", "/webhook/bot", _update_body(2))
+        return first[0], second[0]
+
+    assert asyncio.run(scenario()) == (200, 503)
+    assert app.rejected == 1
+    assert application.update_queue.qsize() == 1
+
+def test_backpressure_when_requests_in_flight(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, max_concurrency=2, webhook_url="")
+
+    async def scenario():
+        release = asyncio.Event()
+        slow = [asyncio.create_task(_request(app, "POST", "/webhook/bot", _update_body(i), release=release))
+                for i in range(2)]
+        await asyncio.sleep(0.01)
+        assert app.in_flight == 2
+        rejected = await _request(app, "POST", "/webhook/bot", _update_body(3))
+        release.set()
+        return rejected[0], [status for status, _ in await asyncio.gather(*slow)]
+
+    assert asyncio.run(scenario()) == (503, [200, 200])
+    assert app.in_flight == 0
+
+async def _get_metrics(port: int) -> str:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await writer.drain()
+    response = (await reader.read()).decode("utf-8")
+    writer.close()
+    return response
+
+def test_metrics_only_on_local_port(application):
+    app = WebhookServer({"bot": application}, secret_token=SECRET, max_queue=1, webhook_url="",
+                        metrics_host="127.0.0.1", metrics_port=0)
+
+    async def scenario():
+        await _request(app, "POST", "/webhook/bot", _update_body(1))
+        await _request(app, "POST", "/webhook/bot", _update_body(2))
+        public = [
+            (await _request(app, "GET", "/metrics", secret=None))[0],
+            (await _request(app, "GET", "/metrics"))[0]
+        ]
+        await app.start_metrics()
+        try:
+            local = await _get_metrics(app.metrics_server.sockets[0].getsockname()[1])
+        finally:
+            app.metrics_server.close()
+            await app.metrics_server.wait_closed()
+        return public, local
+
+    public, local = asyncio.run(scenario())
+    assert public == [404, 404]
+    assert local.startswith("HTTP/1.1 200")
+    assert "webhook_updates_received_total 1" in local
+    assert "webhook_updates_rejected_total 1" in local
+    assert "webhook_requests_in_flight 0" in local
+
+@pytest.mark.parametrize("transport", ["webhook", "polling"])
+def test_load_test_delivers_through_transport(database, transport):
+    pytest.importorskip("uvicorn")
+    test = build_load_test("bot", transport, users=4, duration=1, think_time=0, api_latency=0,
+                           mix={"search_text": 1, "all": 1}, corpus_size=50)
+    report = asyncio.run(test.run())
+    assert report["updates"] > 0
+    assert report["timeouts"] == {}
+    assert report["delivery_errors"] == {}
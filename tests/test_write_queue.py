@@ -0,0 +1,95 @@
+"""Пакетная запись песен: одна транзакция на пачку, порядок вызовов, запись по одной после ошибки"""
+import asyncio
+
+from write_queue import WriteBatcher
+
+def _region(name: str) -> str:
+    return f"Пакетные|{name}"
+
+def test_concurrent_adds_share_one_batch(database, db):
+    batcher = WriteBatcher(max_delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(*(
+            batcher.add_song(f"Пачка {number}", _region("Одна"), "текст") for number in range(5)
+        ))
+
+    songs = asyncio.run(scenario())
+    assert [song.title for song in songs] == [f"Пачка {number}" for number in range(5)]
+    assert batcher.stats()["batches"] == 1
+    assert batcher.stats()["max_batch"] == 5
+    assert {song.id for song in database.get_songs_by_place(db, "Одна")} == {song.id for song in songs}
+
+def test_writes_follow_submission_order(database, db, monkeypatch):
+    song = database.add_song(db, title="Порядок", region=_region("Порядково"), text="")
+    events = []
+    monkeypatch.setattr(database, "_song_listeners", database._song_listeners + [
+        lambda event, changed: events.append((event, changed.id)) if event != "bulk" else None
+    ])
+    batcher = WriteBatcher(max_delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(
+            batcher.update_song(song.id, title="Порядок 1"),
+            batcher.add_song("Новая между изменениями", _region("Порядково")),
+            batcher.update_song(song.id, title="Порядок 2"),
+            batcher.update_song(song.id, title="Порядок 3")
+        )
+
+    results = asyncio.run(scenario())
+    assert results[1].title == "Новая между изменениями"
+    # Изменение, отправленное до добавления, записано раньше него
+    assert events == [("update", song.id), ("add", results[1].id), ("update", song.id), ("update", song.id)]
+    assert batcher.stats()["batches"] == 1
+    db.expire_all()
+    assert database.get_song_by_id(db, song.id).title == "Порядок 3"
+
+def test_failed_batch_is_written_one_by_one(database, db):
+    first = database.add_song(db, title="Первая", region=_region("Поодиночке"), text="")
+    second = database.add_song(db, title="Вторая", region=_region("Поодиночке"), text="")
+    batcher = WriteBatcher(max_delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(
+            batcher.update_song(first.id, text="изменена"),
+            batcher.update_song(10 ** 9, text="нет такой"),
+            batcher.update_song(second.id, text="изменена"),
+            return_exceptions=True
+        )
+
+    updated_first, missing, updated_second = asyncio.run(scenario())
+    assert isinstance(missing, ValueError)
+    assert (updated_first.id, updated_first.text) == (first.id, "изменена")
+    assert (updated_second.id, updated_second.text) == (second.id, "изменена")
+    assert batcher.stats()["fallbacks"] == 1
+
+def test_close_writes_pending_songs(database, db):
+    batcher = WriteBatcher(max_delay=60)
+
+    async def scenario():
+        pending = [asyncio.ensure_future(batcher.add_song(f"При остановке {n}", _region("Остановка"))) for n in range(3)]
+        await asyncio.sleep(0)
+        assert batcher.stats()["pending"] == 3
+        await batcher.close()
+        assert all(task.done() for task in pending)
+        return [task.result() for task in pending]
+
+    songs = asyncio.run(scenario())
+    assert batcher.stats()["pending"] == 0 and not batcher._flushes
+    assert len(database.get_songs_by_place(db, "Остановка")) == len(songs) == 3
+
+def test_flush_task_is_kept_until_done(database):
+    batcher = WriteBatcher(max_delay=0)
+
+    async def scenario():
+        task = asyncio.ensure_future(batcher.add_song("Задача пачки", _region("Ссылка")))
+        while not batcher._flushes:
+            await asyncio.sleep(0)
+        flushes = set(batcher._flushes)
+        await task
+        await asyncio.sleep(0)
+        return flushes
+
+    flushes = asyncio.run(scenario())
+    assert flushes and all(flush.done() for flush in flushes)
+    assert not batcher._flushes
@@ -0,0 +1,79 @@
+import threading
+from collections import defaultdict
+
+def normalize(value: str) -> str:
+    """Приводит строку к виду для сравнения: нижний регистр, ё → е"""
+    return (value or "").lower().replace("ё", "е")
+
+def trigrams(value: str) -> set:
+    """
+    Разбивает строку на триграммы так же, как pg_trgm:
+    каждое слово дополняется двумя пробелами слева и одним справа.
+    """
+    result = set()
+    for word in normalize(value).split():
+        word = "".join(ch for ch in word if ch.isalnum())
+        if not word:
+            continue
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            result.add(padded[i:i + 3])
+    return result
+
+class TrigramIndex:
+    """
+    Инвертированный индекс триграмм названий песен для нечеткого поиска.
+
+    Поиск просматривает только списки песен, у которых есть общие с запросом
+    триграммы, а не все названия архива.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(set)
+        self._grams = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._grams)
+
+    def add(self, song_id: int, title: str):
+        with self._lock:
+            self._remove(song_id)
+            grams = trigrams(title)
+            self._grams[song_id] = grams
+            for gram in grams:
+                self._postings[gram].add(song_id)
+
+    def remove(self, song_id: int):
+        with self._lock:
+            self._remove(song_id)
+
+    def _remove(self, song_id: int):
+        for gram in self._grams.pop(song_id, ()):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(song_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def search(self, query: str, limit: int = 20, threshold: float = 0.3):
+        """Возвращает список (song_id, similarity), отсортированный по убыванию сходства"""
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        with self._lock:
+            shared = defaultdict(int)
+            for gram in query_grams:
+                for song_id in self._postings.get(gram, ()):
+                    shared[song_id] += 1
+
+            scored = []
+            for song_id, common in shared.items():
+                total = len(query_grams) + len(self._grams[song_id]) - common
+                similarity = common / total
+                if similarity >= threshold:
+                    scored.append((song_id, similarity))
+
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
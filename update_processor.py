@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений (от разных пользователей) обрабатывается одновременно
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+# Сколько секунд ждать обработки очередей при остановке бота
+SHUTDOWN_TIMEOUT = float(os.getenv("UPDATE_SHUTDOWN_TIMEOUT", "10"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных пользователей параллельно, а обновления
+    одного пользователя - строго по очереди.
+
+    Многошаговые диалоги (/add, /edit) хранят состояние в context.user_data,
+    поэтому два сообщения одного пользователя нельзя обрабатывать одновременно.
+    Каждое обновление сразу попадает в очередь своего пользователя (семафор
+    базового класса занят лишь на время постановки в очередь). Очередь
+    пользователя разбирает отдельная задача; одновременно выполняется не
+    больше max_concurrent_updates обновлений, и ждут они только в очередях
+    пользователей, где их видно в stats.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_WORKERS):
+        super().__init__(max_concurrent_updates)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._queues = {}
+        self._tasks = set()
+        self.running = 0
+        self.processed = 0
+        self.max_queue_depth = 0
+
+    @staticmethod
+    def _ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            self.max_queue_depth = max(self.max_queue_depth, len(queue) - 1)
+            return
+
+        queue = self._queues[key] = deque([coroutine])
+        task = asyncio.create_task(self._drain(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key, queue):
+        """Обрабатывает очередь пользователя по одному обновлению, пока она не опустеет"""
+        try:
+            while queue:
+                await self._run(queue[0])
+                queue.popleft()
+        finally:
+            del self._queues[key]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            self.running += 1
+            try:
+                await coroutine
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+                self.processed += 1
+
+    def stats(self):
+        """Снимок метрик: активные пользователи, длина очередей, обработано обновлений"""
+        depths = [len(queue) - 1 for queue in list(self._queues.values())]
+        return {
+            "active_users": len(depths),
+            "queued": sum(depths),
+            "max_user_queue": max(depths, default=0),
+            "max_queue_depth": self.max_queue_depth,
+            "in_progress": self.running,
+            "processed": self.processed
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHUTDOWN_TIMEOUT
+        while self._queues and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for queue in list(self._queues.values()):
+            while len(queue) > 1:
+                queue.pop().close()
+        if self._queues:
+            logger.warning(f"Не обработаны обновления {len(self._queues)} пользователей")
+            for task in list(self._tasks):
+                task.cancel()
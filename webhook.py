@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import secrets
+
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import REGISTRY, METRICS_HOST, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, по которому Telegram достучится до этого процесса (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "5000"))
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_hex(16)
+# Сколько запросов обрабатывается одновременно и сколько обновлений может ждать в очереди
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+WEBHOOK_MAX_QUEUE = int(os.getenv("WEBHOOK_MAX_QUEUE", "1000"))
+# /metrics не отдается на публичном порту webhook, только на отдельном локальном (METRICS_HOST)
+WEBHOOK_METRICS_PORT = int(os.getenv("WEBHOOK_METRICS_PORT", "9100"))
+
+class WebhookServer:
+    """
+    ASGI-приложение, принимающее обновления Telegram для нескольких ботов.
+
+    Обновление бота name приходит POST-запросом на /webhook/<name> и кладется
+    в update_queue его Application. Если очередь переполнена или занято
+    WEBHOOK_MAX_CONCURRENCY запросов, отвечаем 503 - Telegram повторит доставку.
+    Метрики при запуске (lifespan) открываются на metrics_host:metrics_port;
+    metrics_port=None - без эндпоинта метрик.
+    """
+
+    def __init__(self, applications, secret_token: str = WEBHOOK_SECRET,
+                 max_concurrency: int = WEBHOOK_MAX_CONCURRENCY, max_queue: int = WEBHOOK_MAX_QUEUE,
+                 webhook_url: str = WEBHOOK_URL, metrics_host: str = METRICS_HOST,
+                 metrics_port: int = WEBHOOK_METRICS_PORT):
+        self.applications = applications
+        self.secret_token = secret_token
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.webhook_url = webhook_url.rstrip("/")
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.in_flight = 0
+        self.rejected = 0
+        self.received = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            # Ответы webhook без тела: Telegram смотрит только на статус
+            status = await self._handle(scope, receive)
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-length", b"0")]
+            })
+            await send({"type": "http.response.body", "body": b""})
+
+    def render_registry(self) -> str:
+        return REGISTRY.render()
+
+    def render_metrics(self) -> str:
+        """Метрики процесса и счетчики webhook-сервера в формате Prometheus"""
+        return self.render_registry() + (
+            "# TYPE webhook_updates_received_total counter\n"
+            f"webhook_updates_received_total {self.received}\n"
+            "# TYPE webhook_updates_rejected_total counter\n"
+            f"webhook_updates_rejected_total {self.rejected}\n"
+            "# TYPE webhook_requests_in_flight gauge\n"
+            f"webhook_requests_in_flight {self.in_flight}\n"
+        )
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.error(f"Ошибка запуска webhook-сервера: {e}")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def start_metrics(self):
+        """Локальный эндпоинт /metrics с метриками процесса и webhook-сервера"""
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = await start_metrics_server(
+                self.metrics_port, self.metrics_host, render=self.render_metrics
+            )
+
+    async def startup(self):
+        await self.start_metrics()
+        for name, application in self.applications.items():
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            if self.webhook_url:
+                await application.bot.set_webhook(
+                    url=f"{self.webhook_url}/webhook/{name}",
+                    secret_token=self.secret_token,
+                    max_connections=self.max_concurrency
+                )
+            await application.start()
+            logger.info(f"Бот {name} принимает обновления через webhook")
+
+    async def shutdown(self):
+        for application in self.applications.values():
+            await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+            self.metrics_server = None
+
+    async def _read_body(self, receive) -> bytes:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    async def _handle(self, scope, receive) -> int:
+        path = scope["path"].rstrip("/")
+        if scope["method"] != "POST" or not path.startswith("/webhook/"):
+            return 404
+        application = self.applications.get(path[len("/webhook/"):])
+        if application is None:
+            return 404
+
+        headers = dict(scope["headers"])
+        if self.secret_token and headers.get(b"x-telegram-bot-api-secret-token", b"").decode() != self.secret_token:
+            return 403
+
+        if self.in_flight >= self.max_concurrency or application.update_queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            return 503
+
+        self.in_flight += 1
+        try:
+            data = json.loads(await self._read_body(receive))
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            self.received += 1
+            return 200
+        except (ValueError, TypeError) as e:
+            logger.error(f"Некорректное обновление: {e}")
+            return 400
+        finally:
+            self.in_flight -= 1
+
+def build_server(builder_factory=None) -> WebhookServer:
+    """Собирает оба бота без собственного updater и ASGI-приложение для них"""
+    import admin
+    import bot
+
+    if builder_factory is None:
+        builder_factory = lambda: Application.builder().updater(None)
+    return WebhookServer({
+        "bot": bot.build_application(builder_factory()),
+        "admin": admin.build_application(builder_factory())
+    })
+
+def main():
+    """Запускает оба бота в одном процессе на WEBHOOK_PORT"""
+    import uvicorn
+
+    if not WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL не задан: webhook не будет зарегистрирован в Telegram")
+    uvicorn.run(
+        build_server(),
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        limit_concurrency=WEBHOOK_MAX_CONCURRENCY * 2,
+        lifespan="on"
+    )
+
+if __name__ == "__main__":
+    main()
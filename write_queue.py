@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from itertools import groupby
+
+from async_database import run_db
+from database import add_song, add_songs, update_song, update_songs
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер пачки и сколько секунд ждать попутные записи перед коммитом
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+WRITE_BATCH_DELAY = float(os.getenv("WRITE_BATCH_DELAY", "0.01"))
+
+class WriteBatcher:
+    """
+    Объединяет одновременные add_song и update_song из обработчиков в пачки:
+    одна транзакция и один коммит на пачку вместо коммита и refresh на каждую
+    запись. Пока пачка пишется, следующие записи копятся в очереди.
+
+    Записи выполняются в порядке вызовов: пачка пишется отрезками подряд
+    идущих добавлений или изменений. Каждый вызов получает свою песню или свое
+    исключение, как при прямом вызове: если отрезок не записался целиком
+    (например, одна песня не найдена), его записи повторяются по одной.
+    """
+
+    def __init__(self, max_batch: int = WRITE_BATCH_SIZE, max_delay: float = WRITE_BATCH_DELAY):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        # Запущенные записи пачек: ссылка не дает сборщику мусора удалить задачу, close() их дожидается
+        self._flushes = set()
+        self._lock = asyncio.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.fallbacks = 0
+        self.max_batch_seen = 0
+
+    async def add_song(self, title: str, region: str, text: str = None):
+        return await self._submit("add", {"title": title, "region": region, "text": text})
+
+    async def update_song(self, song_id: int, title: str = None, text: str = None, region: str = None):
+        return await self._submit("update", {"song_id": song_id, "title": title, "text": text, "region": region})
+
+    async def _submit(self, kind: str, payload: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, payload, future))
+        if len(self._pending) >= self.max_batch:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.max_delay)
+        return await future
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка при записи пачки: {task.exception()}")
+
+    async def close(self):
+        """Записывает накопленные записи и дожидается пачек, которые пишутся сейчас (остановка бота)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending or self._flushes:
+            if self._pending:
+                self._start_flush()
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def _flush(self):
+        async with self._lock:
+            self._timer = None
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if self._pending:
+                self._schedule(0)
+            if not batch:
+                return
+            self.batches += 1
+            self.writes += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            for kind, items in groupby(batch, key=lambda item: item[0]):
+                if kind == "add":
+                    await self._write(list(items), add_songs, add_song)
+                else:
+                    await self._write(list(items), update_songs, update_song)
+
+    async def _write(self, items, write_many, write_one):
+        if not items:
+            return
+        try:
+            results = await run_db(write_many, [payload for _, payload, _ in items])
+        except Exception as e:
+            if len(items) == 1:
+                if not items[0][2].done():
+                    items[0][2].set_exception(e)
+                return
+            logger.warning(f"Пачка из {len(items)} записей не записана ({e}), записываем по одной")
+            await self._write_each(items, write_one)
+            return
+        for (_, _, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _write_each(self, items, write_one):
+        self.fallbacks += 1
+        for _, payload, future in items:
+            try:
+                result = await run_db(write_one, **payload)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "writes": self.writes,
+            "fallbacks": self.fallbacks,
+            "max_batch": self.max_batch_seen
+        }